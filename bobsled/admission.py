@@ -0,0 +1,83 @@
+import collections
+import datetime
+
+
+def _parse_limits(limits):
+    """parse 'tag=n,other=m' into a dict"""
+    parsed = {}
+    for item in limits.split(","):
+        if item.strip():
+            tag, limit = item.split("=")
+            parsed[tag.strip()] = int(limit)
+    return parsed
+
+
+class Usage:
+    """counts of active runs, overall, per task, and per tag"""
+
+    def __init__(self):
+        self.total = 0
+        self.by_task = collections.Counter()
+        self.by_tag = collections.Counter()
+
+    @classmethod
+    def from_runs(cls, runs):
+        usage = cls()
+        for run in runs:
+            usage.add(run.task, run.run_info.get("tags", []))
+        return usage
+
+    def add(self, task_name, tags):
+        self.total += 1
+        self.by_task[task_name] += 1
+        for tag in tags:
+            self.by_tag[tag] += 1
+
+
+class AdmissionController:
+    """
+    decides whether a run can start now or has to wait in the queue
+
+    a limit of 0 means unlimited, tag limits are given as 'tag=n,other=m'
+
+    queued runs are started highest priority first, every BOBSLED_QUEUE_AGING_SECONDS
+    spent waiting raises a run's priority by one so low priority runs don't starve
+    """
+
+    def __init__(
+        self,
+        BOBSLED_MAX_RUNNING=0,
+        BOBSLED_MAX_RUNNING_PER_TAG="",
+        BOBSLED_MAX_RUNNING_PER_TASK=1,
+        BOBSLED_QUEUE_AGING_SECONDS=300,
+    ):
+        self.max_running = int(BOBSLED_MAX_RUNNING)
+        self.max_per_tag = _parse_limits(BOBSLED_MAX_RUNNING_PER_TAG)
+        self.max_per_task = int(BOBSLED_MAX_RUNNING_PER_TASK)
+        self.aging_seconds = float(BOBSLED_QUEUE_AGING_SECONDS)
+
+    def task_at_limit(self, task, usage):
+        return bool(self.max_per_task) and usage.by_task[task.name] >= self.max_per_task
+
+    def admit(self, task, usage):
+        if self.max_running and usage.total >= self.max_running:
+            return False
+        for tag in task.tags:
+            limit = self.max_per_tag.get(tag)
+            if limit and usage.by_tag[tag] >= limit:
+                return False
+        return not self.task_at_limit(task, usage)
+
+    def effective_priority(self, run, now):
+        priority = run.run_info.get("priority", 0)
+        if self.aging_seconds:
+            queued_at = datetime.datetime.fromisoformat(run.run_info["queued_at"])
+            priority += (now - queued_at).total_seconds() / self.aging_seconds
+        return priority
+
+    def queue_order(self, runs, now):
+        """queued runs in the order they should be started"""
+        return sorted(
+            runs,
+            key=lambda r: (-self.effective_priority(r, now), r.run_info["queued_at"]),
+        )
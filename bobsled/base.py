@@ -1,8 +1,12 @@
 import attr
+import asyncio
 import enum
+import hashlib
+import json
 import uuid
 import datetime
 import typing
+from .admission import Usage
 from .exceptions import AlreadyRunning
 
 
@@ -14,6 +18,7 @@ class Status(enum.Enum):
     UserKilled = 5
     TimedOut = 6
     Missing = 7
+    Queued = 8
 
     def is_terminal(self):
         return self.value in (3, 4, 5, 6, 7)
@@ -29,6 +34,8 @@ class Environment:
 @attr.s(auto_attribs=True)
 class Trigger:
     cron: str
+    # minutes after each cron time the run may be placed in to spread out load
+    window: int = 0
 
 
 @attr.s(auto_attribs=True)
@@ -43,6 +50,7 @@ class Task:
     enabled: bool = True
     timeout_minutes: int = 0
     error_threshold: int = 3
+    priority: int = 0
     triggers: typing.List[Trigger] = []
     next_tasks: typing.List[str] = []
 
@@ -50,6 +58,45 @@ class Task:
         if isinstance(self.entrypoint, str):
             self.entrypoint = self.entrypoint.split()
 
+    def content_hash(self):
+        data = json.dumps(attr.asdict(self), sort_keys=True)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+
+@attr.s(auto_attribs=True)
+class TaskDiff:
+    tasks: typing.List[Task] = attr.Factory(list)
+    added: typing.List[Task] = attr.Factory(list)
+    changed: typing.List[Task] = attr.Factory(list)
+    removed: typing.List[str] = attr.Factory(list)
+
+    @classmethod
+    def between(cls, old_hashes, tasks):
+        """
+        compare tasks against a dict mapping names to content_hash of the old tasks
+        """
+        diff = cls(tasks=list(tasks))
+        for task in tasks:
+            old_hash = old_hashes.get(task.name)
+            if old_hash is None:
+                diff.added.append(task)
+            elif old_hash != task.content_hash():
+                diff.changed.append(task)
+        names = {task.name for task in tasks}
+        diff.removed = [name for name in old_hashes if name not in names]
+        return diff
+
+
+def parse_time(value):
+    """a run time from its ISO string, or None for an empty one"""
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        # before 3.11 fromisoformat needs 3 or 6 digits of fractional seconds
+        return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+
 
 @attr.s(auto_attribs=True)
 class Run:
@@ -61,6 +108,30 @@ class Run:
     exit_code: int = None
     run_info: typing.Dict[str, any] = {}
     uuid: str = attr.Factory(lambda: uuid.uuid4().hex)
+    duration_seconds: float = None
+
+    def set_duration(self):
+        """set duration_seconds once the run has ended, storages call this on save"""
+        if self.end and self.start and self.duration_seconds is None:
+            end, start = parse_time(self.end), parse_time(self.start)
+            self.duration_seconds = (end - start).total_seconds()
+
+    def complete_logs(self):
+        """
+        the logs that can be stored: up to the last full line while the run is going,
+        since a partial line may hold a secret that isn't masked yet, and all of them
+        once it has finished
+        """
+        if self.status.is_terminal():
+            return self.logs
+        return self.logs[: self.logs.rfind("\n") + 1]
+
+
+@attr.s(auto_attribs=True)
+class ScheduleState:
+    task: str
+    last_run: datetime.datetime = None
+    next_run: datetime.datetime = None
 
 
 @attr.s(auto_attribs=True)
@@ -70,13 +141,70 @@ class User:
     permissions: typing.List[str] = []
 
 
+ACTIVE_STATUSES = [Status.Queued, Status.Pending, Status.Running]
+
+
+@attr.s(auto_attribs=True)
+class ActiveRuns:
+    """snapshot of the runs that haven't finished, returned by get_active_runs"""
+
+    runs: typing.List[Run]
+
+    @property
+    def counts(self):
+        counts = {status: 0 for status in ACTIVE_STATUSES}
+        for run in self.runs:
+            counts[run.status] += 1
+        return counts
+
+    def with_status(self, *statuses):
+        return [r for r in self.runs if r.status in statuses]
+
+
 class RunService:
-    async def run_task(self, task):
-        running = await self.get_runs(
-            status=[Status.Pending, Status.Running], task_name=task.name
-        )
-        if running:
+    """
+    subclasses provide start_task, stop, update_status and _time_out, and set
+    storage, callbacks, admission and timeouts (a DeadlineQueue) in __init__
+    """
+
+    # created on first use so it belongs to the running event loop
+    _dispatch_lock = None
+    # a claimed run that hasn't started after this long was left behind by a
+    # dispatching process that died, and is given up on as Missing
+    CLAIM_TIMEOUT_SECONDS = 300
+    # set in the process that calls check_timeouts (the leader beat), elsewhere
+    # nothing would ever take tracked runs off the deadline queue
+    tracks_timeouts = False
+
+    async def run_task(self, task, priority=None):
+        active = await self.storage.get_runs(status=ACTIVE_STATUSES)
+        started = [r for r in active if r.status != Status.Queued]
+        queued = [r for r in active if r.status == Status.Queued]
+        usage = Usage.from_runs(started)
+        if any(r.task == task.name for r in queued) or self.admission.task_at_limit(
+            task, usage
+        ):
             raise AlreadyRunning()
+
+        if not queued and self.admission.admit(task, usage):
+            return await self._start_run(task)
+
+        now = datetime.datetime.utcnow().isoformat()
+        run = Run(
+            task.name,
+            Status.Queued,
+            start=now,
+            run_info={
+                "queued_at": now,
+                "tags": task.tags,
+                "priority": task.priority if priority is None else priority,
+            },
+        )
+        await self.storage.add_run(run)
+        await self.dispatch_queued()
+        return await self.storage.get_run(run.uuid)
+
+    async def _start_run(self, task, run=None):
         run_info = self.start_task(task)
         now = datetime.datetime.utcnow()
         timeout_at = ""
@@ -85,15 +213,133 @@ class RunService:
                 now + datetime.timedelta(minutes=task.timeout_minutes)
             ).isoformat()
         run_info["timeout_at"] = timeout_at
+        run_info["tags"] = task.tags
 
-        run = Run(
-            task.name, self.STARTING_STATUS, start=now.isoformat(), run_info=run_info
-        )
-        await self.storage.add_run(run)
+        if run:
+            queued_at = datetime.datetime.fromisoformat(run.run_info["queued_at"])
+            run_info["queued_seconds"] = (now - queued_at).total_seconds()
+            run.run_info.update(run_info)
+            run.status = self.STARTING_STATUS
+            run.start = now.isoformat()
+            await self.storage.save_run(run)
+        else:
+            run = Run(
+                task.name,
+                self.STARTING_STATUS,
+                start=now.isoformat(),
+                run_info=run_info,
+            )
+            await self.storage.add_run(run)
+        self.track_timeout(run)
+        return run
+
+    def track_timeout(self, run):
+        """add a run's timeout to the deadline queue checked by check_timeouts"""
+        timeout_at = run.run_info.get("timeout_at")
+        if not self.tracks_timeouts or not timeout_at or run.status.is_terminal():
+            return
+        deadline = datetime.datetime.fromisoformat(timeout_at)
+        if self.timeouts.get(run.uuid) != deadline:
+            self.timeouts.push(run.uuid, deadline)
+
+    async def check_timeouts(self, now=None):
+        """time out the runs whose deadline has passed, returns them"""
+        if not now:
+            now = datetime.datetime.utcnow()
+        timed_out = []
+        for run_id, _ in self.timeouts.pop_due(now):
+            run = await self.storage.get_run(run_id)
+            if run and not run.status.is_terminal() and run.status != Status.Queued:
+                await self._time_out(run)
+                timed_out.append(run)
+        return timed_out
+
+    async def dispatch_queued(self):
+        """start as many queued runs as the admission limits allow, by priority"""
+        # runs finishing together each dispatch, one at a time so they see each
+        # other's starts
+        if not self._dispatch_lock:
+            self._dispatch_lock = asyncio.Lock()
+        async with self._dispatch_lock:
+            return await self._dispatch_queued()
+
+    def _being_started(self, run):
+        """claimed from the queue by dispatch_queued but not started yet"""
+        # _start_run sets timeout_at along with the runner's own run_info
+        return run.status == Status.Pending and "timeout_at" not in run.run_info
+
+    async def _check_claim(self, run):
+        """update_status for a run that's being started, see _being_started"""
+        claimed_at = run.run_info.get("claimed_at") or run.run_info["queued_at"]
+        waited = datetime.datetime.utcnow() - parse_time(claimed_at)
+        if waited.total_seconds() > self.CLAIM_TIMEOUT_SECONDS:
+            run.status = Status.Missing
+            run.end = datetime.datetime.utcnow().isoformat()
+            run.logs = f"not started within {self.CLAIM_TIMEOUT_SECONDS}s of dispatch"
+            await self._save_and_followup(run)
         return run
 
+    async def _dispatch_queued(self):
+        active = await self.storage.get_runs(status=ACTIVE_STATUSES)
+        usage = Usage.from_runs(r for r in active if r.status != Status.Queued)
+        queued = self.admission.queue_order(
+            [r for r in active if r.status == Status.Queued],
+            datetime.datetime.utcnow(),
+        )
+        started = []
+        for run in queued:
+            if self.admission.max_running and usage.total >= self.admission.max_running:
+                break
+            try:
+                task = await self.storage.get_task(run.task)
+            except KeyError:
+                task = None
+            if not task:
+                run.status = Status.Error
+                run.end = datetime.datetime.utcnow().isoformat()
+                run.logs = f"task {run.task} no longer exists"
+                await self.storage.save_run(run)
+                continue
+            if not self.admission.admit(task, usage):
+                continue
+            # web processes and other beats dispatch too, only one may start the run
+            run_info = dict(
+                run.run_info, claimed_at=datetime.datetime.utcnow().isoformat()
+            )
+            if not await self.storage.claim_run(
+                run.uuid, Status.Queued, Status.Pending, run_info
+            ):
+                continue
+            run.run_info = run_info
+            try:
+                started.append(await self._start_run(task, run))
+            except Exception as e:
+                # claimed, so no one else will try to start it
+                run.status = Status.Error
+                run.end = datetime.datetime.utcnow().isoformat()
+                run.logs = f"failed to start: {e}"
+                await self.storage.save_run(run)
+                raise
+            usage.add(task.name, task.tags)
+        return started
+
+    async def queue_stats(self, queued=None):
+        if queued is None:
+            queued = await self.storage.get_runs(status=Status.Queued)
+        now = datetime.datetime.utcnow()
+        waits = [
+            (
+                now - datetime.datetime.fromisoformat(r.run_info["queued_at"])
+            ).total_seconds()
+            for r in queued
+        ]
+        return {"depth": len(queued), "oldest_wait_seconds": max(waits, default=0)}
+
     async def _save_and_followup(self, run):
         await self.storage.save_run(run)
+        if run.status.is_terminal():
+            # before the callbacks, which may read the stats
+            await self.storage.update_task_stats(run)
         if run.status == Status.Success:
             # start other jobs and do on success callback
             try:
@@ -114,23 +360,52 @@ class RunService:
             for callback in self.callbacks:
                 await callback.on_error(run, self.storage)
 
+        if run.status.is_terminal():
+            self.timeouts.remove(run.uuid)
+            # a slot has opened up
+            await self.dispatch_queued()
+
     async def get_runs(
-        self, *, status=None, task_name=None, latest=None, update_status=False
+        self,
+        *,
+        status=None,
+        task_name=None,
+        latest=None,
+        before=None,
+        after=None,
+        update_status=False,
     ):
         runs = await self.storage.get_runs(
-            status=status, task_name=task_name, latest=latest
+            status=status,
+            task_name=task_name,
+            latest=latest,
+            before=before,
+            after=after,
         )
         if update_status:
             for run in runs:
-                await self.update_status(run.uuid)
-        # sort runs old to new
-        runs.sort(key=lambda r: r.start, reverse=True)
+                await self.update_status(run)
+        # sort runs new to old
+        runs.sort(key=lambda r: (r.start, r.uuid), reverse=True)
         return runs
 
+    async def _load_run(self, run):
+        """update_status takes a Run or a run id"""
+        if isinstance(run, Run):
+            return run
+        return await self.storage.get_run(run)
+
     async def stop_run(self, run_id):
         run = await self.storage.get_run(run_id)
         if not run.status.is_terminal():
-            self.stop(run)
+            was_queued = run.status == Status.Queued
+            if not was_queued:
+                self.stop(run)
             run.status = Status.UserKilled
             run.end = datetime.datetime.utcnow().isoformat()
+            self.timeouts.remove(run.uuid)
             await self.storage.save_run(run)
+            await self.storage.update_task_stats(run)
+            if not was_queued:
+                # a slot has opened up
+                await self.dispatch_queued()
@@ -1,85 +1,467 @@
 import os
 import asyncio
+import socket
 import datetime
 import zmq
-from .base import Status
+import zmq.asyncio
+from .base import ScheduleState, Status, TaskDiff
 from .core import bobsled
+from .cron import TaskSchedule, compile_cron
 from .exceptions import AlreadyRunning
-
-
-def parse_cron_segment(segment, star_equals):
-    if segment == "*":
-        return star_equals
-    elif "," in segment:
-        return sorted([int(n) for n in segment.split(",")])
-    elif "-" in segment:
-        start, end = segment.split("-")
-        return list(range(int(start), int(end) + 1))
-    elif segment.startswith("*/"):
-        n = int(segment[2:])
-        return list(range(0, 24, n))
-    elif segment.isdigit():
-        return [int(segment)]
-    else:
-        raise ValueError(segment)
+from .retention import Retention
+from .scheduler import DeadlineQueue
+from .sharding import HashRing
+from .utils import load_args
 
 
 def next_cron(cronstr, after=None):
-    minute, hour, day, month, dow = cronstr.split()
-
-    days = parse_cron_segment(day, list(range(1, 32)))
-    minutes = parse_cron_segment(minute, list(range(60)))
-    hours = parse_cron_segment(hour, list(range(24)))
+    if not after:
+        after = datetime.datetime.utcnow()
+    return compile_cron(cronstr).next_after(after)
 
-    # scheduling things that don't run every month not currently supported
-    assert month == "*"
-    assert dow == "?"
 
+def next_run_for_task(task, after=None):
     if not after:
         after = datetime.datetime.utcnow()
-    next_time = None
+    return TaskSchedule.for_task(task).next_after(after)
+
+
+# TODO: make these configurable
+LOG_FILE = "/tmp/bobsled-beat.log"
+UPDATE_CONFIG_MINS = 120
+STATUS_POLL_SECONDS = 60
+RETENTION_MINS = 60
+# batches of expired runs removed per tick, so a backlog doesn't hold up due tasks
+RETENTION_BATCHES = 4
+MEMBER_LEASE_PREFIX = "beat:"
+LEADER_LEASE = "beat-leader"
+
+
+class Beat:
+    """
+    event-driven scheduler
+
+    upcoming runs are kept in a DeadlineQueue, the loop sleeps until the earliest of
+    the next run, the next run timeout, the next status poll, the next config update,
+    or a call to wakeup(), e.g. from config_changed() when the web UI reloads config
+
+    when sharded, each instance holds a membership lease in storage and schedules only
+    the tasks it owns on a hash ring of the live members.  the instance holding the
+    leader lease refreshes config and polls run status, the others re-read tasks from
+    storage.  an instance that stops renewing its leases drops out of the ring once they
+    expire and its tasks are taken over by the rest.
+
+    the leader also applies the run retention policy, if one is given.
+    """
+
+    CATCHUP_POLICIES = ("skip", "once", "all")
+
+    def __init__(
+        self,
+        bobsled,
+        log=print,
+        retention=None,
+        *,
+        BOBSLED_BEAT_CATCHUP="once",
+        BOBSLED_BEAT_SHARDED="false",
+        BOBSLED_BEAT_INSTANCE_ID="",
+        BOBSLED_BEAT_LEASE_SECONDS=15,
+    ):
+        if BOBSLED_BEAT_CATCHUP not in self.CATCHUP_POLICIES:
+            raise ValueError(
+                f"BOBSLED_BEAT_CATCHUP must be one of {self.CATCHUP_POLICIES}"
+            )
+        self.bobsled = bobsled
+        self.log = log
+        self.catchup = BOBSLED_BEAT_CATCHUP
+        self.sharded = str(BOBSLED_BEAT_SHARDED).lower() in ("1", "true", "yes")
+        self.instance_id = (
+            BOBSLED_BEAT_INSTANCE_ID or f"{socket.gethostname()}-{os.getpid()}"
+        )
+        self.lease_seconds = float(BOBSLED_BEAT_LEASE_SECONDS)
+        # ring of live beat instances, None when not sharded
+        self.ring = None
+        self.is_leader = not self.sharded
+        self.retention = retention
+        self.bobsled.run.tracks_timeouts = self.is_leader
+        # last time each task was started by beat
+        self.last_runs = {}
+        # content hashes of the tasks the schedule was built from
+        self.task_hashes = {}
+        # offsets within trigger windows chosen by the planner
+        self.offsets = {}
+        self.schedule = DeadlineQueue()
+        # merged iterator of upcoming times for each scheduled task
+        self._upcoming = {}
+        # with the 'all' catch-up policy, when each catching up task came back up and
+        # the missed run held back until the task's previous run finishes
+        self.catching_up = {}
+        self.held = {}
+        self._wakeup = asyncio.Event()
+        # set when config was refreshed elsewhere and tasks need re-reading
+        self.tasks_changed = False
+        now = datetime.datetime.utcnow()
+        self.next_status_poll = now
+        self.next_config_update = now + datetime.timedelta(minutes=UPDATE_CONFIG_MINS)
+        self.next_membership_check = now
+        self.next_retention = now
+
+    def schedule_task(self, task, after=None):
+        if not after:
+            after = datetime.datetime.utcnow()
+        self.catching_up.pop(task.name, None)
+        self.held.pop(task.name, None)
+        self._upcoming[task.name] = self._task_schedule(task).iter_after(after)
+        return self._advance(task.name, after)
+
+    def _task_schedule(self, task):
+        return TaskSchedule.for_task(task, self.offsets.get(task.name))
+
+    def unschedule_task(self, task_name):
+        self._upcoming.pop(task_name, None)
+        self.catching_up.pop(task_name, None)
+        self.held.pop(task_name, None)
+        self.schedule.remove(task_name)
 
-    for day in days:
-        for hour in hours:
-            for minute in minutes:
+    def _advance(self, task_name, after):
+        next_run = None
+        for when in self._upcoming.get(task_name, ()):
+            if when > after:
+                next_run = when
+                break
+        if next_run:
+            self.schedule.push(task_name, next_run)
+        else:
+            self.unschedule_task(task_name)
+        return next_run
+
+    def resume_task(self, task, state, now):
+        """
+        schedule a task using its persisted state, applying the catch-up policy if
+        runs were missed while beat wasn't running
+        """
+        if state:
+            self.last_runs[task.name] = state.last_run
+        if (
+            not state
+            or not state.next_run
+            or state.next_run > now
+            or self.catchup == "skip"
+        ):
+            return self.schedule_task(task, now)
+
+        schedule = self._task_schedule(task)
+        if self.catchup == "once":
+            self._upcoming[task.name] = schedule.iter_after(now)
+        else:
+            # walk through every missed time, start_due advances from each due time
+            self._upcoming[task.name] = schedule.iter_after(state.next_run)
+            self.catching_up[task.name] = now
+        self.schedule.push(task.name, state.next_run)
+        self.log(f"{task.name} missed run at {state.next_run}, catching up")
+        return state.next_run
+
+    def owns(self, task_name):
+        return self.ring is None or self.ring.owner(task_name) == self.instance_id
+
+    async def update_membership(self, now=None):
+        """
+        renew this instance's leases and rebuild the ring from the live members
+
+        returns True if the members changed
+        """
+        if not now:
+            now = datetime.datetime.utcnow()
+        storage = self.bobsled.storage
+        await storage.acquire_lease(
+            MEMBER_LEASE_PREFIX + self.instance_id, self.instance_id, self.lease_seconds
+        )
+        was_leader = self.is_leader
+        self.is_leader = await storage.acquire_lease(
+            LEADER_LEASE, self.instance_id, self.lease_seconds
+        )
+        if self.is_leader != was_leader:
+            # the leader checks timeouts, poll_status tracks the active runs' deadlines
+            self.bobsled.run.tracks_timeouts = self.is_leader
+            if self.is_leader:
+                self.log(f"{self.instance_id} is now the leader")
+                self.next_status_poll = now
+            else:
+                self.bobsled.run.timeouts = DeadlineQueue()
+        # renew well before the leases expire
+        self.next_membership_check = now + datetime.timedelta(
+            seconds=self.lease_seconds / 3
+        )
+
+        members = set((await storage.get_leases(MEMBER_LEASE_PREFIX)).values())
+        members.add(self.instance_id)
+        if self.ring and self.ring.members == sorted(members):
+            return False
+        self.ring = HashRing(members)
+        self.log(f"beat members: {', '.join(self.ring.members)}")
+        return True
+
+    async def release_leases(self):
+        storage = self.bobsled.storage
+        await storage.release_lease(LEADER_LEASE, self.instance_id)
+        await storage.release_lease(
+            MEMBER_LEASE_PREFIX + self.instance_id, self.instance_id
+        )
+
+    def _state(self, task_name):
+        # a held missed run is still to come, not the time it's retried at
+        next_run = self.held.get(task_name) or self.schedule.get(task_name)
+        return ScheduleState(task_name, self.last_runs.get(task_name), next_run)
+
+    async def load_schedule(self):
+        self.offsets = await self.bobsled.storage.get_schedule_offsets()
+        if self.sharded:
+            await self.update_membership()
+        await self.resume_owned()
+
+    async def resume_owned(self, now=None):
+        """
+        schedule owned tasks that aren't scheduled yet from their persisted state and
+        drop tasks owned by another instance
+        """
+        if not now:
+            now = datetime.datetime.utcnow()
+        states = await self.bobsled.storage.get_schedule_states()
+        for task in await self.bobsled.storage.get_tasks():
+            owned = self.owns(task.name)
+            if owned and task.name in self.schedule:
+                # already scheduled, changes are picked up by update_config
+                continue
+            self.task_hashes[task.name] = task.content_hash()
+            if not owned:
+                self.unschedule_task(task.name)
+                continue
+            if not task.enabled:
+                continue
+            try:
+                next_run = self.resume_task(task, states.get(task.name), now)
+            except ValueError as e:
+                self.log(f"{task.name}: invalid trigger {e}")
+                continue
+            if next_run:
+                self.log(f"{task.name} next run at {next_run}")
+        await self.bobsled.storage.set_schedule_states(
+            [self._state(name) for name, _ in self.schedule.items()]
+        )
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def config_changed(self):
+        """tasks were refreshed by another process, pick them up on the next tick"""
+        self.tasks_changed = True
+        self.wakeup()
+
+    def next_wakeup(self):
+        deadlines = [self.next_config_update]
+        # only the leader polls status, a follower's next_status_poll is never advanced
+        if self.is_leader:
+            deadlines.append(self.next_status_poll)
+            if self.retention:
+                deadlines.append(self.next_retention)
+        if self.sharded:
+            deadlines.append(self.next_membership_check)
+        for deadline in (self.schedule.peek(), self.bobsled.run.timeouts.peek()):
+            if deadline:
+                deadlines.append(deadline)
+        return min(deadlines)
+
+    async def poll_status(self):
+        active = await self.bobsled.storage.get_active_runs()
+        counts = active.counts
+        utcnow = datetime.datetime.utcnow()
+
+        queue = await self.bobsled.run.queue_stats(active.with_status(Status.Queued))
+
+        self.log(
+            f"{utcnow}: pending={counts[Status.Pending]} running={counts[Status.Running]} "
+            f"queued={queue['depth']} longest wait={queue['oldest_wait_seconds']:.0f}s"
+        )
+
+        started = active.with_status(Status.Pending, Status.Running)
+        # runs started elsewhere (e.g. from the web ui) get their timeouts tracked here
+        for run in started:
+            self.bobsled.run.track_timeout(run)
+
+        # parallel updates from all running tasks
+        await asyncio.gather(
+            *[self.bobsled.run.update_status(run, update_logs=True) for run in started]
+        )
+        await self.bobsled.run.dispatch_queued()
+
+    async def update_config(self, refresh=True):
+        if self.is_leader and refresh:
+            self.log("updating config...")
+            tasks = (await self.bobsled.refresh_config()).tasks
+        else:
+            # the leader refreshes config, followers pick it up from storage
+            tasks = await self.bobsled.storage.get_tasks()
+        # diff against what beat scheduled, config may have been refreshed elsewhere
+        beat_diff = TaskDiff.between(self.task_hashes, tasks)
+
+        # tasks the planner has moved need rescheduling too
+        offsets = await self.bobsled.storage.get_schedule_offsets()
+        moved = {
+            name
+            for name in set(offsets) | set(self.offsets)
+            if offsets.get(name) != self.offsets.get(name)
+        }
+        self.offsets = offsets
+        updated = {task.name for task in beat_diff.added + beat_diff.changed}
+        beat_diff.changed += [task for task in tasks if task.name in moved - updated]
+        await self.apply_diff(beat_diff)
+
+    async def apply_diff(self, diff, now=None):
+        if not now:
+            now = datetime.datetime.utcnow()
+        for name in diff.removed:
+            self.unschedule_task(name)
+            self.task_hashes.pop(name, None)
+            self.last_runs.pop(name, None)
+            self.log(f"{name} removed")
+
+        for task in diff.added + diff.changed:
+            self.task_hashes[task.name] = task.content_hash()
+            next_run = None
+            if task.enabled and self.owns(task.name):
                 try:
-                    next_time = after.replace(
-                        day=day, hour=hour, minute=minute, second=0, microsecond=0
+                    next_run = self.schedule_task(task, now)
+                except ValueError as e:
+                    self.log(f"{task.name}: invalid trigger {e}")
+            if not next_run:
+                self.unschedule_task(task.name)
+            self.log(f"{task.name} updated, next run at {next_run}")
+
+        if diff.removed:
+            await self.bobsled.storage.delete_schedule_states(diff.removed)
+        scheduled = [
+            self._state(task.name)
+            for task in diff.added + diff.changed
+            if task.name in self.schedule
+        ]
+        if scheduled:
+            await self.bobsled.storage.set_schedule_states(scheduled)
+
+    async def start_due(self, now):
+        fired = []
+        for task_name, due_at in self.schedule.pop_due(now):
+            try:
+                task = await self.bobsled.storage.get_task(task_name)
+            except KeyError:
+                task = None
+            if not task or not task.enabled:
+                # removed or disabled since beat last refreshed its config
+                self.unschedule_task(task_name)
+                continue
+            due_at = self.held.pop(task_name, due_at)
+            missed = due_at < self.catching_up.get(task_name, due_at)
+            try:
+                run = await self.bobsled.run.run_task(task)
+                msg = f"started {task_name}: {run}."
+            except AlreadyRunning:
+                if missed:
+                    # each missed run waits for the one before it, rather than
+                    # being dropped, and is retried once run status has been polled
+                    self.held[task_name] = due_at
+                    retry_at = now + datetime.timedelta(seconds=STATUS_POLL_SECONDS)
+                    self.schedule.push(task_name, retry_at)
+                    fired.append(self._state(task_name))
+                    self.log(
+                        f"{task_name}: already running, missed run at {due_at} "
+                        f"will be retried at {retry_at}"
                     )
-                except ValueError:
-                    # if we made an invalid time due to month rollover, skip it
                     continue
-                if next_time > after:
-                    return next_time
-
-    # no next time this month, set to the first time but the next month
-    if after.month == 12:
-        month = 1
-        year = after.year + 1
-    else:
-        month = after.month + 1
-        year = after.year
-    next_time = next_time.replace(
-        day=days[0], hour=hours[0], minute=minutes[0], month=month, year=year,
-    )
-    return next_time
+                msg = f"{task_name}: already running."
+            next_run = self._advance(task_name, due_at if missed else now)
+            if next_run and next_run >= self.catching_up.get(task_name, next_run):
+                self.catching_up.pop(task_name, None)
+            self.last_runs[task_name] = due_at
+            fired.append(self._state(task_name))
+            self.log(f"{msg}  next run at {next_run}")
+        if fired:
+            await self.bobsled.storage.set_schedule_states(fired)
+
+    async def tick(self):
+        utcnow = datetime.datetime.utcnow()
 
+        if self.sharded and utcnow >= self.next_membership_check:
+            if await self.update_membership(utcnow):
+                await self.resume_owned(utcnow)
 
-def next_run_for_task(task):
-    for trigger in task.triggers:
-        return next_cron(trigger.cron)
+        if self.tasks_changed:
+            self.tasks_changed = False
+            self.log("config changed, updating tasks...")
+            await self.update_config(refresh=False)
 
+        if utcnow >= self.next_config_update:
+            await self.update_config()
+            if self.is_leader:
+                self.next_config_update = utcnow + datetime.timedelta(
+                    minutes=UPDATE_CONFIG_MINS
+                )
+                self.log(f"updated tasks, will run again at {self.next_config_update}")
+            else:
+                self.next_config_update = utcnow + datetime.timedelta(
+                    seconds=STATUS_POLL_SECONDS
+                )
 
-# TODO: make these configurable
-LOG_FILE = "/tmp/bobsled-beat.log"
-UPDATE_CONFIG_MINS = 120
+        if self.is_leader and utcnow >= self.next_status_poll:
+            await self.poll_status()
+            self.next_status_poll = utcnow + datetime.timedelta(
+                seconds=STATUS_POLL_SECONDS
+            )
+
+        if self.is_leader:
+            for run in await self.bobsled.run.check_timeouts(utcnow):
+                self.log(f"{run.task} timed out: {run}")
+
+        await self.start_due(utcnow)
+
+        if self.is_leader and self.retention and utcnow >= self.next_retention:
+            removed = await self.retention.run(utcnow, max_batches=RETENTION_BATCHES)
+            if removed:
+                self.log(f"archived {removed} expired runs")
+            if removed == RETENTION_BATCHES * self.retention.BATCH_SIZE:
+                # there may be more, carry on next tick
+                self.next_retention = utcnow
+            else:
+                self.next_retention = utcnow + datetime.timedelta(
+                    minutes=RETENTION_MINS
+                )
+
+    async def run_forever(self):
+        try:
+            while True:
+                await self.tick()
+                timeout = (
+                    self.next_wakeup() - datetime.datetime.utcnow()
+                ).total_seconds()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+        finally:
+            if self.sharded:
+                # let the other instances take over right away
+                await self.release_leases()
+
+
+async def listen_for_control(socket, beat):
+    """handle messages from other processes, see bobsled.web.notify_beat"""
+    while True:
+        message = await socket.recv_string()
+        if message == "config_changed":
+            beat.config_changed()
 
 
 async def run_service():
     await bobsled.initialize()
-    next_task_update = datetime.datetime.utcnow() + datetime.timedelta(
-        minutes=UPDATE_CONFIG_MINS
-    )
 
     port = os.environ.get("BOBSLED_BEAT_PORT", "1988")
 
@@ -91,50 +473,24 @@ async def run_service():
         socket.send_string(msg)
         print(msg)
 
-    next_run_list = {}
-    for task in await bobsled.storage.get_tasks():
-        if not task.enabled:
-            continue
-        next_run = next_run_for_task(task)
-        if next_run:
-            next_run_list[task.name] = next_run
-            _log(f"{task.name} next run at {next_run}")
-
-    while True:
-        pending = await bobsled.run.get_runs(status=Status.Pending)
-        running = await bobsled.run.get_runs(status=Status.Running)
-        utcnow = datetime.datetime.utcnow()
-
-        _log(f"{utcnow}: pending={len(pending)} running={len(running)}")
-
-        if utcnow > next_task_update:
-            _log("updating config...")
-            await bobsled.refresh_config()
-            next_task_update = utcnow + datetime.timedelta(minutes=UPDATE_CONFIG_MINS)
-            _log(f"updated tasks, will run again at {next_task_update}")
-
-        # parallel updates from all running tasks
-        await asyncio.gather(
-            *[
-                bobsled.run.update_status(run.uuid, update_logs=True)
-                for run in running + pending
-            ]
-        )
+    retention = Retention(bobsled.storage, **load_args(Retention))
+    beat = Beat(
+        bobsled,
+        log=_log,
+        retention=retention if retention.enabled else None,
+        **load_args(Beat),
+    )
+    await beat.load_schedule()
 
-        # TODO: could improve by basing next run time on last run instead of using utcnow
-        for task_name, next_run in next_run_list.items():
-            if next_run <= utcnow:
-                # update next run time
-                next_run_list[task_name] = next_run_for_task(task)
-                try:
-                    task = await bobsled.storage.get_task(task_name)
-                    run = await bobsled.run.run_task(task)
-                    msg = f"started {task_name}: {run}.  next run at {next_run_list[task_name]}"
-                except AlreadyRunning:
-                    msg = f"{task_name}: already running.  next run at {next_run_list[task_name]}"
-                _log(msg)
-
-        await asyncio.sleep(60)
+    control_port = os.environ.get("BOBSLED_BEAT_CONTROL_PORT", "1989")
+    control = zmq.asyncio.Context.instance().socket(zmq.PULL)
+    control.bind(f"tcp://*:{control_port}")
+    listener = asyncio.ensure_future(listen_for_control(control, beat))
+    try:
+        await beat.run_forever()
+    finally:
+        listener.cancel()
+        await bobsled.shutdown()
 
 
 if __name__ == "__main__":
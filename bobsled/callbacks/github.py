@@ -1,5 +1,4 @@
 import github3
-from ..base import Status
 
 
 class GithubIssueCallback:
@@ -28,17 +27,13 @@ class GithubIssueCallback:
 
     async def on_error(self, latest_run, storage):
         task = await storage.get_task(name=latest_run.task)
-        latest_runs = await storage.get_runs(task_name=latest_run.task, latest=5)
-        count = 0
-        for r in latest_runs:
-            if r.status == Status.Error:
-                count += 1
-            else:
-                break
+        # kept up to date as runs finish, see bobsled.stats
+        stats = (await storage.get_task_stats([latest_run.task])).get(latest_run.task)
+        count = stats.consecutive_failures if stats else 0
 
         # if the number of failures is > threshold, and threshold is nonzero
         if count >= task.error_threshold > 0:
-            self.make_issue(latest_run, count, r)
+            self.make_issue(latest_run, count, stats.failing_since)
 
     def get_existing_issue(self, task_name):
         existing_issues = self.repo_obj.issues(labels=self.tags[0], state="open")
@@ -46,17 +41,17 @@ class GithubIssueCallback:
             if issue.title.startswith(task_name):
                 return issue
 
-    def make_issue(self, latest_run, count, failure):
+    def make_issue(self, latest_run, count, failing_since):
         if self.get_existing_issue(latest_run.task):
             return
 
         logs = "\n".join(latest_run.logs.splitlines()[-20:])
-        body = f"""{latest_run.task} has failed {count} times since {failure.start[:10]}
+        body = f"""{latest_run.task} has failed {count} times since {failing_since[:10]}
 
 Logs:
 ```
 {logs}
 ```
         """
-        title = f"{latest_run.task} failing since at least {failure.start[:10]}"
+        title = f"{latest_run.task} failing since at least {failing_since[:10]}"
         self.repo_obj.create_issue(title=title, body=body, labels=self.tags)
@@ -1,6 +1,7 @@
 import os
 import asyncio
 from bobsled import storages, runners, callbacks
+from bobsled.admission import AdmissionController
 from bobsled.environment import EnvironmentProvider
 from bobsled.tasks import TaskProvider
 from bobsled.utils import get_env_config, load_args
@@ -27,12 +28,21 @@ class Bobsled:
             callback_classes.append(CallbackCls(**load_args(CallbackCls)))
 
         self.storage = StorageCls(**storage_args)
+        if os.environ.get("BOBSLED_TASK_CACHE_SECONDS"):
+            self.storage = storages.TaskCacheStorage(
+                self.storage, **load_args(storages.TaskCacheStorage)
+            )
+        if os.environ.get("BOBSLED_WRITE_BEHIND_SECONDS"):
+            self.storage = storages.WriteBehindStorage(
+                self.storage, **load_args(storages.WriteBehindStorage)
+            )
         self.env = EnvironmentProvider(**env_args)
         self.tasks = TaskProvider(storage=self.storage, **task_args)
         self.run = RunCls(
             storage=self.storage,
             environment=self.env,
             callbacks=callback_classes,
+            admission=AdmissionController(**load_args(AdmissionController)),
             **run_args,
         )
 
@@ -45,11 +55,31 @@ class Bobsled:
         else:
             self.run.initialize(tasks)
 
+    async def shutdown(self):
+        if isinstance(self.storage, storages.WriteBehindStorage):
+            # don't lose updates still waiting to be written
+            await self.storage.flush()
+
     async def refresh_config(self):
-        await asyncio.gather(self.tasks.update_tasks(), self.env.update_environments())
-        tasks = await self.storage.get_tasks()
-        self.run.initialize(tasks)
-        return tasks
+        old_environments = dict(self.env.environments)
+        diff, _ = await asyncio.gather(
+            self.tasks.update_tasks(), self.env.update_environments()
+        )
+        changed_environments = {
+            name
+            for name, env in self.env.environments.items()
+            if old_environments.get(name) != env
+        }
+        # only (re)initialize tasks that are new or whose definition changed
+        modified = {task.name for task in diff.added + diff.changed}
+        self.run.initialize(
+            [
+                task
+                for task in diff.tasks
+                if task.name in modified or task.environment in changed_environments
+            ]
+        )
+        return diff
 
 
 bobsled = Bobsled()
@@ -0,0 +1,266 @@
+import calendar
+import datetime
+import functools
+import heapq
+import itertools
+import zlib
+
+"""
+Cron expressions are the standard five fields:
+
+    minute hour day-of-month month day-of-week
+
+Each field accepts *, ? (same as *), numbers, ranges (a-b), lists (a,b,c) and steps
+(*/n, a/n, a-b/n).  Months and days of the week may also be given by name (JAN, MON),
+and Sunday is either 0 or 7.
+
+If both day-of-month and day-of-week are restricted a day matching either is used,
+matching the behavior of Vixie cron.
+"""
+
+ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+MONTH_NAMES = {
+    name.upper(): num for num, name in enumerate(calendar.month_abbr) if name
+}
+DOW_NAMES = {"SUN": 0, "MON": 1, "TUE": 2, "WED": 3, "THU": 4, "FRI": 5, "SAT": 6}
+
+# how far ahead to look before deciding an expression can never match (e.g. 0 0 30 2 *)
+MAX_YEARS_AHEAD = 8
+
+
+def _next_bit(bits, start):
+    """smallest set bit in bits that is >= start, or None"""
+    masked = bits >> start
+    if not masked:
+        return None
+    return start + (masked & -masked).bit_length() - 1
+
+
+def _parse_value(value, names):
+    value = value.upper()
+    if value in names:
+        return names[value]
+    if not value.isdigit():
+        raise ValueError(value)
+    return int(value)
+
+
+def parse_field(field, minimum, maximum, names=None):
+    """
+    parse a single cron field into a bitset where bit n is set if n matches
+    """
+    names = names or {}
+    bits = 0
+    for part in field.split(","):
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+            if step < 1:
+                raise ValueError(f"invalid step in {field}")
+        else:
+            step = 1
+
+        if part in ("*", "?"):
+            start, end = minimum, maximum
+        elif "-" in part:
+            start, end = part.split("-", 1)
+            start, end = _parse_value(start, names), _parse_value(end, names)
+        else:
+            start = _parse_value(part, names)
+            # a/n means a through the maximum, every n
+            end = maximum if step > 1 else start
+
+        if start < minimum or end > maximum or start > end:
+            raise ValueError(f"{field} out of range {minimum}-{maximum}")
+        for n in range(start, end + 1, step):
+            bits |= 1 << n
+    return bits
+
+
+class CronSchedule:
+    """
+    a cron expression compiled to one bitset per field
+
+    next_after only steps field by field (month, day, hour, minute) so the cost of
+    finding the next time doesn't depend on how far away it is
+    """
+
+    def __init__(self, cronstr):
+        self.cronstr = cronstr
+        fields = ALIASES.get(cronstr.strip(), cronstr).split()
+        if len(fields) != 5:
+            raise ValueError(f"cron expression must have five fields: {cronstr}")
+        minute, hour, dom, month, dow = fields
+
+        self.minutes = parse_field(minute, 0, 59)
+        self.hours = parse_field(hour, 0, 23)
+        self.days = parse_field(dom, 1, 31)
+        self.months = parse_field(month, 1, 12, MONTH_NAMES)
+        dows = parse_field(dow, 0, 7, DOW_NAMES)
+        # 7 is an alias for Sunday
+        if dows & (1 << 7):
+            dows = (dows | 1) & ~(1 << 7)
+        self.dows = dows
+        self.dom_restricted = dom not in ("*", "?")
+        self.dow_restricted = dow not in ("*", "?")
+        self._month_days = {}
+
+    def __repr__(self):
+        return f"CronSchedule({self.cronstr!r})"
+
+    def _days_in_month(self, year, month):
+        """bitset of the days in year/month that satisfy the day fields"""
+        key = (year, month)
+        if key not in self._month_days:
+            first_dow, ndays = calendar.monthrange(year, month)
+            # python weeks start on Monday, cron weeks start on Sunday
+            first_dow = (first_dow + 1) % 7
+            month_mask = ((1 << ndays) - 1) << 1
+
+            dow_days = 0
+            for day in range(1, ndays + 1):
+                if self.dows >> ((first_dow + day - 1) % 7) & 1:
+                    dow_days |= 1 << day
+
+            if self.dom_restricted and self.dow_restricted:
+                days = (self.days | dow_days) & month_mask
+            elif self.dow_restricted:
+                days = dow_days
+            else:
+                days = self.days & month_mask
+            self._month_days[key] = days
+        return self._month_days[key]
+
+    def next_after(self, after):
+        """first matching time strictly after 'after'"""
+        start = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        year, month, day = start.year, start.month, start.day
+        hour, minute = start.hour, start.minute
+
+        while year <= after.year + MAX_YEARS_AHEAD:
+            next_month = _next_bit(self.months, month)
+            if next_month is None:
+                year, month, day, hour, minute = year + 1, 1, 1, 0, 0
+                continue
+            if next_month != month:
+                month, day, hour, minute = next_month, 1, 0, 0
+
+            next_day = _next_bit(self._days_in_month(year, month), day)
+            if next_day is None:
+                month, day, hour, minute = month + 1, 1, 0, 0
+                if month > 12:
+                    year, month = year + 1, 1
+                continue
+            if next_day != day:
+                day, hour, minute = next_day, 0, 0
+
+            next_hour = _next_bit(self.hours, hour)
+            if next_hour is None:
+                # go to the next day, which may be in the next month
+                day, hour, minute = day + 1, 0, 0
+                continue
+            if next_hour != hour:
+                hour, minute = next_hour, 0
+
+            next_minute = _next_bit(self.minutes, minute)
+            if next_minute is None:
+                hour, minute = hour + 1, 0
+                continue
+            return datetime.datetime(year, month, day, hour, next_minute)
+
+        raise ValueError(f"{self.cronstr} never matches")
+
+    def iter_after(self, after):
+        """yield matching times after 'after' in order"""
+        while True:
+            after = self.next_after(after)
+            yield after
+
+    def next_n(self, after, n):
+        """list of the next n matching times after 'after'"""
+        times = []
+        for _ in range(n):
+            after = self.next_after(after)
+            times.append(after)
+        return times
+
+
+@functools.lru_cache(maxsize=None)
+def compile_cron(cronstr):
+    """cached CronSchedule for a cron string, parsed once per distinct expression"""
+    return CronSchedule(cronstr)
+
+
+def default_offset(task_name, window):
+    """stable offset in minutes for a trigger window, used until the planner picks one"""
+    if not window:
+        return 0
+    return zlib.crc32(task_name.encode()) % window
+
+
+class TaskSchedule:
+    """
+    the merged schedule of all of a task's triggers
+
+    iter_after does a k-way heap merge of the per-trigger iterators, so producing each
+    time only advances the trigger that supplied it
+
+    triggers with a window are shifted by an offset (in minutes) within that window
+    """
+
+    def __init__(self, crons, offsets=None):
+        self.crons = [compile_cron(cron) for cron in crons]
+        self.offsets = [
+            datetime.timedelta(minutes=offset) for offset in offsets or [0] * len(crons)
+        ]
+
+    @classmethod
+    def for_task(cls, task, offset=None):
+        offsets = []
+        for trigger in task.triggers:
+            if not trigger.window:
+                offsets.append(0)
+            elif offset is None:
+                offsets.append(default_offset(task.name, trigger.window))
+            else:
+                offsets.append(min(offset, trigger.window - 1))
+        return cls([trigger.cron for trigger in task.triggers], offsets)
+
+    def __bool__(self):
+        return bool(self.crons)
+
+    def _iter_trigger(self, cron, offset, after):
+        for when in cron.iter_after(after - offset):
+            yield when + offset
+
+    def iter_after(self, after):
+        """yield times after 'after' from any trigger, in order and without repeats"""
+        last = None
+        for when in heapq.merge(
+            *[
+                self._iter_trigger(cron, offset, after)
+                for cron, offset in zip(self.crons, self.offsets)
+            ]
+        ):
+            if when != last:
+                yield when
+                last = when
+
+    def next_after(self, after):
+        """earliest time after 'after' across all triggers, or None without triggers"""
+        if self.crons:
+            return min(
+                cron.next_after(after - offset) + offset
+                for cron, offset in zip(self.crons, self.offsets)
+            )
+
+    def next_n(self, after, n):
+        return list(itertools.islice(self.iter_after(after), n))
@@ -0,0 +1,37 @@
+import codecs
+import zlib
+
+"""
+Compression of finished runs' logs.
+
+Logs are stored as zlib compressed UTF-8 and decompressed a block at a time, so a
+reader streaming them never has the whole log in memory at once.
+"""
+
+COMPRESSION_LEVEL = 6
+BLOCK_SIZE = 64 * 1024
+
+
+def compress_logs(logs):
+    return zlib.compress(logs.encode(), COMPRESSION_LEVEL)
+
+
+def _iter_text(data):
+    decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for start in range(0, len(data), BLOCK_SIZE):
+        pending = data[start : start + BLOCK_SIZE]
+        while pending:
+            # limit the output too, repetitive logs expand a lot
+            yield decoder.decode(decompressor.decompress(pending, BLOCK_SIZE))
+            pending = decompressor.unconsumed_tail
+    yield decoder.decode(decompressor.flush(), final=True)
+
+
+def iter_decompressed(data, offset=0):
+    """yield the text of compressed logs in pieces, starting at character 'offset'"""
+    position = 0
+    for text in _iter_text(data):
+        if text and position + len(text) > offset:
+            yield text[max(offset - position, 0) :]
+        position += len(text)
@@ -0,0 +1,148 @@
+import datetime
+import math
+import attr
+import typing
+from .base import parse_time
+from .cron import TaskSchedule, default_offset
+
+"""
+Schedule planner that spreads out tasks whose triggers declare a window.
+
+Each windowed task is placed (largest first) at the offset within its window that
+keeps the predicted number of concurrent runs lowest, using recent run durations.
+Ties go to the task's current offset so that re-planning doesn't shuffle tasks around.
+"""
+
+DEFAULT_DURATION_MINUTES = 1
+HORIZON_MINUTES = 24 * 60
+
+
+def _minutes(seconds):
+    return max(1, math.ceil(seconds / 60))
+
+
+def run_minutes(run):
+    seconds = run.duration_seconds
+    if seconds is None:
+        seconds = (parse_time(run.end) - parse_time(run.start)).total_seconds()
+    return _minutes(seconds)
+
+
+async def expected_durations(storage, tasks):
+    """
+    median duration in minutes of each task's successful runs
+
+    read from the running task stats, so this is one query however many tasks there are
+    """
+    stats = await storage.get_task_stats([task.name for task in tasks])
+    durations = {}
+    for name, task_stats in stats.items():
+        seconds = task_stats.duration(0.5)
+        if seconds is not None:
+            durations[name] = _minutes(seconds)
+    return durations
+
+
+class LoadProfile:
+    """
+    predicted number of concurrent runs for each minute of a repeating horizon
+
+    runs that go past the end of the horizon wrap around to the start
+    """
+
+    def __init__(self, start, minutes=HORIZON_MINUTES):
+        self.start = start
+        self.load = [0] * minutes
+
+    @property
+    def peak(self):
+        return max(self.load, default=0)
+
+    def _minutes(self, schedule, duration):
+        size = len(self.load)
+        end = self.start + datetime.timedelta(minutes=size)
+        # start a minute early so a run at the very start of the horizon counts
+        for when in schedule.iter_after(self.start - datetime.timedelta(minutes=1)):
+            if when >= end:
+                break
+            first = int((when - self.start).total_seconds() // 60)
+            yield [(first + n) % size for n in range(min(duration, size))]
+
+    def add(self, schedule, duration):
+        for minutes in self._minutes(schedule, duration):
+            for minute in minutes:
+                self.load[minute] += 1
+
+    def cost(self, schedule, duration):
+        """(peak, overlap) if a run of schedule were added"""
+        peak = overlap = 0
+        for minutes in self._minutes(schedule, duration):
+            for minute in minutes:
+                peak = max(peak, self.load[minute] + 1)
+                overlap += self.load[minute]
+        return peak, overlap
+
+
+@attr.s(auto_attribs=True)
+class Plan:
+    offsets: typing.Dict[str, int]
+    peak_before: int
+    peak_after: int
+
+
+def _window(task):
+    return max((t.window for t in task.triggers), default=0)
+
+
+def _profile(tasks, durations, offsets, start):
+    profile = LoadProfile(start)
+    for task in tasks:
+        profile.add(
+            TaskSchedule.for_task(task, offsets.get(task.name)),
+            durations.get(task.name, DEFAULT_DURATION_MINUTES),
+        )
+    return profile
+
+
+def make_plan(tasks, durations, current_offsets, start=None):
+    """
+    assign an offset to each task with a trigger window
+
+    durations maps task names to expected minutes, current_offsets are the offsets
+    in use now (tasks without one use their default offset)
+    """
+    if not start:
+        start = datetime.datetime.utcnow().replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+    tasks = [t for t in tasks if t.enabled and t.triggers]
+    # an invalid trigger can't be planned
+    for task in list(tasks):
+        try:
+            TaskSchedule.for_task(task).next_after(start)
+        except ValueError:
+            tasks.remove(task)
+
+    before = _profile(tasks, durations, current_offsets, start)
+
+    windowed = [t for t in tasks if _window(t)]
+    profile = _profile([t for t in tasks if not _window(t)], durations, {}, start)
+
+    def duration(task):
+        return durations.get(task.name, DEFAULT_DURATION_MINUTES)
+
+    offsets = {}
+    for task in sorted(windowed, key=lambda t: (-duration(t), t.name)):
+        window = _window(task)
+        current = current_offsets.get(task.name, default_offset(task.name, window))
+        best = min(
+            range(window),
+            key=lambda offset: (
+                profile.cost(TaskSchedule.for_task(task, offset), duration(task)),
+                abs(offset - current),
+            ),
+        )
+        offsets[task.name] = best
+        profile.add(TaskSchedule.for_task(task, best), duration(task))
+
+    return Plan(offsets, before.peak, profile.peak)
@@ -0,0 +1,132 @@
+import os
+import gzip
+import glob
+import json
+import datetime
+import attr
+from .base import Run, Status
+
+"""
+Run retention.
+
+Finished runs that fall outside every configured rule (the latest N runs of their task,
+or runs from the last X days) are written to gzipped JSON lines archive files and then
+deleted from storage, a batch at a time.
+"""
+
+
+def _run_to_json(run):
+    values = attr.asdict(run)
+    values["status"] = run.status.name
+    return json.dumps(values)
+
+
+def _json_to_run(line):
+    values = json.loads(line)
+    values["status"] = Status[values["status"]]
+    return Run(**values)
+
+
+class RunArchive:
+    """a directory of gzipped JSON lines files, each holding one batch of runs"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, runs):
+        os.makedirs(self.directory, exist_ok=True)
+        now = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        filename = os.path.join(self.directory, f"runs-{now}.jsonl.gz")
+        # written under another name first so a partial file is never read
+        with gzip.open(filename + ".tmp", "wt") as f:
+            for run in runs:
+                f.write(_run_to_json(run) + "\n")
+        os.replace(filename + ".tmp", filename)
+        return filename
+
+    def iter_runs(self, task_name=None, after=None, before=None):
+        """
+        yield archived runs, optionally for one task and with start in (after, before)
+        """
+        seen = set()
+        for filename in sorted(glob.glob(os.path.join(self.directory, "*.jsonl.gz"))):
+            with gzip.open(filename, "rt") as f:
+                for line in f:
+                    run = _json_to_run(line)
+                    # a batch archived but not deleted is archived again next time
+                    if run.uuid in seen:
+                        continue
+                    seen.add(run.uuid)
+                    if task_name and run.task != task_name:
+                        continue
+                    if after and run.start <= after:
+                        continue
+                    if before and run.start >= before:
+                        continue
+                    yield run
+
+    def get_run(self, run_id):
+        for run in self.iter_runs():
+            if run.uuid == run_id:
+                return run
+
+
+class Retention:
+    """
+    a run is kept if it is one of the BOBSLED_RETAIN_RUNS_PER_TASK latest runs of its
+    task or started in the last BOBSLED_RETAIN_DAYS days, 0 disables a rule
+
+    expired runs are archived to BOBSLED_ARCHIVE_DIR, or just deleted if it isn't set
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(
+        self,
+        storage,
+        *,
+        BOBSLED_RETAIN_RUNS_PER_TASK=0,
+        BOBSLED_RETAIN_DAYS=0,
+        BOBSLED_ARCHIVE_DIR="",
+    ):
+        self.storage = storage
+        self.keep_latest = int(BOBSLED_RETAIN_RUNS_PER_TASK)
+        self.keep_days = float(BOBSLED_RETAIN_DAYS)
+        self.archive = RunArchive(BOBSLED_ARCHIVE_DIR) if BOBSLED_ARCHIVE_DIR else None
+
+    @property
+    def enabled(self):
+        return bool(self.keep_latest or self.keep_days)
+
+    async def run(self, now=None, max_batches=None):
+        """
+        archive and delete expired runs a batch at a time, returns how many
+
+        with max_batches, stops after that many batches (found with a single query) so
+        that a backlog can be worked through a bit at a time over several calls
+        """
+        if not self.enabled:
+            return 0
+        if not now:
+            now = datetime.datetime.utcnow()
+        older_than = None
+        if self.keep_days:
+            older_than = (now - datetime.timedelta(days=self.keep_days)).isoformat()
+        limit = self.BATCH_SIZE * (max_batches or 1)
+        removed = 0
+        while True:
+            expired = await self.storage.get_expired_runs(
+                keep_latest=self.keep_latest, older_than=older_than, limit=limit
+            )
+            for start in range(0, len(expired), self.BATCH_SIZE):
+                await self._remove(expired[start : start + self.BATCH_SIZE])
+            removed += len(expired)
+            if max_batches or len(expired) < limit:
+                return removed
+
+    async def _remove(self, batch):
+        if self.archive:
+            for run in batch:
+                run.logs = await self.storage.get_logs(run.uuid)
+            self.archive.write(batch)
+        await self.storage.delete_runs([run.uuid for run in batch])
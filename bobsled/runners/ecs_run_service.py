@@ -1,7 +1,9 @@
 import datetime
 import boto3
 from botocore.exceptions import ClientError
+from ..admission import AdmissionController
 from ..base import RunService, Status
+from ..scheduler import DeadlineQueue
 
 
 class ECSRunService(RunService):
@@ -13,6 +15,7 @@ class ECSRunService(RunService):
         storage,
         environment,
         callbacks=None,
+        admission=None,
         *,
         BOBSLED_ECS_CLUSTER,
         BOBSLED_SUBNET_ID,
@@ -23,6 +26,8 @@ class ECSRunService(RunService):
         self.storage = storage
         self.environment = environment
         self.callbacks = callbacks or []
+        self.admission = admission or AdmissionController()
+        self.timeouts = DeadlineQueue()
         self.cluster_name = BOBSLED_ECS_CLUSTER
         self.subnet_id = BOBSLED_SUBNET_ID
         self.security_group_id = BOBSLED_SECURITY_GROUP_ID
@@ -149,11 +154,13 @@ class ECSRunService(RunService):
         )
         return {"task_arn": resp["tasks"][0]["taskArn"]}
 
-    async def update_status(self, run_id, update_logs=False):
-        run = await self.storage.get_run(run_id)
+    async def update_status(self, run, update_logs=False):
+        run = await self._load_run(run)
 
-        if run.status.is_terminal():
+        if run.status.is_terminal() or run.status == Status.Queued:
             return run
+        if self._being_started(run):
+            return await self._check_claim(run)
 
         # note: what ECS calls a task, we call a run
         arn = run.run_info["task_arn"]
@@ -165,9 +172,8 @@ class ECSRunService(RunService):
                 run.end = datetime.datetime.utcnow().isoformat()
                 run.status = Status.Missing
                 run.logs = self.get_logs(run)
-                await self.storage.save_run(run)
+                await self._save_and_followup(run)
                 return run
-                # TODO: improve handling, should we call callbacks on missing?
             raise ValueError(f"unexpected status: {resp['failures']}")
 
         result = resp["tasks"][0]
@@ -189,10 +195,8 @@ class ECSRunService(RunService):
             run.run_info["timeout_at"]
             and datetime.datetime.utcnow().isoformat() > run.run_info["timeout_at"]
         ):
-            run.logs = self.get_logs(run)
-            self.stop(run)
-            run.status = Status.TimedOut
-            await self._save_and_followup(run)
+            # check_timeouts normally gets there first, this covers untracked runs
+            await self._time_out(run)
 
         elif result["lastStatus"] == "RUNNING":
             if run.status != Status.Running:
@@ -209,6 +213,13 @@ class ECSRunService(RunService):
 
         return run
 
+    async def _time_out(self, run):
+        run.logs = self.get_logs(run)
+        self.stop(run)
+        run.status = Status.TimedOut
+        run.end = datetime.datetime.utcnow().isoformat()
+        await self._save_and_followup(run)
+
     def stop(self, run):
         self.ecs.stop_task(cluster=self.cluster_name, task=run.run_info["task_arn"])
 
@@ -1,17 +1,21 @@
 import datetime
 import docker
+from ..admission import AdmissionController
 from ..base import RunService, Status
+from ..scheduler import DeadlineQueue
 
 
 class LocalRunService(RunService):
 
     STARTING_STATUS = Status.Running
 
-    def __init__(self, storage, environment, callbacks=None):
+    def __init__(self, storage, environment, callbacks=None, admission=None):
         self.client = docker.from_env()
         self.storage = storage
         self.environment = environment
         self.callbacks = callbacks or []
+        self.admission = admission or AdmissionController()
+        self.timeouts = DeadlineQueue()
 
     def _get_container(self, run):
         if run.status == Status.Running:
@@ -51,16 +55,28 @@ class LocalRunService(RunService):
             return
         container.remove(force=True)
 
-    async def update_status(self, run_id, update_logs=False):
-        run = await self.storage.get_run(run_id)
+    async def _time_out(self, run):
+        container = self._get_container(run)
+        if container:
+            run.logs = self.environment.mask_variables(container.logs().decode())
+            container.remove(force=True)
+        run.status = Status.TimedOut
+        run.end = datetime.datetime.utcnow().isoformat()
+        await self._save_and_followup(run)
+
+    async def update_status(self, run, update_logs=False):
+        run = await self._load_run(run)
 
-        if run.status.is_terminal():
+        if run.status.is_terminal() or run.status == Status.Queued:
             return run
+        if self._being_started(run):
+            return await self._check_claim(run)
 
         container = self._get_container(run)
         if not container:
             run.status = Status.Missing
-            await self.storage.save_run(run)
+            run.end = datetime.datetime.utcnow().isoformat()
+            await self._save_and_followup(run)
 
         elif container.status == "exited":
             resp = container.wait()
@@ -76,14 +92,12 @@ class LocalRunService(RunService):
             container.remove()
 
         elif run.status == Status.Running:
+            # check_timeouts normally gets there first, this covers untracked runs
             if (
                 run.run_info["timeout_at"]
                 and datetime.datetime.utcnow().isoformat() > run.run_info["timeout_at"]
             ):
-                run.logs = self.environment.mask_variables(container.logs().decode())
-                container.remove(force=True)
-                run.status = Status.TimedOut
-                await self._save_and_followup(run)
+                await self._time_out(run)
 
             elif update_logs:
                 run.logs = self.environment.mask_variables(container.logs().decode())
@@ -0,0 +1,69 @@
+import heapq
+import itertools
+
+_REMOVED = object()
+
+
+class DeadlineQueue:
+    """
+    min-heap of (deadline, key) pairs
+
+    each key has at most one live deadline, pushing a key again or removing it marks the
+    old heap entry as stale and it is discarded once it reaches the top of the heap
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry:
+            return entry[0]
+
+    def items(self):
+        return [(key, entry[0]) for key, entry in self._entries.items()]
+
+    def push(self, key, deadline):
+        self.remove(key)
+        entry = [deadline, next(self._counter), key]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            entry[2] = _REMOVED
+            # rebuild if stale entries make up most of the heap
+            if len(self._heap) > 2 * len(self._entries) + 64:
+                self._heap = [e for e in self._heap if e[2] is not _REMOVED]
+                heapq.heapify(self._heap)
+
+    def _prune(self):
+        while self._heap and self._heap[0][2] is _REMOVED:
+            heapq.heappop(self._heap)
+
+    def peek(self):
+        """earliest deadline or None if empty"""
+        self._prune()
+        if self._heap:
+            return self._heap[0][0]
+
+    def pop_due(self, now):
+        """remove and return all (key, deadline) pairs with deadline <= now"""
+        due = []
+        while True:
+            self._prune()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            deadline, _, key = heapq.heappop(self._heap)
+            del self._entries[key]
+            due.append((key, deadline))
+        return due
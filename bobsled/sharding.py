@@ -0,0 +1,31 @@
+import bisect
+import hashlib
+
+
+def _hash(key):
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    consistent hash ring, each member gets 'replicas' points on the ring
+
+    a key belongs to the first member point after the key's hash, so when a member
+    joins or leaves only the keys next to its points move
+    """
+
+    def __init__(self, members, replicas=64):
+        self.members = sorted(set(members))
+        self._ring = sorted(
+            (_hash(f"{member}:{n}"), member)
+            for member in self.members
+            for n in range(replicas)
+        )
+        self._hashes = [h for h, _ in self._ring]
+
+    def owner(self, key):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._ring)
+        return self._ring[index][1]
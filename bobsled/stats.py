@@ -0,0 +1,154 @@
+import attr
+import typing
+from .base import Status, parse_time
+
+"""
+Per-task run statistics, updated as each run finishes rather than computed from the
+run history.
+
+Duration percentiles are estimated with the P² algorithm (Jain & Chlamtac, 1985),
+which keeps five markers per percentile no matter how many runs there have been.
+"""
+
+DURATION_PERCENTILES = (0.5, 0.9, 0.99)
+
+
+class P2Quantile:
+    """streaming estimate of the p-quantile of the values added"""
+
+    def __init__(self, p, heights=None, positions=None, desired=None):
+        self.p = p
+        # marker heights, the first five values (sorted) until there are five
+        self.heights = heights or []
+        self.positions = positions or [0, 1, 2, 3, 4]
+        self.desired = desired or [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+
+    @property
+    def count(self):
+        if len(self.heights) < 5:
+            return len(self.heights)
+        return self.positions[4] + 1
+
+    def add(self, x):
+        q, n = self.heights, self.positions
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(4) if q[i] <= x < q[i + 1])
+        for i in range(k + 1, 5):
+            n[i] += 1
+        increments = [0, self.p / 2, self.p, (1 + self.p) / 2, 1]
+        self.desired = [d + inc for d, inc in zip(self.desired, increments)]
+
+        # move the middle markers towards where they should be
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    @property
+    def value(self):
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            return self.heights[round(self.p * (len(self.heights) - 1))]
+        return self.heights[2]
+
+    def to_dict(self):
+        return {
+            "p": self.p,
+            "heights": self.heights,
+            "positions": self.positions,
+            "desired": self.desired,
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+
+def _duration_estimates():
+    return [P2Quantile(p) for p in DURATION_PERCENTILES]
+
+
+@attr.s(auto_attribs=True)
+class TaskStats:
+    task: str
+    runs: int = 0
+    successes: int = 0
+    last_status: Status = None
+    # uuid of the last run recorded, so a run isn't counted twice
+    last_run: str = ""
+    consecutive_failures: int = 0
+    # start of the first run in the current streak of failures
+    failing_since: str = ""
+    durations: typing.List[P2Quantile] = attr.Factory(_duration_estimates)
+
+    @property
+    def success_rate(self):
+        return self.successes / self.runs if self.runs else None
+
+    def duration(self, p):
+        """estimated p-quantile of successful runs' durations in seconds"""
+        for estimate in self.durations:
+            if estimate.p == p:
+                return estimate.value
+        raise ValueError(f"no estimate for {p}, have {DURATION_PERCENTILES}")
+
+    def record(self, run):
+        """add a finished run, returns False if it was already recorded"""
+        if run.uuid == self.last_run or not run.status.is_terminal():
+            return False
+        self.runs += 1
+        self.last_status = run.status
+        self.last_run = run.uuid
+        if run.status == Status.Error:
+            if not self.consecutive_failures:
+                self.failing_since = run.start
+            self.consecutive_failures += 1
+        else:
+            self.consecutive_failures = 0
+            self.failing_since = ""
+        if run.status == Status.Success:
+            self.successes += 1
+            seconds = run.duration_seconds
+            if seconds is None and run.end:
+                seconds = (parse_time(run.end) - parse_time(run.start)).total_seconds()
+            if seconds is not None:
+                for estimate in self.durations:
+                    estimate.add(seconds)
+        return True
+
+    def to_dict(self):
+        """summary for the API"""
+        return {
+            "runs": self.runs,
+            "success_rate": self.success_rate,
+            "last_status": self.last_status.name if self.last_status else None,
+            "consecutive_failures": self.consecutive_failures,
+            "failing_since": self.failing_since,
+            "duration_percentiles": {
+                str(estimate.p): estimate.value for estimate in self.durations
+            },
+        }
@@ -1,2 +1,5 @@
 from .database import DatabaseStorage  # noqa
 from .memory import InMemoryStorage  # noqa
+from .sqlite import SQLiteStorage  # noqa
+from .task_cache import TaskCacheStorage  # noqa
+from .write_behind import WriteBehindStorage  # noqa
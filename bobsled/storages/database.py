@@ -1,9 +1,31 @@
 import json
+import datetime
 import attr
 import sqlalchemy
+from sqlalchemy.dialects import postgresql
 from databases import Database
-from ..base import Run, Status, Task, Trigger, User
+from ..base import (
+    ACTIVE_STATUSES,
+    ActiveRuns,
+    Run,
+    ScheduleState,
+    Status,
+    Task,
+    Trigger,
+    User,
+    parse_time,
+)
+from ..logs import compress_logs, iter_decompressed
+from ..stats import P2Quantile, TaskStats
 from ..utils import hash_password, verify_password
+from .migrations import migrate
+
+
+def StringArray(length):
+    # postgres has native arrays, store them as JSON elsewhere (e.g. sqlite)
+    return sqlalchemy.ARRAY(sqlalchemy.String(length=length)).with_variant(
+        sqlalchemy.JSON(), "sqlite"
+    )
 
 
 metadata = sqlalchemy.MetaData()
@@ -13,15 +35,17 @@ Tasks = sqlalchemy.Table(
     sqlalchemy.Column("name", sqlalchemy.String(length=100), primary_key=True),
     sqlalchemy.Column("image", sqlalchemy.String(length=100)),
     sqlalchemy.Column("tags", sqlalchemy.JSON()),
-    sqlalchemy.Column("entrypoint", sqlalchemy.ARRAY(sqlalchemy.String(length=1000))),
+    sqlalchemy.Column("entrypoint", StringArray(1000)),
     sqlalchemy.Column("environment", sqlalchemy.String(length=100)),
     sqlalchemy.Column("memory", sqlalchemy.Integer),
     sqlalchemy.Column("cpu", sqlalchemy.Integer),
     sqlalchemy.Column("enabled", sqlalchemy.Boolean),
     sqlalchemy.Column("timeout_minutes", sqlalchemy.Integer),
     sqlalchemy.Column("error_threshold", sqlalchemy.Integer),
+    sqlalchemy.Column("priority", sqlalchemy.Integer, default=0),
     sqlalchemy.Column("triggers", sqlalchemy.JSON()),
-    sqlalchemy.Column("next_tasks", sqlalchemy.ARRAY(sqlalchemy.String(length=100))),
+    sqlalchemy.Column("next_tasks", StringArray(100)),
+    sqlalchemy.Column("content_hash", sqlalchemy.String(length=40)),
 )
 Runs = sqlalchemy.Table(
     "bobsled_run",
@@ -31,21 +55,80 @@ Runs = sqlalchemy.Table(
     sqlalchemy.Column(
         "task", sqlalchemy.String(length=100), sqlalchemy.ForeignKey(Tasks.c.name)
     ),
-    sqlalchemy.Column("start", sqlalchemy.String(length=50)),
-    sqlalchemy.Column("end", sqlalchemy.String(length=50)),
+    sqlalchemy.Column("start", sqlalchemy.DateTime),
+    sqlalchemy.Column("end", sqlalchemy.DateTime),
+    # set when the run finishes
+    sqlalchemy.Column("duration_seconds", sqlalchemy.Float),
     sqlalchemy.Column("logs", sqlalchemy.String()),
+    # logs of finished runs, see bobsled.logs
+    sqlalchemy.Column("logs_zlib", sqlalchemy.LargeBinary()),
     sqlalchemy.Column("exit_code", sqlalchemy.Integer),
     sqlalchemy.Column("run_info_json", sqlalchemy.JSON()),
 )
+ScheduleStates = sqlalchemy.Table(
+    "bobsled_schedule",
+    metadata,
+    sqlalchemy.Column("task", sqlalchemy.String(length=100), primary_key=True),
+    sqlalchemy.Column("last_run", sqlalchemy.DateTime),
+    sqlalchemy.Column("next_run", sqlalchemy.DateTime),
+)
+ScheduleOffsets = sqlalchemy.Table(
+    "bobsled_schedule_offset",
+    metadata,
+    sqlalchemy.Column("task", sqlalchemy.String(length=100), primary_key=True),
+    sqlalchemy.Column("offset_minutes", sqlalchemy.Integer),
+)
+# logs are stored as chunks appended as output arrives, position is the character
+# offset of the chunk within the run's logs
+RunLogs = sqlalchemy.Table(
+    "bobsled_run_log",
+    metadata,
+    sqlalchemy.Column("run", sqlalchemy.String(length=50), primary_key=True),
+    sqlalchemy.Column("position", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("text", sqlalchemy.String()),
+)
+Leases = sqlalchemy.Table(
+    "bobsled_lease",
+    metadata,
+    sqlalchemy.Column("name", sqlalchemy.String(length=200), primary_key=True),
+    sqlalchemy.Column("holder", sqlalchemy.String(length=200)),
+    sqlalchemy.Column("expires_at", sqlalchemy.DateTime),
+)
+# see bobsled.stats, updated as each run finishes
+TaskStatsTable = sqlalchemy.Table(
+    "bobsled_task_stats",
+    metadata,
+    sqlalchemy.Column("task", sqlalchemy.String(length=100), primary_key=True),
+    sqlalchemy.Column("runs", sqlalchemy.Integer),
+    sqlalchemy.Column("successes", sqlalchemy.Integer),
+    sqlalchemy.Column("last_status", sqlalchemy.String(length=50)),
+    sqlalchemy.Column("last_run", sqlalchemy.String(length=50)),
+    sqlalchemy.Column("consecutive_failures", sqlalchemy.Integer),
+    sqlalchemy.Column("failing_since", sqlalchemy.DateTime),
+    sqlalchemy.Column("durations", sqlalchemy.JSON()),
+)
+# a single row, bumped whenever set_tasks changes the tasks
+TaskVersion = sqlalchemy.Table(
+    "bobsled_task_version",
+    metadata,
+    sqlalchemy.Column("version", sqlalchemy.Integer),
+)
 Users = sqlalchemy.Table(
     "bobsled_user",
     metadata,
     sqlalchemy.Column("username", sqlalchemy.String(length=100)),
     sqlalchemy.Column("password", sqlalchemy.String(length=100)),
-    sqlalchemy.Column("permissions", sqlalchemy.ARRAY(sqlalchemy.String(length=100))),
+    sqlalchemy.Column("permissions", StringArray(100)),
 )
 
 
+def _to_datetime(value):
+    # runs keep times as ISO strings
+    if isinstance(value, str):
+        return parse_time(value)
+    return value
+
+
 def _db_to_run(r):
     logs = ""
     if "logs" in r:
@@ -53,29 +136,64 @@ def _db_to_run(r):
     return Run(
         task=r["task"],
         status=Status[r["status"]],
-        start=r["start"],
-        end=r["end"],
+        start=r["start"].isoformat() if r["start"] else "",
+        end=r["end"].isoformat() if r["end"] else "",
         logs=logs,
         exit_code=r["exit_code"],
         run_info=json.loads(r["run_info_json"]),
         uuid=r["uuid"],
+        duration_seconds=r["duration_seconds"],
     )
 
 
 def _run_to_db(r):
     values = attr.asdict(r)
+    # written to RunLogs, the logs column only has logs from before chunking
+    values.pop("logs")
     values["status"] = values["status"].name
+    values["start"] = _to_datetime(values["start"])
+    values["end"] = _to_datetime(values["end"])
     values["run_info_json"] = json.dumps(values.pop("run_info"))
     return values
 
 
+def _stats_to_db(stats):
+    return {
+        "task": stats.task,
+        "runs": stats.runs,
+        "successes": stats.successes,
+        "last_status": stats.last_status.name if stats.last_status else None,
+        "last_run": stats.last_run,
+        "consecutive_failures": stats.consecutive_failures,
+        "failing_since": _to_datetime(stats.failing_since),
+        "durations": [estimate.to_dict() for estimate in stats.durations],
+    }
+
+
+def _db_to_stats(row):
+    return TaskStats(
+        task=row["task"],
+        runs=row["runs"],
+        successes=row["successes"],
+        last_status=Status[row["last_status"]] if row["last_status"] else None,
+        last_run=row["last_run"],
+        consecutive_failures=row["consecutive_failures"],
+        failing_since=row["failing_since"].isoformat() if row["failing_since"] else "",
+        durations=[P2Quantile.from_dict(values) for values in row["durations"]],
+    )
+
+
 def _task_to_db(t):
     values = attr.asdict(t)
+    values["content_hash"] = t.content_hash()
     return values
 
 
 def _db_to_task(row):
     vals = dict(**row)
+    vals.pop("content_hash", None)
+    if vals.get("priority") is None:
+        vals["priority"] = 0
     vals["triggers"] = [Trigger(**t) for t in row["triggers"]]
     return Task(**vals)
 
@@ -87,25 +205,203 @@ class DatabaseStorage:
     async def connect(self):
         await self.database.connect()
         engine = sqlalchemy.create_engine(str(self.database.url))
-        metadata.create_all(engine)
+        migrate(engine, metadata)
 
     async def add_run(self, run):
+        run.set_duration()
         query = Runs.insert()
         await self.database.execute(query=query, values=_run_to_db(run))
+        await self._store_logs(run)
 
     async def save_run(self, run):
+        run.set_duration()
         values = _run_to_db(run)
         uuid = values.pop("uuid")
         query = Runs.update().where(Runs.c.uuid == uuid).values(**values)
         await self.database.execute(query=query)
+        await self._store_logs(run)
+
+    async def save_runs(self, runs):
+        """save several runs in one transaction"""
+        async with self.database.transaction():
+            for run in runs:
+                await self.save_run(run)
+
+    async def claim_run(self, run_id, from_status, to_status, run_info=None):
+        """
+        move a run from one status to another if it still has from_status, returns
+        False if it doesn't, e.g. because another process claimed it first
 
-    async def get_run(self, run_id):
-        query = Runs.select().where(Runs.c.uuid == run_id)
+        run_info, if given, is saved along with the new status
+        """
+        values = {"status": to_status.name}
+        if run_info is not None:
+            values["run_info_json"] = json.dumps(run_info)
+        query = (
+            Runs.update()
+            .where(Runs.c.uuid == run_id)
+            .where(Runs.c.status == from_status.name)
+            .values(**values)
+        )
+        if self.database.url.dialect == "postgresql":
+            row = await self.database.fetch_one(query=query.returning(Runs.c.uuid))
+            return row is not None
+        async with self.database.transaction():
+            # the count is per connection, which the transaction holds on to
+            await self.database.execute(query=query)
+            return await self.database.fetch_val("SELECT changes()") == 1
+
+    async def _store_logs(self, run):
+        if run.status.is_terminal():
+            await self._compress_logs(run)
+        else:
+            await self.append_logs(run.uuid, run.complete_logs())
+
+    async def _compress_logs(self, run):
+        """replace a finished run's chunks with its compressed logs"""
+        async with self.database.transaction():
+            query = sqlalchemy.select([Runs.c.logs_zlib.isnot(None)]).where(
+                Runs.c.uuid == run.uuid
+            )
+            if await self.database.fetch_val(query=query):
+                return
+            await self.append_logs(run.uuid, run.logs)
+            logs = await self.get_logs(run.uuid)
+            query = (
+                Runs.update()
+                .where(Runs.c.uuid == run.uuid)
+                .values(logs_zlib=compress_logs(logs))
+            )
+            await self.database.execute(query=query)
+            query = RunLogs.delete().where(RunLogs.c.run == run.uuid)
+            await self.database.execute(query=query)
+
+    def _insert_ignoring_conflicts(self, table):
+        dialect = self.database.url.dialect
+        if dialect == "postgresql":
+            return postgresql.insert(table).on_conflict_do_nothing()
+        elif dialect == "sqlite":
+            return table.insert().prefix_with("OR IGNORE")
+        return table.insert()
+
+    async def append_logs(self, run_id, logs):
+        """
+        store the part of 'logs', the run's output so far, that isn't stored yet
+
+        returns the length of the stored logs
+        """
+        query = sqlalchemy.select(
+            [
+                sqlalchemy.func.max(
+                    RunLogs.c.position + sqlalchemy.func.length(RunLogs.c.text)
+                )
+            ]
+        ).where(RunLogs.c.run == run_id)
+        stored = await self.database.fetch_val(query=query) or 0
+        if len(logs) > stored:
+            # if another process stored a chunk at this position first, keep theirs
+            await self.database.execute(
+                query=self._insert_ignoring_conflicts(RunLogs),
+                values={"run": run_id, "position": stored, "text": logs[stored:]},
+            )
+            stored = len(logs)
+        return stored
+
+    async def get_logs(self, run_id, offset=0):
+        """a run's logs starting at character 'offset'"""
+        return "".join([text async for text in self.iter_logs(run_id, offset)])
+
+    async def iter_logs(self, run_id, offset=0):
+        """yield a run's logs in pieces, starting at character 'offset'"""
+        query = (
+            sqlalchemy.select([RunLogs.c.position, RunLogs.c.text])
+            .where(RunLogs.c.run == run_id)
+            .where(RunLogs.c.position + sqlalchemy.func.length(RunLogs.c.text) > offset)
+            .order_by(RunLogs.c.position)
+        )
+        chunks = await self.database.fetch_all(query=query)
+        for chunk in chunks:
+            yield chunk["text"][max(offset - chunk["position"], 0) :]
+        if chunks:
+            return
+
+        query = sqlalchemy.select([Runs.c.logs_zlib, Runs.c.logs]).where(
+            Runs.c.uuid == run_id
+        )
+        row = await self.database.fetch_one(query=query)
+        if row and row["logs_zlib"]:
+            for text in iter_decompressed(row["logs_zlib"], offset):
+                yield text
+        elif row and row["logs"]:
+            # runs stored before logs were chunked
+            yield row["logs"][offset:]
+
+    async def get_run(self, run_id, logs=True):
+        query = self._runs_query().where(Runs.c.uuid == run_id)
         row = await self.database.fetch_one(query=query)
         if row:
-            return _db_to_run(row)
+            run = _db_to_run(row)
+            if logs:
+                run.logs = await self.get_logs(run_id)
+            return run
+
+    async def get_runs(
+        self, *, status=None, task_name=None, latest=None, before=None, after=None
+    ):
+        """
+        runs from old to new, the latest N of them (or if 'after' is given, the first N
+        after it)
+
+        before and after are (start, uuid) cursors, and only runs strictly before or
+        after them are returned
+        """
+        query = self._runs_query(
+            status=status,
+            task_name=task_name,
+            latest=latest,
+            before=before,
+            after=after,
+        )
+        rows = await self.database.fetch_all(query=query)
+
+        if after:
+            return [_db_to_run(r) for r in rows]
+        return [_db_to_run(r) for r in reversed(rows)]
 
-    async def get_runs(self, *, status=None, task_name=None, latest=None):
+    async def get_latest_runs(self, latest, task_names=None):
+        """
+        the latest runs of every task (or of the tasks in task_names), old to new,
+        as a dict keyed by task name, using a single query
+        """
+        position = (
+            sqlalchemy.func.row_number()
+            .over(
+                partition_by=Runs.c.task,
+                order_by=[Runs.c.start.desc(), Runs.c.uuid.desc()],
+            )
+            .label("position")
+        )
+        ranked = self._runs_query().order_by(None).column(position)
+        if task_names is not None:
+            ranked = ranked.where(Runs.c.task.in_(task_names))
+        ranked = ranked.alias("ranked")
+        query = (
+            sqlalchemy.select([ranked])
+            .where(ranked.c.position <= latest)
+            .order_by(ranked.c.task, ranked.c.start, ranked.c.uuid)
+        )
+        latest_runs = {}
+        for row in await self.database.fetch_all(query=query):
+            latest_runs.setdefault(row["task"], []).append(_db_to_run(row))
+        return latest_runs
+
+    def _cursor(self, cursor):
+        start, uuid = cursor
+        return sqlalchemy.tuple_(_to_datetime(start), uuid)
+
+    def _runs_query(
+        self, *, status=None, task_name=None, latest=None, before=None, after=None
+    ):
         query = sqlalchemy.select(
             [
                 Runs.c.uuid,
@@ -113,11 +409,20 @@ class DatabaseStorage:
                 Runs.c.status,
                 Runs.c.start,
                 Runs.c.end,
+                Runs.c.duration_seconds,
                 Runs.c.exit_code,
                 Runs.c.run_info_json,
             ]
         )
-        query = query.order_by(Runs.c.start.desc())
+        # compared as a row value, which can use an index on start
+        key = sqlalchemy.tuple_(Runs.c.start, Runs.c.uuid)
+        if after:
+            query = query.order_by(Runs.c.start, Runs.c.uuid)
+            query = query.where(key > self._cursor(after))
+        else:
+            query = query.order_by(Runs.c.start.desc(), Runs.c.uuid.desc())
+        if before:
+            query = query.where(key < self._cursor(before))
         if isinstance(status, Status):
             query = query.where(Runs.c.status == status.name)
         elif isinstance(status, list):
@@ -128,9 +433,81 @@ class DatabaseStorage:
             query = query.where(Runs.c.task == task_name)
         if latest:
             query = query.limit(latest)
+        return query
+
+    async def get_active_runs(self):
+        """all unfinished runs in a single query, logs aren't included"""
+        query = self._runs_query(status=ACTIVE_STATUSES)
         rows = await self.database.fetch_all(query=query)
+        return ActiveRuns([_db_to_run(r) for r in reversed(rows)])
 
-        return [_db_to_run(r) for r in reversed(rows)]
+    async def get_expired_runs(self, *, keep_latest=0, older_than=None, limit=None):
+        """
+        the oldest finished runs that are neither one of the keep_latest latest runs of
+        their task nor started after older_than (a rule that is unset keeps nothing)
+        """
+        position = (
+            sqlalchemy.func.row_number()
+            .over(
+                partition_by=Runs.c.task,
+                order_by=[Runs.c.start.desc(), Runs.c.uuid.desc()],
+            )
+            .label("position")
+        )
+        ranked = self._runs_query().order_by(None).column(position).alias("ranked")
+        query = (
+            sqlalchemy.select([ranked])
+            .where(ranked.c.status.notin_(s.name for s in ACTIVE_STATUSES))
+            .order_by(ranked.c.start, ranked.c.uuid)
+        )
+        if keep_latest:
+            query = query.where(ranked.c.position > keep_latest)
+        if older_than:
+            query = query.where(ranked.c.start < _to_datetime(older_than))
+        if limit:
+            query = query.limit(limit)
+        rows = await self.database.fetch_all(query=query)
+        return [_db_to_run(r) for r in rows]
+
+    async def get_duration_stats(self, *, task_names=None, status=None, since=None):
+        """
+        number of runs and mean & max duration_seconds of each task's finished runs
+        (only those with status, and started after since, if given)
+        """
+        duration = Runs.c.duration_seconds
+        query = (
+            sqlalchemy.select(
+                [
+                    Runs.c.task,
+                    sqlalchemy.func.count().label("runs"),
+                    sqlalchemy.func.avg(duration).label("mean_seconds"),
+                    sqlalchemy.func.max(duration).label("max_seconds"),
+                ]
+            )
+            .where(duration.isnot(None))
+            .group_by(Runs.c.task)
+        )
+        if task_names is not None:
+            query = query.where(Runs.c.task.in_(task_names))
+        if status:
+            query = query.where(Runs.c.status == status.name)
+        if since:
+            query = query.where(Runs.c.start > _to_datetime(since))
+        return {
+            row["task"]: {
+                "runs": row["runs"],
+                "mean_seconds": float(row["mean_seconds"]),
+                "max_seconds": row["max_seconds"],
+            }
+            for row in await self.database.fetch_all(query=query)
+        }
+
+    async def delete_runs(self, run_ids):
+        async with self.database.transaction():
+            await self.database.execute(
+                RunLogs.delete().where(RunLogs.c.run.in_(run_ids))
+            )
+            await self.database.execute(Runs.delete().where(Runs.c.uuid.in_(run_ids)))
 
     async def get_tasks(self):
         query = Tasks.select().order_by(Tasks.c.name.asc())
@@ -144,36 +521,200 @@ class DatabaseStorage:
             return _db_to_task(row)
 
     async def set_tasks(self, tasks):
-        seen = set()
-        for task in tasks:
-            seen.add(task.name)
-            dbtask = _task_to_db(task)
-
-            query = Tasks.select().where(Tasks.c.name == task.name)
-            res = await self.database.fetch_all(query=query)
-            if res:
-                query = Tasks.update().where(Tasks.c.name == task.name).values(**dbtask)
-                res = await self.database.execute(query=query)
+        """
+        replace the stored tasks with 'tasks' in one transaction
+
+        only tasks whose content hash differs from the stored one are written
+        """
+        async with self.database.transaction():
+            query = sqlalchemy.select([Tasks.c.name, Tasks.c.content_hash])
+            stored = {
+                row["name"]: row["content_hash"]
+                for row in await self.database.fetch_all(query=query)
+            }
+            changed = [
+                _task_to_db(task)
+                for task in tasks
+                if stored.get(task.name) != task.content_hash()
+            ]
+            if changed:
+                await self._upsert(Tasks, changed)
+
+            # delete the other tasks
+            removed = set(stored) - {task.name for task in tasks}
+            if removed:
+                query = Tasks.delete().where(Tasks.c.name.in_(removed))
+                await self.database.execute(query)
+
+            if changed or removed:
+                query = TaskVersion.update().values(version=TaskVersion.c.version + 1)
+                await self.database.execute(query)
+
+    async def update_task_stats(self, run):
+        """
+        add a finished run to its task's stats, returns the stats
+
+        the row is locked while it's updated so concurrent updates aren't lost
+        """
+        async with self.database.transaction():
+            # make sure there's a row to lock
+            await self.database.execute(
+                self._insert_ignoring_conflicts(TaskStatsTable).values(
+                    _stats_to_db(TaskStats(run.task))
+                )
+            )
+            query = TaskStatsTable.select().where(TaskStatsTable.c.task == run.task)
+            if self.database.url.dialect == "postgresql":
+                query = query.with_for_update()
+            stats = _db_to_stats(await self.database.fetch_one(query=query))
+            if stats.record(run):
+                values = _stats_to_db(stats)
+                query = (
+                    TaskStatsTable.update()
+                    .where(TaskStatsTable.c.task == values.pop("task"))
+                    .values(**values)
+                )
+                await self.database.execute(query=query)
+            return stats
+
+    async def get_task_stats(self, task_names=None):
+        """dict of task name => TaskStats, for tasks that have finished a run"""
+        query = TaskStatsTable.select().where(TaskStatsTable.c.runs > 0)
+        if task_names is not None:
+            query = query.where(TaskStatsTable.c.task.in_(task_names))
+        rows = await self.database.fetch_all(query=query)
+        return {row["task"]: _db_to_stats(row) for row in rows}
+
+    async def get_task_version(self):
+        """changes whenever the tasks do, so a cache of them can be checked cheaply"""
+        query = sqlalchemy.select([TaskVersion.c.version])
+        return await self.database.fetch_val(query=query)
+
+    async def _upsert(self, table, rows):
+        """insert rows, replacing any with the same primary key"""
+        dialect = self.database.url.dialect
+        keys = [column.name for column in table.primary_key.columns]
+        if dialect not in ("postgresql", "sqlite"):
+            # no portable upsert, replace the rows instead
+            (key,) = keys
+            query = table.delete().where(table.c[key].in_(r[key] for r in rows))
+            await self.database.execute(query)
+            await self.database.execute_many(query=table.insert(), values=rows)
+            return
+
+        # multi-row inserts, kept under SQLite's limit of 999 parameters
+        batch_size = 999 // len(table.columns)
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start : start + batch_size]
+            if dialect == "postgresql":
+                query = postgresql.insert(table).values(batch)
+                query = query.on_conflict_do_update(
+                    index_elements=keys,
+                    set_={
+                        column.name: query.excluded[column.name]
+                        for column in table.columns
+                        if column.name not in keys
+                    },
+                )
             else:
-                query = Tasks.insert()
-                await self.database.execute(query=query, values=dbtask)
+                # the bundled SQLAlchemy can't express ON CONFLICT for SQLite
+                query = table.insert().prefix_with("OR REPLACE").values(batch)
+            await self.database.execute(query)
 
-        # delete the other tasks
-        query = Tasks.delete().where(~Tasks.c.name.in_(seen))
+    async def get_schedule_states(self):
+        rows = await self.database.fetch_all(query=ScheduleStates.select())
+        return {r["task"]: ScheduleState(**r) for r in rows}
+
+    async def set_schedule_states(self, states):
+        rows = [attr.asdict(state) for state in states]
+        if rows:
+            async with self.database.transaction():
+                await self._upsert(ScheduleStates, rows)
+
+    async def delete_schedule_states(self, task_names):
+        query = ScheduleStates.delete().where(ScheduleStates.c.task.in_(task_names))
         await self.database.execute(query)
 
-    async def set_user(self, username, password, permissions):
-        phash = hash_password(password)
+    async def get_schedule_offsets(self):
+        rows = await self.database.fetch_all(query=ScheduleOffsets.select())
+        return {r["task"]: r["offset_minutes"] for r in rows}
+
+    async def set_schedule_offsets(self, offsets):
+        async with self.database.transaction():
+            await self.database.execute(
+                ScheduleOffsets.delete().where(ScheduleOffsets.c.task.in_(offsets))
+            )
+            await self.database.execute_many(
+                query=ScheduleOffsets.insert(),
+                values=[
+                    {"task": task, "offset_minutes": offset}
+                    for task, offset in offsets.items()
+                ],
+            )
+
+    async def acquire_lease(self, name, holder, seconds):
+        """
+        take or renew the lease 'name' if it is free, expired or already ours
+
+        returns True if holder has the lease
+        """
+        now = datetime.datetime.utcnow()
+        expires_at = now + datetime.timedelta(seconds=seconds)
         query = (
-            Users.update()
-            .where(Users.c.username == username)
-            .values(password=phash, permissions=permissions or [])
+            Leases.update()
+            .where(Leases.c.name == name)
+            .where(sqlalchemy.or_(Leases.c.holder == holder, Leases.c.expires_at < now))
+            .values(holder=holder, expires_at=expires_at)
         )
-        res = await self.database.execute(query=query)
-        if not res:
-            query = Users.insert().values(
-                username=username, password=phash, permissions=permissions or []
+        await self.database.execute(query=query)
+        query = sqlalchemy.select([Leases.c.holder]).where(Leases.c.name == name)
+        row = await self.database.fetch_one(query=query)
+        if not row:
+            try:
+                await self.database.execute(
+                    query=Leases.insert(),
+                    values={"name": name, "holder": holder, "expires_at": expires_at},
+                )
+            except Exception:
+                # someone else inserted it first
+                return False
+            return True
+        return row["holder"] == holder
+
+    async def release_lease(self, name, holder):
+        query = (
+            Leases.delete()
+            .where(Leases.c.name == name)
+            .where(Leases.c.holder == holder)
+        )
+        await self.database.execute(query=query)
+
+    async def get_leases(self, prefix=""):
+        """holders of unexpired leases with names starting with prefix"""
+        query = (
+            Leases.select()
+            .where(Leases.c.name.startswith(prefix))
+            .where(Leases.c.expires_at >= datetime.datetime.utcnow())
+        )
+        rows = await self.database.fetch_all(query=query)
+        return {r["name"]: r["holder"] for r in rows}
+
+    async def set_user(self, username, password, permissions):
+        phash = hash_password(password)
+        async with self.database.transaction():
+            query = sqlalchemy.select([Users.c.username]).where(
+                Users.c.username == username
             )
+            if await self.database.fetch_val(query=query):
+                query = (
+                    Users.update()
+                    .where(Users.c.username == username)
+                    .values(password=phash, permissions=permissions or [])
+                )
+            else:
+                query = Users.insert().values(
+                    username=username, password=phash, permissions=permissions or []
+                )
             await self.database.execute(query=query)
 
     async def check_password(self, username, password):
@@ -1,43 +1,284 @@
-from ..base import Status, User
+import attr
+import bisect
+import collections
+import datetime
+from ..base import ACTIVE_STATUSES, ActiveRuns, Status, User
+from ..logs import compress_logs, iter_decompressed
+from ..stats import TaskStats
 from ..utils import hash_password, verify_password
 
 
+def _run_key(run):
+    return (run.start, run.uuid)
+
+
 class InMemoryStorage:
+    """
+    runs are indexed by uuid, by status, and for each task the latest
+    TASK_INDEX_SIZE runs are kept in start order
+
+    unfinished runs are kept as given and updated in place, finished runs are kept
+    as a copy without their logs, which are only kept compressed
+    """
+
+    TASK_INDEX_SIZE = 100
+
     def __init__(self):
         self.runs = []
         self.tasks = {}
+        self.task_version = 0
+        self.task_stats = {}
         self.users = {}
+        self.schedule_states = {}
+        self.schedule_offsets = {}
+        self.leases = {}
+        # run id => list of (position, text) chunks, until the run finishes
+        self.log_chunks = {}
+        # run id => compressed logs of finished runs
+        self.compressed_logs = {}
+
+    @property
+    def runs(self):
+        return list(self._runs.values())
+
+    @runs.setter
+    def runs(self, runs):
+        # uuid => run, in the order they were added
+        self._runs = {}
+        # status => {uuid: run}
+        self._status_runs = {status: {} for status in Status}
+        # task name => deque of (key, run) ordered by key, and total runs of the task
+        self._task_runs = {}
+        self._task_counts = collections.Counter()
+        # the status and key each run is indexed under
+        self._indexed = {}
+        for run in runs:
+            self._add_to_index(run)
+
+    def _add_to_index(self, run):
+        self._runs[run.uuid] = run
+        self._task_counts[run.task] += 1
+        self._index(run)
+
+    def _index(self, run):
+        self._status_runs[run.status][run.uuid] = run
+        task_runs = self._task_runs.setdefault(
+            run.task, collections.deque(maxlen=self.TASK_INDEX_SIZE)
+        )
+        item = (_run_key(run), run.uuid)
+        if len(task_runs) == task_runs.maxlen:
+            if item < task_runs[0]:
+                # older than anything kept
+                item = None
+            else:
+                task_runs.popleft()
+        if item:
+            task_runs.insert(bisect.bisect(task_runs, item), item)
+        self._indexed[run.uuid] = (run.status, _run_key(run))
+
+    def _reindex(self, run):
+        status, key = self._indexed[run.uuid]
+        if (status, key) == (run.status, _run_key(run)):
+            self._status_runs[status][run.uuid] = run
+            return
+        del self._status_runs[status][run.uuid]
+        task_runs = self._task_runs[run.task]
+        try:
+            task_runs.remove((key, run.uuid))
+        except ValueError:
+            # had already dropped out of the task index
+            pass
+        self._index(run)
+
+    def _task_index_complete(self, task_name):
+        return self._task_counts[task_name] <= self.TASK_INDEX_SIZE
 
     async def connect(self):
         pass
 
+    def _stored(self, run):
+        if run.status.is_terminal():
+            return attr.evolve(run, logs="")
+        return run
+
     async def add_run(self, run):
-        self.runs.append(run)
+        run.set_duration()
+        await self._store_logs(run)
+        self._add_to_index(self._stored(run))
 
     async def save_run(self, run):
-        # run is modified in place
-        pass
+        # unfinished runs are modified in place, only the indexes and logs need updating
+        run.set_duration()
+        await self._store_logs(run)
+        run = self._stored(run)
+        self._runs[run.uuid] = run
+        self._reindex(run)
+
+    async def save_runs(self, runs):
+        for run in runs:
+            await self.save_run(run)
+
+    async def claim_run(self, run_id, from_status, to_status, run_info=None):
+        run = self._runs.get(run_id)
+        if not run or run.status != from_status:
+            return False
+        run.status = to_status
+        if run_info is not None:
+            run.run_info = run_info
+        self._reindex(run)
+        return True
+
+    async def _store_logs(self, run):
+        if run.uuid in self.compressed_logs:
+            return
+        if run.status.is_terminal():
+            await self.append_logs(run.uuid, run.logs)
+            logs = await self.get_logs(run.uuid)
+            self.compressed_logs[run.uuid] = compress_logs(logs) if logs else b""
+            self.log_chunks.pop(run.uuid, None)
+        else:
+            await self.append_logs(run.uuid, run.complete_logs())
+
+    async def append_logs(self, run_id, logs):
+        chunks = self.log_chunks.setdefault(run_id, [])
+        stored = chunks[-1][0] + len(chunks[-1][1]) if chunks else 0
+        if len(logs) > stored:
+            chunks.append((stored, logs[stored:]))
+            stored = len(logs)
+        return stored
+
+    async def get_logs(self, run_id, offset=0):
+        return "".join([text async for text in self.iter_logs(run_id, offset)])
+
+    async def iter_logs(self, run_id, offset=0):
+        if self.compressed_logs.get(run_id):
+            for text in iter_decompressed(self.compressed_logs[run_id], offset):
+                yield text
+        for position, text in self.log_chunks.get(run_id, []):
+            if position + len(text) > offset:
+                yield text[max(offset - position, 0) :]
 
-    async def get_run(self, run_id):
-        run = [r for r in self.runs if r.uuid == run_id]
-        if run:
-            return run[0]
+    async def get_run(self, run_id, logs=True):
+        run = self._runs.get(run_id)
+        if run and logs and run_id in self.compressed_logs:
+            return attr.evolve(run, logs=await self.get_logs(run_id))
+        return run
 
-    async def get_runs(self, *, status=None, task_name=None, latest=None):
-        runs = [r for r in self.runs]
+    def _latest_task_runs(self, task_name, latest):
+        if latest <= self.TASK_INDEX_SIZE or self._task_index_complete(task_name):
+            keys = list(self._task_runs.get(task_name, ()))[-latest:]
+            return [self._runs[uuid] for _, uuid in keys]
+        runs = sorted(
+            (r for r in self._runs.values() if r.task == task_name), key=_run_key
+        )
+        return runs[-latest:]
+
+    async def get_latest_runs(self, latest, task_names=None):
+        if task_names is None:
+            task_names = list(self._task_runs)
+        latest_runs = {
+            name: self._latest_task_runs(name, latest) for name in task_names
+        }
+        return {name: runs for name, runs in latest_runs.items() if runs}
+
+    async def get_runs(
+        self, *, status=None, task_name=None, latest=None, before=None, after=None
+    ):
         if isinstance(status, Status):
-            runs = [r for r in runs if r.status == status]
+            runs = list(self._status_runs[status].values())
         elif isinstance(status, list):
-            runs = [r for r in runs if r.status in status]
+            runs = [r for s in status for r in self._status_runs[s].values()]
         elif status:
             raise ValueError("status must be Status or list")
+        elif task_name and latest and not before and not after:
+            return self._latest_task_runs(task_name, latest)
+        elif task_name and self._task_index_complete(task_name):
+            runs = [self._runs[uuid] for _, uuid in self._task_runs.get(task_name, ())]
+        else:
+            runs = list(self._runs.values())
+
         if task_name:
             runs = [r for r in runs if r.task == task_name]
-        if latest:
-            # runs are in order, so just grab the tail
+        if latest or before or after or isinstance(status, list):
+            # same order as DatabaseStorage, so runs with the same start page the same
+            runs.sort(key=_run_key)
+        if before:
+            runs = [r for r in runs if _run_key(r) < tuple(before)]
+        if after:
+            runs = [r for r in runs if _run_key(r) > tuple(after)]
+        if latest and after:
+            runs = runs[:latest]
+        elif latest:
             runs = runs[-latest:]
         return runs
 
+    async def get_active_runs(self):
+        return ActiveRuns(
+            [r for s in ACTIVE_STATUSES for r in self._status_runs[s].values()]
+        )
+
+    async def get_expired_runs(self, *, keep_latest=0, older_than=None, limit=None):
+        expired = []
+        runs = sorted(self._runs.values(), key=_run_key, reverse=True)
+        positions = collections.Counter()
+        for run in runs:
+            positions[run.task] += 1
+            if run.status in ACTIVE_STATUSES:
+                continue
+            if keep_latest and positions[run.task] <= keep_latest:
+                continue
+            if older_than and run.start >= older_than:
+                continue
+            expired.append(run)
+        expired.reverse()
+        return expired[:limit] if limit else expired
+
+    async def get_duration_stats(self, *, task_names=None, status=None, since=None):
+        durations = collections.defaultdict(list)
+        for run in self._runs.values():
+            if run.duration_seconds is None:
+                continue
+            if task_names is not None and run.task not in task_names:
+                continue
+            if status and run.status != status:
+                continue
+            if since and run.start <= since:
+                continue
+            durations[run.task].append(run.duration_seconds)
+        return {
+            task: {
+                "runs": len(seconds),
+                "mean_seconds": sum(seconds) / len(seconds),
+                "max_seconds": max(seconds),
+            }
+            for task, seconds in durations.items()
+        }
+
+    async def delete_runs(self, run_ids):
+        tasks = set()
+        for run_id in run_ids:
+            run = self._runs.pop(run_id, None)
+            if not run:
+                continue
+            status, key = self._indexed.pop(run_id)
+            del self._status_runs[status][run_id]
+            try:
+                self._task_runs[run.task].remove((key, run_id))
+            except ValueError:
+                pass
+            self._task_counts[run.task] -= 1
+            self.log_chunks.pop(run_id, None)
+            self.compressed_logs.pop(run_id, None)
+            tasks.add(run.task)
+        for task_name in tasks:
+            task_runs = self._task_runs[task_name]
+            if len(task_runs) < min(self._task_counts[task_name], task_runs.maxlen):
+                # deleted runs were among the latest, refill from the older ones
+                task_runs.clear()
+                for run in self._runs.values():
+                    if run.task == task_name:
+                        self._index(run)
+
     async def get_tasks(self):
         return list(self.tasks.values())
 
@@ -45,7 +286,62 @@ class InMemoryStorage:
         return self.tasks[name]
 
     async def set_tasks(self, tasks):
-        self.tasks = {task.name: task for task in tasks}
+        tasks = {task.name: task for task in tasks}
+        if tasks != self.tasks:
+            self.task_version += 1
+        self.tasks = tasks
+
+    async def update_task_stats(self, run):
+        stats = self.task_stats.setdefault(run.task, TaskStats(run.task))
+        stats.record(run)
+        return stats
+
+    async def get_task_stats(self, task_names=None):
+        return {
+            name: stats
+            for name, stats in self.task_stats.items()
+            if stats.runs and (task_names is None or name in task_names)
+        }
+
+    async def get_task_version(self):
+        return self.task_version
+
+    async def get_schedule_states(self):
+        return dict(self.schedule_states)
+
+    async def set_schedule_states(self, states):
+        for state in states:
+            self.schedule_states[state.task] = state
+
+    async def delete_schedule_states(self, task_names):
+        for name in task_names:
+            self.schedule_states.pop(name, None)
+
+    async def get_schedule_offsets(self):
+        return dict(self.schedule_offsets)
+
+    async def set_schedule_offsets(self, offsets):
+        self.schedule_offsets.update(offsets)
+
+    async def acquire_lease(self, name, holder, seconds):
+        now = datetime.datetime.utcnow()
+        current = self.leases.get(name)
+        if current and current[0] != holder and current[1] >= now:
+            return False
+        self.leases[name] = (holder, now + datetime.timedelta(seconds=seconds))
+        return True
+
+    async def release_lease(self, name, holder):
+        if self.leases.get(name, (None,))[0] == holder:
+            del self.leases[name]
+
+    async def get_leases(self, prefix=""):
+        now = datetime.datetime.utcnow()
+        return {
+            name: holder
+            for name, (holder, expires_at) in self.leases.items()
+            if name.startswith(prefix) and expires_at >= now
+        }
 
     async def get_users(self):
         return list(self.users.values())
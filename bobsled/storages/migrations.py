@@ -0,0 +1,167 @@
+import sqlalchemy
+from ..base import parse_time
+
+"""
+Versioned schema migrations for DatabaseStorage.
+
+Each migration is a function taking a connection and the storage's metadata.  They run
+in order, each in its own transaction, and the highest applied version is kept in the
+bobsled_schema_version table.
+
+Databases created before migrations existed already have some of these changes, so
+migrations check what is there before altering anything.
+"""
+
+# arbitrary key for the Postgres advisory lock held while migrating
+LOCK_ID = 0x0B0B5
+VERSION_TABLE = "bobsled_schema_version"
+
+
+def _add_column(conn, table, column):
+    existing = {c["name"] for c in sqlalchemy.inspect(conn).get_columns(table.name)}
+    if column.name not in existing:
+        type_ = column.type.compile(dialect=conn.dialect)
+        conn.execute(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {type_}')
+
+
+def _create_index(conn, name, table, columns):
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+
+
+def initial_schema(conn, metadata):
+    metadata.create_all(conn)
+
+
+def task_priority_and_hash(conn, metadata):
+    tasks = metadata.tables["bobsled_task"]
+    _add_column(conn, tasks, tasks.c.priority)
+    _add_column(conn, tasks, tasks.c.content_hash)
+
+
+def run_indexes(conn, metadata):
+    # the latest runs of a task, and active runs by status
+    _create_index(conn, "ix_bobsled_run_task_start", "bobsled_run", "task, start DESC")
+    _create_index(conn, "ix_bobsled_run_status_start", "bobsled_run", "status, start")
+
+
+def run_log_chunks(conn, metadata):
+    metadata.tables["bobsled_run_log"].create(conn, checkfirst=True)
+
+
+def compressed_logs(conn, metadata):
+    runs = metadata.tables["bobsled_run"]
+    _add_column(conn, runs, runs.c.logs_zlib)
+
+
+def run_start_index(conn, metadata):
+    # paging through all runs by (start, uuid)
+    _create_index(conn, "ix_bobsled_run_start_uuid", "bobsled_run", "start, uuid")
+
+
+def native_run_times(conn, metadata):
+    # start and end were ISO strings, duration_seconds is new
+    runs = metadata.tables["bobsled_run"]
+    _add_column(conn, runs, runs.c.duration_seconds)
+    # also break ties by uuid, as the latest runs of a task are ordered
+    conn.execute("DROP INDEX IF EXISTS ix_bobsled_run_task_start")
+    _create_index(
+        conn, "ix_bobsled_run_task_start", "bobsled_run", "task, start DESC, uuid DESC"
+    )
+    columns = {
+        c["name"]: c["type"]
+        for c in sqlalchemy.inspect(conn).get_columns("bobsled_run")
+    }
+    if isinstance(columns["start"], sqlalchemy.DateTime):
+        # created after times became native
+        return
+    if conn.dialect.name == "postgresql":
+        for name in ("start", "end"):
+            conn.execute(
+                f'ALTER TABLE bobsled_run ALTER COLUMN "{name}" TYPE TIMESTAMP '
+                f"USING NULLIF(\"{name}\", '')::timestamp"
+            )
+        conn.execute(
+            'UPDATE bobsled_run SET duration_seconds = EXTRACT(EPOCH FROM "end" - start) '
+            'WHERE "end" IS NOT NULL AND start IS NOT NULL'
+        )
+    else:
+        # sqlite doesn't change column types, rewrite the values in DateTime's format
+        rows = conn.execute('SELECT uuid, start, "end" FROM bobsled_run').fetchall()
+        for uuid, start, end in rows:
+            start, end = parse_time(start), parse_time(end)
+            conn.execute(
+                runs.update()
+                .where(runs.c.uuid == uuid)
+                .values(
+                    start=start,
+                    end=end,
+                    duration_seconds=(end - start).total_seconds()
+                    if start and end
+                    else None,
+                )
+            )
+
+
+def task_version(conn, metadata):
+    table = metadata.tables["bobsled_task_version"]
+    table.create(conn, checkfirst=True)
+    if conn.execute(sqlalchemy.select([table.c.version])).scalar() is None:
+        conn.execute(table.insert().values(version=0))
+
+
+def task_stats(conn, metadata):
+    metadata.tables["bobsled_task_stats"].create(conn, checkfirst=True)
+
+
+def task_priority_default(conn, metadata):
+    # task_priority_and_hash added the column without a value for existing tasks
+    conn.execute("UPDATE bobsled_task SET priority = 0 WHERE priority IS NULL")
+
+
+MIGRATIONS = [
+    initial_schema,
+    task_priority_and_hash,
+    run_indexes,
+    run_log_chunks,
+    compressed_logs,
+    run_start_index,
+    native_run_times,
+    task_version,
+    task_stats,
+    task_priority_default,
+]
+
+
+def current_version(conn):
+    query = sqlalchemy.text(f"SELECT MAX(version) FROM {VERSION_TABLE}")
+    return conn.execute(query).scalar() or 0
+
+
+def migrate(engine, metadata):
+    """bring the database up to date, returns the versions that were applied"""
+    applied = []
+    with engine.connect() as conn:
+        if conn.dialect.name == "postgresql":
+            # web and beat may start at the same time
+            conn.execute(sqlalchemy.text(f"SELECT pg_advisory_lock({LOCK_ID})"))
+        try:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (version INTEGER)"
+            )
+            version = current_version(conn)
+            for number, migration in enumerate(MIGRATIONS, start=1):
+                if number <= version:
+                    continue
+                with conn.begin():
+                    migration(conn, metadata)
+                    conn.execute(
+                        sqlalchemy.text(
+                            f"INSERT INTO {VERSION_TABLE} (version) VALUES (:v)"
+                        ),
+                        v=number,
+                    )
+                applied.append(number)
+        finally:
+            if conn.dialect.name == "postgresql":
+                conn.execute(sqlalchemy.text(f"SELECT pg_advisory_unlock({LOCK_ID})"))
+    return applied
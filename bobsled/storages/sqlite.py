@@ -0,0 +1,263 @@
+import asyncio
+import collections
+import weakref
+import aiosqlite
+from databases import Database
+from databases.core import Connection
+from databases.backends.sqlite import (
+    SQLiteBackend,
+    SQLiteConnection,
+    SQLiteTransaction,
+)
+from .database import DatabaseStorage
+
+"""
+SQLite tuned for a single node running beat and the web UI.
+
+The stock SQLite backend opens a connection per query and runs each statement in its
+own transaction, with the default rollback journal that makes writers block readers.
+
+Here connections stay open with WAL journaling, so readers don't wait for the writer.
+All writes go through a single connection, one statement or transaction at a time,
+and reads outside a transaction use a pool of read-only connections.
+"""
+
+
+class _ConnectionPool:
+    def __init__(self, database, readers, pragmas):
+        self.database = database
+        self.max_readers = readers
+        self.pragmas = pragmas
+        self._writer = None
+        self._readers = []
+        self._opened_readers = 0
+        # futures of tasks waiting for a reader
+        self._waiting = collections.deque()
+        # created on first use so it belongs to the running event loop
+        self._writer_lock = None
+
+    async def _open(self, *pragmas):
+        connection = aiosqlite.connect(database=self.database, isolation_level=None)
+        await connection.__aenter__()
+        for pragma in self.pragmas + list(pragmas):
+            await (await connection.execute(f"PRAGMA {pragma}")).close()
+        return connection
+
+    async def acquire_writer(self):
+        if not self._writer_lock:
+            self._writer_lock = asyncio.Lock()
+        await self._writer_lock.acquire()
+        try:
+            if not self._writer:
+                self._writer = await self._open("journal_mode=WAL")
+        except Exception:
+            self._writer_lock.release()
+            raise
+        return self._writer
+
+    def release_writer(self):
+        self._writer_lock.release()
+
+    async def acquire_reader(self):
+        if self._readers and not self._waiting:
+            return self._readers.pop()
+        if self._opened_readers < self.max_readers:
+            self._opened_readers += 1
+            try:
+                return await self._open("query_only=1")
+            except Exception:
+                self._opened_readers -= 1
+                raise
+        # handed over in order by release_reader, so busy readers can't starve others
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiting.append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # cancelled after a reader was handed over
+                await self.release_reader(waiter.result())
+            raise
+
+    async def release_reader(self, connection):
+        while self._waiting:
+            waiter = self._waiting.popleft()
+            if not waiter.done():
+                waiter.set_result(connection)
+                return
+        self._readers.append(connection)
+
+    async def close(self):
+        for connection in self._readers:
+            await connection.__aexit__(None, None, None)
+        self._readers = []
+        self._opened_readers = 0
+        if self._writer:
+            await self._writer.__aexit__(None, None, None)
+            self._writer = None
+
+
+class _Connection(SQLiteConnection):
+    """
+    holds the writer for the length of a transaction, otherwise borrows a connection
+    for each statement
+    """
+
+    async def acquire(self):
+        pass
+
+    async def release(self):
+        pass
+
+    async def _read(self, method, query):
+        if self._connection:
+            # in a transaction, which must see its own writes
+            return await method(self, query)
+        self._connection = await self._pool.acquire_reader()
+        try:
+            return await method(self, query)
+        finally:
+            await self._pool.release_reader(self._connection)
+            self._connection = None
+
+    async def _write(self, method, query):
+        if self._connection:
+            return await method(self, query)
+        self._connection = await self._pool.acquire_writer()
+        try:
+            return await method(self, query)
+        finally:
+            self._pool.release_writer()
+            self._connection = None
+
+    async def fetch_all(self, query):
+        return await self._read(SQLiteConnection.fetch_all, query)
+
+    async def fetch_one(self, query):
+        return await self._read(SQLiteConnection.fetch_one, query)
+
+    async def execute(self, query):
+        return await self._write(SQLiteConnection.execute, query)
+
+    async def execute_many(self, queries):
+        if self._connection:
+            for query in queries:
+                await SQLiteConnection.execute(self, query)
+            return
+        # one write transaction rather than one per statement
+        transaction = self.transaction()
+        await transaction.start(is_root=True)
+        try:
+            for query in queries:
+                await SQLiteConnection.execute(self, query)
+        except Exception:
+            await transaction.rollback()
+            raise
+        await transaction.commit()
+
+    def transaction(self):
+        return _Transaction(self)
+
+
+class _Transaction(SQLiteTransaction):
+    async def start(self, is_root):
+        if not is_root:
+            return await super().start(is_root)
+        self._is_root = True
+        self._connection._connection = await self._connection._pool.acquire_writer()
+        try:
+            # take the write lock now, not when the first write happens
+            await (
+                await self._connection._connection.execute("BEGIN IMMEDIATE")
+            ).close()
+        except Exception:
+            self._release()
+            raise
+
+    def _release(self):
+        self._connection._pool.release_writer()
+        self._connection._connection = None
+
+    async def commit(self):
+        try:
+            await super().commit()
+        finally:
+            if self._is_root:
+                self._release()
+
+    async def rollback(self):
+        try:
+            await super().rollback()
+        finally:
+            if self._is_root:
+                self._release()
+
+
+class TunedSQLiteBackend(SQLiteBackend):
+    def __init__(self, database_url, *, readers, pragmas):
+        super().__init__(database_url)
+        self._pool = _ConnectionPool(self._database_url.database, readers, pragmas)
+
+    async def connect(self):
+        # the writer switches the database to WAL before any reader opens
+        await self._pool.acquire_writer()
+        self._pool.release_writer()
+
+    async def disconnect(self):
+        await self._pool.close()
+
+    def connection(self):
+        return _Connection(self._pool, self._dialect)
+
+
+class _TunedDatabase(Database):
+    SUPPORTED_BACKENDS = {
+        **Database.SUPPORTED_BACKENDS,
+        "sqlite": "bobsled.storages.sqlite:TunedSQLiteBackend",
+    }
+
+    def __init__(self, url, **options):
+        super().__init__(url, **options)
+        self._task_connections = weakref.WeakKeyDictionary()
+
+    def connection(self):
+        # one per task rather than per context, so tasks started while another
+        # holds a transaction don't share its connection, and wait for the writer
+        task = asyncio.current_task()
+        if task not in self._task_connections:
+            self._task_connections[task] = Connection(self._backend)
+        return self._task_connections[task]
+
+
+class SQLiteStorage(DatabaseStorage):
+    """
+    DatabaseStorage for a SQLite database shared by the processes on one machine
+
+    BOBSLED_SQLITE_READERS is the most read connections open at once,
+    BOBSLED_SQLITE_SYNCHRONOUS is SQLite's synchronous setting (NORMAL only syncs
+    the WAL at checkpoints, which is safe from corruption but may lose the last
+    transactions on power loss), and BOBSLED_SQLITE_CACHE_MB is the page cache size
+    of each connection
+    """
+
+    def __init__(
+        self,
+        BOBSLED_DATABASE_URI,
+        *,
+        BOBSLED_SQLITE_READERS=4,
+        BOBSLED_SQLITE_SYNCHRONOUS="NORMAL",
+        BOBSLED_SQLITE_CACHE_MB=64,
+    ):
+        if not BOBSLED_DATABASE_URI.startswith("sqlite"):
+            raise ValueError("SQLiteStorage requires a sqlite:// BOBSLED_DATABASE_URI")
+        pragmas = [
+            f"synchronous={BOBSLED_SQLITE_SYNCHRONOUS}",
+            # negative sizes are in KiB
+            f"cache_size=-{int(BOBSLED_SQLITE_CACHE_MB) * 1024}",
+            "temp_store=MEMORY",
+            # other processes may hold the write lock
+            "busy_timeout=5000",
+        ]
+        self.database = _TunedDatabase(
+            BOBSLED_DATABASE_URI, readers=int(BOBSLED_SQLITE_READERS), pragmas=pragmas
+        )
@@ -0,0 +1,49 @@
+import time
+
+
+class TaskCacheStorage:
+    """
+    wraps another storage, keeping its tasks in memory
+
+    the task version, which set_tasks bumps, is checked at most every
+    BOBSLED_TASK_CACHE_SECONDS and the tasks are only read again when it has changed,
+    so processes sharing a database see each other's changes within that time.
+    everything else is passed through to the wrapped storage.
+    """
+
+    def __init__(self, storage, *, BOBSLED_TASK_CACHE_SECONDS=1):
+        self.storage = storage
+        self.check_seconds = float(BOBSLED_TASK_CACHE_SECONDS)
+        # name => Task, None until first loaded
+        self.tasks = None
+        self.version = None
+        self.next_check = 0
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    async def _current_tasks(self):
+        now = time.monotonic()
+        if self.tasks is None or now >= self.next_check:
+            # read before the tasks, a change in between is picked up next time
+            version = await self.storage.get_task_version()
+            if self.tasks is None or version != self.version:
+                tasks = await self.storage.get_tasks()
+                self.tasks = {task.name: task for task in tasks}
+                self.version = version
+            self.next_check = now + self.check_seconds
+        return self.tasks
+
+    async def get_tasks(self):
+        return list((await self._current_tasks()).values())
+
+    async def get_task(self, name):
+        tasks = await self._current_tasks()
+        if name in tasks:
+            return tasks[name]
+        # missing tasks are reported however the wrapped storage does
+        return await self.storage.get_task(name)
+
+    async def set_tasks(self, tasks):
+        await self.storage.set_tasks(tasks)
+        self.next_check = 0
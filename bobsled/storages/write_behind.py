@@ -0,0 +1,111 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindStorage:
+    """
+    wraps another storage, holding save_run calls for unfinished runs for up to
+    BOBSLED_WRITE_BEHIND_SECONDS and then writing them with save_runs, so repeated
+    updates to a run are written once and a busy tick's updates share a transaction
+
+    runs reaching a terminal status are saved immediately, and reading runs writes
+    anything pending first, so callbacks and next_tasks see the same state as without
+    the wrapper.  everything else is passed through to the wrapped storage.
+    """
+
+    def __init__(self, storage, *, BOBSLED_WRITE_BEHIND_SECONDS=1):
+        self.storage = storage
+        self.delay = float(BOBSLED_WRITE_BEHIND_SECONDS)
+        # run id => the latest version of the run to save
+        self.pending = {}
+        self._timer = None
+        # created on first use so it belongs to the running event loop
+        self._lock = None
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def _get_lock(self):
+        if not self._lock:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def save_run(self, run):
+        if run.status.is_terminal():
+            # after any flush already writing, which may hold an older copy of the run
+            async with self._get_lock():
+                self.pending.pop(run.uuid, None)
+                await self.storage.save_run(run)
+            return
+        self.pending[run.uuid] = run
+        if not self._timer:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def save_runs(self, runs):
+        for run in runs:
+            await self.save_run(run)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception:
+            # kept pending, the next save or read tries again
+            logger.exception("write-behind flush failed")
+
+    async def flush(self):
+        """write all pending updates"""
+        async with self._get_lock():
+            batch, self.pending = self.pending, {}
+            if not batch:
+                return
+            try:
+                await self.storage.save_runs(list(batch.values()))
+            except Exception:
+                for run_id, run in batch.items():
+                    self.pending.setdefault(run_id, run)
+                raise
+
+    async def get_run(self, run_id, logs=True):
+        await self.flush()
+        return await self.storage.get_run(run_id, logs)
+
+    async def get_runs(self, **kwargs):
+        await self.flush()
+        return await self.storage.get_runs(**kwargs)
+
+    async def get_latest_runs(self, latest, task_names=None):
+        await self.flush()
+        return await self.storage.get_latest_runs(latest, task_names)
+
+    async def get_active_runs(self):
+        await self.flush()
+        return await self.storage.get_active_runs()
+
+    async def get_expired_runs(self, **kwargs):
+        await self.flush()
+        return await self.storage.get_expired_runs(**kwargs)
+
+    async def get_duration_stats(self, **kwargs):
+        await self.flush()
+        return await self.storage.get_duration_stats(**kwargs)
+
+    async def get_logs(self, run_id, offset=0):
+        await self.flush()
+        return await self.storage.get_logs(run_id, offset)
+
+    async def iter_logs(self, run_id, offset=0):
+        await self.flush()
+        async for text in self.storage.iter_logs(run_id, offset):
+            yield text
+
+    async def claim_run(self, run_id, from_status, to_status, run_info=None):
+        await self.flush()
+        return await self.storage.claim_run(run_id, from_status, to_status, run_info)
+
+    async def delete_runs(self, run_ids):
+        await self.flush()
+        await self.storage.delete_runs(run_ids)
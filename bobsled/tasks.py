@@ -1,4 +1,4 @@
-from .base import Task, Trigger
+from .base import Task, TaskDiff, Trigger
 from .utils import load_github_or_local_yaml
 
 
@@ -26,6 +26,7 @@ class TaskProvider:
             )
 
     async def update_tasks(self):
+        old_hashes = {t.name: t.content_hash() for t in await self.storage.get_tasks()}
         data = load_github_or_local_yaml(
             self.filename,
             self.dirname,
@@ -37,3 +38,4 @@ class TaskProvider:
         for task in tasks:
             task.triggers = [Trigger(**t) for t in task.triggers]
         await self.storage.set_tasks(tasks)
+        return TaskDiff.between(old_hashes, tasks)
@@ -0,0 +1,284 @@
+import asyncio
+import datetime
+import inspect
+import pytest
+from ..admission import AdmissionController, Usage
+from ..base import Run, RunService, Status, Task
+from ..exceptions import AlreadyRunning
+from ..scheduler import DeadlineQueue
+from ..storages import InMemoryStorage
+
+
+class FakeRunService(RunService):
+    STARTING_STATUS = Status.Running
+
+    def __init__(self, admission=None):
+        self.storage = InMemoryStorage()
+        self.callbacks = []
+        self.admission = admission or AdmissionController()
+        self.timeouts = DeadlineQueue()
+        self.tracks_timeouts = True
+        self.started = []
+        self.stopped = []
+
+    def start_task(self, task):
+        self.started.append(task.name)
+        return {}
+
+    def stop(self, run):
+        self.stopped.append(run.task)
+
+    async def _time_out(self, run):
+        self.stop(run)
+        run.status = Status.TimedOut
+        await self._save_and_followup(run)
+
+    async def finish(self, run):
+        run.status = Status.Success
+        await self._save_and_followup(run)
+
+
+def test_usage_from_runs():
+    usage = Usage.from_runs(
+        [
+            Run("a", Status.Running, run_info={"tags": ["x", "y"]}),
+            Run("b", Status.Running, run_info={"tags": ["x"]}),
+            Run("b", Status.Pending, run_info={}),
+        ]
+    )
+    assert usage.total == 3
+    assert usage.by_task == {"a": 1, "b": 2}
+    assert usage.by_tag == {"x": 2, "y": 1}
+
+
+def test_admit_limits():
+    usage = Usage()
+    usage.add("a", ["scrape"])
+    usage.add("b", ["scrape"])
+    task = Task("c", "img", tags=["scrape"])
+
+    assert AdmissionController().admit(task, usage)
+    assert not AdmissionController(BOBSLED_MAX_RUNNING="2").admit(task, usage)
+    assert AdmissionController(BOBSLED_MAX_RUNNING="3").admit(task, usage)
+    assert not AdmissionController(
+        BOBSLED_MAX_RUNNING_PER_TAG="other=1, scrape=2"
+    ).admit(task, usage)
+    assert AdmissionController(BOBSLED_MAX_RUNNING_PER_TAG="scrape=3").admit(
+        task, usage
+    )
+    assert not AdmissionController().admit(Task("a", "img"), usage)
+    assert AdmissionController(BOBSLED_MAX_RUNNING_PER_TASK="0").admit(
+        Task("a", "img"), usage
+    )
+
+
+@pytest.mark.asyncio
+async def test_unlimited_starts_immediately():
+    rs = FakeRunService()
+    run = await rs.run_task(Task("a", "img"))
+    assert run.status == Status.Running
+    with pytest.raises(AlreadyRunning):
+        await rs.run_task(Task("a", "img"))
+
+
+@pytest.mark.asyncio
+async def test_queue_drains_as_runs_finish():
+    rs = FakeRunService(AdmissionController(BOBSLED_MAX_RUNNING=1))
+    tasks = [Task(name, "img") for name in "abc"]
+    await rs.storage.set_tasks(tasks)
+
+    a = await rs.run_task(tasks[0])
+    b = await rs.run_task(tasks[1])
+    c = await rs.run_task(tasks[2])
+    assert [a.status, b.status, c.status] == [
+        Status.Running,
+        Status.Queued,
+        Status.Queued,
+    ]
+    assert rs.started == ["a"]
+    # queued runs count as already running
+    with pytest.raises(AlreadyRunning):
+        await rs.run_task(tasks[1])
+
+    stats = await rs.queue_stats()
+    assert stats["depth"] == 2
+
+    await rs.finish(a)
+    assert rs.started == ["a", "b"]
+    assert b.status == Status.Running
+    assert "queued_seconds" in b.run_info
+    assert c.status == Status.Queued
+
+    await rs.finish(b)
+    assert rs.started == ["a", "b", "c"]
+    assert (await rs.queue_stats())["depth"] == 0
+
+
+class YieldingStorage:
+    """yields to the event loop on each call, like a database-backed storage"""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+        if not inspect.iscoroutinefunction(method):
+            return method
+
+        async def call(*args, **kwargs):
+            await asyncio.sleep(0)
+            return await method(*args, **kwargs)
+
+        return call
+
+
+@pytest.mark.asyncio
+async def test_concurrent_dispatch_starts_runs_once():
+    rs = FakeRunService(AdmissionController(BOBSLED_MAX_RUNNING=2))
+    rs.storage = YieldingStorage(rs.storage)
+    tasks = [Task(name, "img") for name in "abcd"]
+    await rs.storage.set_tasks(tasks)
+    a, b, c, d = [await rs.run_task(task) for task in tasks]
+    assert rs.started == ["a", "b"]
+
+    # e.g. beat polling status, which finishes runs in parallel
+    await asyncio.gather(rs.finish(a), rs.finish(b))
+    assert rs.started == ["a", "b", "c", "d"]
+    assert c.status == d.status == Status.Running
+
+
+@pytest.mark.asyncio
+async def test_tag_limit_skips_blocked_runs():
+    rs = FakeRunService(AdmissionController(BOBSLED_MAX_RUNNING_PER_TAG="heavy=1"))
+    tasks = [
+        Task("h1", "img", tags=["heavy"]),
+        Task("h2", "img", tags=["heavy"]),
+        Task("light", "img"),
+    ]
+    await rs.storage.set_tasks(tasks)
+    runs = [await rs.run_task(t) for t in tasks]
+    # the light task queues behind h2 but isn't held up by it
+    assert [r.status for r in runs] == [Status.Running, Status.Queued, Status.Running]
+    assert rs.started == ["h1", "light"]
+
+
+@pytest.mark.asyncio
+async def test_stop_queued_run():
+    rs = FakeRunService(AdmissionController(BOBSLED_MAX_RUNNING=1))
+    await rs.storage.set_tasks([Task("a", "img"), Task("b", "img")])
+    await rs.run_task(Task("a", "img"))
+    b = await rs.run_task(Task("b", "img"))
+    await rs.stop_run(b.uuid)
+    assert b.status == Status.UserKilled
+    assert (await rs.queue_stats())["depth"] == 0
+
+
+@pytest.mark.asyncio
+async def test_stop_running_run_dispatches_queued():
+    rs = FakeRunService(AdmissionController(BOBSLED_MAX_RUNNING=1))
+    await rs.storage.set_tasks([Task("a", "img"), Task("b", "img")])
+    a = await rs.run_task(Task("a", "img"))
+    b = await rs.run_task(Task("b", "img"))
+    assert b.status == Status.Queued
+    await rs.stop_run(a.uuid)
+    assert rs.stopped == ["a"]
+    assert rs.started == ["a", "b"]
+    assert (await rs.storage.get_run(b.uuid)).status == Status.Running
+
+
+def _queued(task, priority, queued_at):
+    return Run(
+        task,
+        Status.Queued,
+        run_info={"priority": priority, "queued_at": queued_at.isoformat()},
+    )
+
+
+def test_queue_order_priority_and_aging():
+    now = datetime.datetime(2020, 1, 1, 12)
+    runs = [
+        _queued("old-low", 0, now - datetime.timedelta(minutes=30)),
+        _queued("new-low", 0, now),
+        _queued("new-high", 5, now),
+        _queued("older-low", 0, now - datetime.timedelta(minutes=31)),
+    ]
+    # no aging, priority then age
+    ac = AdmissionController(BOBSLED_QUEUE_AGING_SECONDS=0)
+    assert [r.task for r in ac.queue_order(runs, now)] == [
+        "new-high",
+        "older-low",
+        "old-low",
+        "new-low",
+    ]
+    # every 5 minutes waiting is worth one priority level
+    ac = AdmissionController(BOBSLED_QUEUE_AGING_SECONDS=300)
+    assert [r.task for r in ac.queue_order(runs, now)] == [
+        "older-low",
+        "old-low",
+        "new-high",
+        "new-low",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_priority_dispatch():
+    rs = FakeRunService(AdmissionController(BOBSLED_MAX_RUNNING=1))
+    tasks = [
+        Task("first", "img"),
+        Task("bulk", "img"),
+        Task("critical", "img", priority=10),
+        Task("manual", "img"),
+    ]
+    await rs.storage.set_tasks(tasks)
+    first = await rs.run_task(tasks[0])
+    await rs.run_task(tasks[1])
+    await rs.run_task(tasks[2])
+    manual = await rs.run_task(tasks[3], priority=20)
+    assert manual.run_info["priority"] == 20
+
+    await rs.finish(first)
+    assert rs.started == ["first", "manual"]
+    await rs.finish(manual)
+    assert rs.started == ["first", "manual", "critical"]
+
+
+@pytest.mark.asyncio
+async def test_run_timeouts():
+    rs = FakeRunService(AdmissionController(BOBSLED_MAX_RUNNING=1))
+    slow = await rs.run_task(Task("slow", "img", timeout_minutes=5))
+    queued = await rs.run_task(Task("next", "img"))
+    await rs.storage.set_tasks([Task("slow", "img"), Task("next", "img")])
+    deadline = datetime.datetime.fromisoformat(slow.run_info["timeout_at"])
+    assert rs.timeouts.peek() == deadline
+
+    assert await rs.check_timeouts(deadline - datetime.timedelta(seconds=1)) == []
+    assert await rs.check_timeouts(deadline) == [slow]
+    assert slow.status == Status.TimedOut
+    assert rs.stopped == ["slow"]
+    assert rs.timeouts.peek() is None
+    # the freed slot went to the queued run
+    assert (await rs.storage.get_run(queued.uuid)).status == Status.Running
+
+
+@pytest.mark.asyncio
+async def test_finished_run_timeout_forgotten():
+    rs = FakeRunService()
+    run = await rs.run_task(Task("quick", "img", timeout_minutes=5))
+    await rs.finish(run)
+    assert len(rs.timeouts) == 0
+    assert await rs.check_timeouts(datetime.datetime.utcnow().replace(year=2100)) == []
+
+    # runs started by another process are tracked from their run_info
+    other = Run("other", Status.Running, run_info={"timeout_at": "2020-01-01T00:00:00"})
+    await rs.storage.add_run(other)
+    rs.track_timeout(other)
+    assert await rs.check_timeouts() == [other]
+
+
+@pytest.mark.asyncio
+async def test_timeouts_only_tracked_where_checked():
+    # e.g. the web process, where nothing would take the run off the queue again
+    rs = FakeRunService()
+    rs.tracks_timeouts = False
+    await rs.run_task(Task("slow", "img", timeout_minutes=5))
+    assert len(rs.timeouts) == 0
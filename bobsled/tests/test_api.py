@@ -64,6 +64,48 @@ def test_overview():
     assert response.json()["runs"][0]["duration"] == "25:02:03"
 
 
+def test_latest_runs_pages():
+    bobsled.storage.runs = [
+        Run("hello-world", Status.Success, f"2020-01-{day:02d}T00:00:00.0")
+        for day in range(1, 11)
+    ]
+    with TestClient(app) as client:
+        client.post("/login", {"username": "sample", "password": "password"})
+        first = client.get("/api/latest_runs?limit=4").json()
+        second = client.get(f"/api/latest_runs?limit=4&before={first['older']}").json()
+        back = client.get(f"/api/latest_runs?limit=4&after={second['newer']}").json()
+    assert [r["start"][:10] for r in first["runs"]] == [
+        "2020-01-10",
+        "2020-01-09",
+        "2020-01-08",
+        "2020-01-07",
+    ]
+    assert second["runs"][0]["start"][:10] == "2020-01-06"
+    assert back["runs"] == first["runs"]
+
+
+def test_latest_runs_bad_params():
+    bobsled.storage.runs = [
+        Run("hello-world", Status.Success, f"2020-01-{day:02d}T00:00:00.0")
+        for day in range(1, 11)
+    ]
+    with TestClient(app) as client:
+        client.post("/login", {"username": "sample", "password": "password"})
+        # 0 and negative limits would otherwise mean no limit
+        assert len(client.get("/api/latest_runs?limit=0").json()["runs"]) == 1
+        assert len(client.get("/api/latest_runs?limit=-1").json()["runs"]) == 1
+        for query in ("limit=ten", "before=null", "after=2020-01-01,", "before=x,y"):
+            assert client.get(f"/api/latest_runs?{query}").status_code == 400
+
+
+def test_run_bad_priority():
+    with TestClient(app) as client:
+        client.post("/login", {"username": "admin", "password": "password"})
+        response = client.post("/api/task/hello-world/run?priority=high")
+        assert response.status_code == 400
+        assert response.json()["error"] == "priority must be an integer"
+
+
 def test_run_perms():
     # test these together because there's weirdness in running twice
     with TestClient(app) as client:
@@ -1,4 +1,4 @@
-from ..base import Task
+from ..base import Task, TaskDiff, Trigger
 
 
 def test_task_entrypoint():
@@ -9,3 +9,25 @@ def test_task_entrypoint():
         "right",
         "way",
     ]
+
+
+def test_task_content_hash():
+    task = Task("name", "image", tags=["a"], triggers=[Trigger("0 4 * * ?")])
+    same = Task("name", "image", tags=["a"], triggers=[Trigger("0 4 * * ?")])
+    assert task.content_hash() == same.content_hash()
+    same.triggers = [Trigger("0 5 * * ?")]
+    assert task.content_hash() != same.content_hash()
+
+
+def test_task_diff():
+    one = Task("one", "image")
+    two = Task("two", "image")
+    old_hashes = {"one": one.content_hash(), "two": two.content_hash(), "gone": "x"}
+    changed = Task("two", "new-image")
+    new = Task("new", "image")
+
+    diff = TaskDiff.between(old_hashes, [one, changed, new])
+    assert diff.tasks == [one, changed, new]
+    assert diff.added == [new]
+    assert diff.changed == [changed]
+    assert diff.removed == ["gone"]
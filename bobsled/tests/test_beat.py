@@ -1,5 +1,15 @@
+import asyncio
 import datetime
-from ..beat import next_cron
+from types import SimpleNamespace
+import pytest
+import zmq
+import zmq.asyncio
+from ..base import Run, ScheduleState, Status, Task, TaskDiff, Trigger
+from ..beat import RETENTION_BATCHES, Beat, listen_for_control, next_cron
+from ..retention import Retention
+from ..scheduler import DeadlineQueue
+from ..storages import InMemoryStorage
+from .test_admission import FakeRunService as FakeAdmissionRunService
 
 midnight = datetime.datetime(2020, 1, 1, 0, 0)
 noon = datetime.datetime(2020, 1, 1, 12, 0)
@@ -78,3 +88,395 @@ def test_dec_jan_rollover():
     # going from dec to january
     dec = datetime.datetime(2020, 12, 31, 23, 0)
     assert next_cron("0 4 * * ?", dec) == datetime.datetime(2021, 1, 1, 4, 0)
+
+
+class FakeRunService:
+    def __init__(self):
+        self.started = []
+        self.updated = []
+        self.timeouts = DeadlineQueue()
+
+    async def run_task(self, task):
+        self.started.append(task.name)
+        return task.name
+
+    def track_timeout(self, run):
+        pass
+
+    async def update_status(self, run, update_logs=False):
+        self.updated.append(run)
+
+    async def queue_stats(self, queued):
+        return {"depth": len(queued), "oldest_wait_seconds": 0}
+
+    async def dispatch_queued(self):
+        pass
+
+    async def check_timeouts(self, now):
+        return []
+
+
+def _beat(catchup="once"):
+    storage = InMemoryStorage()
+    bobsled = SimpleNamespace(storage=storage, run=FakeRunService())
+    beat = Beat(bobsled, log=lambda msg: None, BOBSLED_BEAT_CATCHUP=catchup)
+    return beat, storage
+
+
+@pytest.mark.asyncio
+async def test_beat_starts_due_tasks():
+    beat, storage = _beat()
+    await storage.set_tasks(
+        [
+            Task("four", "img", triggers=[Trigger("0 4 * * ?")]),
+            Task("noon", "img", triggers=[Trigger("0 12 * * ?")]),
+            Task("disabled", "img", enabled=False, triggers=[Trigger("0 4 * * ?")]),
+            Task("no-trigger", "img"),
+        ]
+    )
+    for task in await storage.get_tasks():
+        if task.enabled:
+            beat.schedule_task(task, midnight)
+    assert len(beat.schedule) == 2
+    assert beat.schedule.peek() == datetime.datetime(2020, 1, 1, 4, 0)
+
+    # nothing due yet
+    await beat.start_due(datetime.datetime(2020, 1, 1, 3, 59))
+    assert beat.bobsled.run.started == []
+
+    await beat.start_due(datetime.datetime(2020, 1, 1, 4, 0))
+    assert beat.bobsled.run.started == ["four"]
+    # rescheduled for the next day, noon still pending
+    assert beat.schedule.get("four") == datetime.datetime(2020, 1, 2, 4, 0)
+    assert beat.schedule.get("noon") == noon
+
+
+def test_beat_next_wakeup():
+    beat, storage = _beat()
+    beat.next_status_poll = ninepm
+    beat.next_config_update = ninepm
+    assert beat.next_wakeup() == ninepm
+    beat.schedule.push("task", noon)
+    assert beat.next_wakeup() == noon
+    # run timeouts wake beat too
+    beat.bobsled.run.timeouts.push("run-id", midnight)
+    assert beat.next_wakeup() == midnight
+
+
+@pytest.mark.asyncio
+async def test_beat_multiple_triggers():
+    beat, storage = _beat()
+    task = Task("two", "img", triggers=[Trigger("0 4 * * ?"), Trigger("0 12 * * ?")])
+    await storage.set_tasks([task])
+    assert beat.schedule_task(task, midnight) == datetime.datetime(2020, 1, 1, 4, 0)
+
+    await beat.start_due(datetime.datetime(2020, 1, 1, 4, 0))
+    assert beat.schedule.get("two") == noon
+    await beat.start_due(noon)
+    assert beat.schedule.get("two") == datetime.datetime(2020, 1, 2, 4, 0)
+    assert beat.bobsled.run.started == ["two", "two"]
+
+
+@pytest.mark.asyncio
+async def test_beat_persists_schedule_state():
+    beat, storage = _beat()
+    task = Task("four", "img", triggers=[Trigger("0 4 * * ?")])
+    await storage.set_tasks([task])
+    beat.schedule_task(task, midnight)
+    await beat.start_due(datetime.datetime(2020, 1, 1, 4, 0, 1))
+
+    state = (await storage.get_schedule_states())["four"]
+    assert state.last_run == datetime.datetime(2020, 1, 1, 4, 0)
+    assert state.next_run == datetime.datetime(2020, 1, 2, 4, 0)
+
+
+hourly = Task("hourly", "img", triggers=[Trigger("0 * * * ?")])
+# beat was down from 1:30 to 4:30, missing runs at 2, 3 and 4
+down_state = ScheduleState(
+    "hourly", datetime.datetime(2020, 1, 1, 1), datetime.datetime(2020, 1, 1, 2)
+)
+back_up = datetime.datetime(2020, 1, 1, 4, 30)
+
+
+def test_resume_without_state():
+    beat, storage = _beat()
+    assert beat.resume_task(hourly, None, back_up) == datetime.datetime(2020, 1, 1, 5)
+    assert beat.resume_task(
+        hourly, ScheduleState("hourly", None, datetime.datetime(2020, 1, 1, 5)), back_up
+    ) == datetime.datetime(2020, 1, 1, 5)
+
+
+@pytest.mark.asyncio
+async def test_catchup_skip():
+    beat, storage = _beat("skip")
+    beat.resume_task(hourly, down_state, back_up)
+    await beat.start_due(back_up)
+    assert beat.bobsled.run.started == []
+    assert beat.schedule.get("hourly") == datetime.datetime(2020, 1, 1, 5)
+
+
+@pytest.mark.asyncio
+async def test_catchup_once():
+    beat, storage = _beat("once")
+    await storage.set_tasks([hourly])
+    beat.resume_task(hourly, down_state, back_up)
+    await beat.start_due(back_up)
+    assert beat.bobsled.run.started == ["hourly"]
+    assert beat.schedule.get("hourly") == datetime.datetime(2020, 1, 1, 5)
+
+
+@pytest.mark.asyncio
+async def test_catchup_all():
+    beat, storage = _beat("all")
+    await storage.set_tasks([hourly])
+    beat.resume_task(hourly, down_state, back_up)
+    for _ in range(4):
+        await beat.start_due(back_up)
+    assert beat.bobsled.run.started == ["hourly", "hourly", "hourly"]
+    assert beat.schedule.get("hourly") == datetime.datetime(2020, 1, 1, 5)
+
+
+@pytest.mark.asyncio
+async def test_catchup_all_waits_for_previous_run():
+    rs = FakeAdmissionRunService()
+    bobsled = SimpleNamespace(storage=rs.storage, run=rs)
+    beat = Beat(bobsled, log=lambda msg: None, BOBSLED_BEAT_CATCHUP="all")
+    await rs.storage.set_tasks([hourly])
+    beat.resume_task(hourly, down_state, back_up)
+
+    await beat.start_due(back_up)
+    await beat.start_due(back_up)
+    # the 3:00 run is held rather than dropped while the 2:00 run is going
+    assert rs.started == ["hourly"]
+    state = (await rs.storage.get_schedule_states())["hourly"]
+    assert state.next_run == datetime.datetime(2020, 1, 1, 3)
+
+    now = back_up
+    for n in range(2, 4):
+        (running,) = await rs.storage.get_runs(status=Status.Running)
+        await rs.finish(running)
+        now += datetime.timedelta(minutes=1)
+        await beat.start_due(now)
+        assert rs.started == ["hourly"] * n
+    (running,) = await rs.storage.get_runs(status=Status.Running)
+    await rs.finish(running)
+
+    # caught up, back on the regular schedule
+    await beat.start_due(now + datetime.timedelta(minutes=1))
+    assert rs.started == ["hourly"] * 3
+    assert beat.schedule.get("hourly") == datetime.datetime(2020, 1, 1, 5)
+    state = (await rs.storage.get_schedule_states())["hourly"]
+    assert state.last_run == datetime.datetime(2020, 1, 1, 4)
+
+
+def test_bad_catchup_policy():
+    with pytest.raises(ValueError):
+        _beat("sometimes")
+
+
+@pytest.mark.asyncio
+async def test_beat_apply_diff():
+    beat, storage = _beat()
+    four = Task("four", "img", triggers=[Trigger("0 4 * * ?")])
+    gone = Task("gone", "img", triggers=[Trigger("0 4 * * ?")])
+    await storage.set_tasks([four, gone])
+    await beat.apply_diff(TaskDiff.between({}, [four, gone]), midnight)
+    assert beat.schedule.get("four") == beat.schedule.get("gone")
+    assert set(await storage.get_schedule_states()) == {"four", "gone"}
+
+    noon_task = Task("four", "img", triggers=[Trigger("0 12 * * ?")])
+    disabled = Task("disabled", "img", enabled=False, triggers=[Trigger("0 4 * * ?")])
+    diff = TaskDiff.between(beat.task_hashes, [noon_task, disabled])
+    assert diff.changed == [noon_task]
+    await beat.apply_diff(diff, midnight)
+
+    assert beat.schedule.get("four") == noon
+    assert "gone" not in beat.schedule
+    assert "disabled" not in beat.schedule
+    assert set(await storage.get_schedule_states()) == {"four"}
+    # nothing changed, nothing to apply
+    diff = TaskDiff.between(beat.task_hashes, [noon_task, disabled])
+    assert diff.added == diff.changed == diff.removed == []
+
+
+@pytest.mark.asyncio
+async def test_beat_config_changed():
+    beat, storage = _beat()
+    await storage.set_tasks([Task("hourly", "img", triggers=[Trigger("0 * * * ?")])])
+    socket = zmq.asyncio.Context.instance().socket(zmq.PULL)
+    socket.bind("inproc://beat-control")
+    listener = asyncio.ensure_future(listen_for_control(socket, beat))
+    try:
+        sender = zmq.asyncio.Context.instance().socket(zmq.PUSH)
+        sender.connect("inproc://beat-control")
+        await sender.send_string("config_changed")
+        await asyncio.wait_for(beat._wakeup.wait(), 1)
+    finally:
+        listener.cancel()
+        sender.close()
+        socket.close()
+    assert beat.tasks_changed
+
+    # the web UI already refreshed the config, beat only re-reads the tasks
+    await beat.tick()
+    assert not beat.tasks_changed
+    assert "hourly" in beat.schedule
+
+
+@pytest.mark.asyncio
+async def test_beat_skips_removed_task():
+    beat, storage = _beat()
+    beat.schedule_task(Task("gone", "img", triggers=[Trigger("0 4 * * ?")]), midnight)
+    await beat.start_due(datetime.datetime(2020, 1, 1, 4))
+    assert beat.bobsled.run.started == []
+    assert "gone" not in beat.schedule
+
+
+@pytest.mark.asyncio
+async def test_beat_uses_planned_offsets():
+    beat, storage = _beat()
+    task = Task("hourly", "img", triggers=[Trigger("0 * * * ?", window=20)])
+    await storage.set_tasks([task])
+    await storage.set_schedule_offsets({"hourly": 7})
+    await beat.load_schedule()
+    assert beat.schedule.get("hourly").minute == 7
+
+
+def _sharded_beats(storage, *ids):
+    return [
+        Beat(
+            SimpleNamespace(storage=storage, run=FakeRunService()),
+            log=lambda msg: None,
+            BOBSLED_BEAT_SHARDED="true",
+            BOBSLED_BEAT_INSTANCE_ID=id,
+        )
+        for id in ids
+    ]
+
+
+@pytest.mark.asyncio
+async def test_sharded_beats_split_tasks():
+    storage = InMemoryStorage()
+    names = [f"task{n}" for n in range(20)]
+    await storage.set_tasks(
+        [Task(name, "img", triggers=[Trigger("0 4 * * ?")]) for name in names]
+    )
+    a, b = _sharded_beats(storage, "a", "b")
+    await a.load_schedule()
+    await b.load_schedule()
+    # a loaded before b joined and still owns everything
+    assert len(a.schedule) == 20
+    assert a.is_leader and not b.is_leader
+    # only the leader checks timeouts, so only it tracks them
+    assert a.bobsled.run.tracks_timeouts and not b.bobsled.run.tracks_timeouts
+
+    await a.update_membership()
+    await a.resume_owned()
+    owned_a = {name for name, _ in a.schedule.items()}
+    owned_b = {name for name, _ in b.schedule.items()}
+    assert owned_a and owned_b
+    assert owned_a | owned_b == set(names)
+    assert not owned_a & owned_b
+
+
+@pytest.mark.asyncio
+async def test_sharded_beat_takes_over_dead_instance():
+    storage = InMemoryStorage()
+    await storage.set_tasks(
+        [Task(f"task{n}", "img", triggers=[Trigger("0 4 * * ?")]) for n in range(10)]
+    )
+    a, b = _sharded_beats(storage, "a", "b")
+    b.lease_seconds = 0.1
+    await b.update_membership()
+    await a.update_membership()
+    await a.resume_owned()
+    assert len(a.schedule) < 10
+    assert b.is_leader
+
+    # b's leases expire, a takes over its tasks and the leader role
+    await asyncio.sleep(0.2)
+    assert await a.update_membership()
+    await a.resume_owned()
+    assert len(a.schedule) == 10
+    assert a.is_leader
+    assert a.ring.members == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_sharded_beat_releases_leases():
+    storage = InMemoryStorage()
+    (a,) = _sharded_beats(storage, "a")
+    await a.update_membership()
+    assert await storage.get_leases() == {"beat:a": "a", "beat-leader": "a"}
+    await a.release_leases()
+    assert await storage.get_leases() == {}
+
+
+@pytest.mark.asyncio
+async def test_follower_next_wakeup():
+    storage = InMemoryStorage()
+    a, b = _sharded_beats(storage, "a", "b")
+    await a.update_membership()
+    await b.update_membership()
+    assert not b.is_leader
+    # followers don't poll status, so their past next_status_poll mustn't wake them
+    assert b.next_status_poll < datetime.datetime.utcnow()
+    assert b.next_wakeup() == b.next_membership_check
+
+    ticks = []
+    tick = b.tick
+
+    async def counting_tick():
+        ticks.append(datetime.datetime.utcnow())
+        await tick()
+
+    b.tick = counting_tick
+    loop = asyncio.ensure_future(b.run_forever())
+    await asyncio.sleep(0.1)
+    loop.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await loop
+    assert len(ticks) == 1
+
+
+@pytest.mark.asyncio
+async def test_retention_backlog_doesnt_block_due_tasks():
+    storage = InMemoryStorage()
+    await storage.set_tasks([Task("due", "img", triggers=[Trigger("0 4 * * ?")])])
+    for n in range(20):
+        await storage.add_run(
+            Run("old", Status.Success, start=f"2020-01-01T00:{n:02d}:00")
+        )
+    retention = Retention(storage, BOBSLED_RETAIN_RUNS_PER_TASK="1")
+    retention.BATCH_SIZE = 2
+    beat = Beat(
+        SimpleNamespace(storage=storage, run=FakeRunService()),
+        log=lambda msg: None,
+        retention=retention,
+    )
+    beat.schedule.push("due", datetime.datetime.utcnow())
+
+    await beat.tick()
+    assert beat.bobsled.run.started == ["due"]
+    # only a few batches are removed per tick, the rest carry on next tick
+    assert len(storage.runs) == 20 - RETENTION_BATCHES * 2
+    assert beat.next_wakeup() <= datetime.datetime.utcnow()
+
+    while beat.next_retention <= datetime.datetime.utcnow():
+        await beat.tick()
+    assert len(storage.runs) == 1
+
+
+@pytest.mark.asyncio
+async def test_poll_status_uses_active_snapshot():
+    logs = []
+    beat, storage = _beat()
+    beat.log = logs.append
+    running = Run("a", Status.Running, run_info={"timeout_at": ""})
+    pending = Run("b", Status.Pending, run_info={"timeout_at": ""})
+    for run in (running, pending, Run("c", Status.Success)):
+        await storage.add_run(run)
+    await beat.poll_status()
+    # the loaded runs are passed along rather than being fetched again
+    assert sorted(beat.bobsled.run.updated, key=lambda r: r.task) == [running, pending]
+    assert "pending=1 running=1 queued=0" in logs[0]
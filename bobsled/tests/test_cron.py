@@ -0,0 +1,181 @@
+import datetime
+import pytest
+from ..base import Task, Trigger
+from ..cron import (
+    CronSchedule,
+    TaskSchedule,
+    compile_cron,
+    default_offset,
+    parse_field,
+)
+
+
+def dt(*args):
+    return datetime.datetime(*args)
+
+
+def test_parse_field():
+    assert parse_field("*", 0, 5) == 0b111111
+    assert parse_field("?", 0, 5) == 0b111111
+    assert parse_field("1,3", 0, 5) == 0b1010
+    assert parse_field("2-4", 0, 5) == 0b11100
+    assert parse_field("*/2", 0, 5) == 0b10101
+    assert parse_field("1/2", 0, 5) == 0b101010
+    assert parse_field("0-4/2", 0, 5) == 0b10101
+    assert parse_field("JAN,mar", 1, 12, {"JAN": 1, "MAR": 3}) == 0b1010
+
+
+@pytest.mark.parametrize(
+    "cronstr",
+    ["0 4 * *", "60 * * * *", "0 24 * * *", "0 0 0 * *", "0 0 * 13 *", "*/0 * * * *"],
+)
+def test_invalid(cronstr):
+    with pytest.raises(ValueError):
+        CronSchedule(cronstr)
+
+
+def test_minute_steps():
+    # */n on minutes used to be treated as hours
+    cron = CronSchedule("*/15 * * * ?")
+    assert cron.next_after(dt(2020, 1, 1, 0, 0)) == dt(2020, 1, 1, 0, 15)
+    assert cron.next_after(dt(2020, 1, 1, 0, 50)) == dt(2020, 1, 1, 1, 0)
+
+
+def test_months():
+    cron = CronSchedule("0 0 1 1,7 ?")
+    assert cron.next_after(dt(2020, 1, 1, 0, 0)) == dt(2020, 7, 1, 0, 0)
+    assert cron.next_after(dt(2020, 7, 1, 0, 0)) == dt(2021, 1, 1, 0, 0)
+    assert CronSchedule("30 6 * FEB *").next_after(dt(2020, 3, 1)) == dt(
+        2021, 2, 1, 6, 30
+    )
+
+
+def test_day_of_week():
+    # 2020-01-01 was a Wednesday
+    cron = CronSchedule("0 9 * * MON-FRI")
+    assert cron.next_after(dt(2020, 1, 3, 10, 0)) == dt(2020, 1, 6, 9, 0)
+    assert CronSchedule("0 0 * * 0").next_after(dt(2020, 1, 1)) == dt(2020, 1, 5)
+    assert CronSchedule("0 0 * * 7").next_after(dt(2020, 1, 1)) == dt(2020, 1, 5)
+
+
+def test_day_of_month_or_day_of_week():
+    # the 15th or any Monday
+    cron = CronSchedule("0 0 15 * 1")
+    assert cron.next_n(dt(2020, 1, 1), 4) == [
+        dt(2020, 1, 6),
+        dt(2020, 1, 13),
+        dt(2020, 1, 15),
+        dt(2020, 1, 20),
+    ]
+
+
+def test_leap_day():
+    cron = CronSchedule("0 0 29 2 ?")
+    assert cron.next_after(dt(2020, 3, 1)) == dt(2024, 2, 29)
+
+
+def test_never_matches():
+    with pytest.raises(ValueError):
+        CronSchedule("0 0 30 2 ?").next_after(dt(2020, 1, 1))
+
+
+def test_aliases():
+    assert CronSchedule("@daily").next_after(dt(2020, 1, 1, 3)) == dt(2020, 1, 2)
+    assert CronSchedule("@hourly").next_after(dt(2020, 1, 1, 3, 1)) == dt(2020, 1, 1, 4)
+
+
+def test_compile_cron_is_cached():
+    assert compile_cron("0 4 * * ?") is compile_cron("0 4 * * ?")
+
+
+def _matches(cronstr, when):
+    # slow reference implementation used to check next_after
+    minute, hour, dom, month, dow = cronstr.split()
+    cron = CronSchedule(cronstr)
+
+    def bit(bits, n):
+        return bool(bits >> n & 1)
+
+    dow_ok = bit(cron.dows, (when.weekday() + 1) % 7)
+    dom_ok = bit(cron.days, when.day)
+    if cron.dom_restricted and cron.dow_restricted:
+        day_ok = dow_ok or dom_ok
+    else:
+        day_ok = dow_ok and dom_ok
+    return (
+        bit(cron.minutes, when.minute)
+        and bit(cron.hours, when.hour)
+        and bit(cron.months, when.month)
+        and day_ok
+    )
+
+
+@pytest.mark.parametrize(
+    "cronstr", ["*/7 */5 * * ?", "15 3 */10 * ?", "0 12 * 2-3 SAT", "5 0 31 * 1"]
+)
+def test_against_reference(cronstr):
+    cron = CronSchedule(cronstr)
+    when = dt(2020, 1, 28, 0, 0)
+    expected = []
+    for n in range(1, 60 * 24 * 40):
+        candidate = when + datetime.timedelta(minutes=n)
+        if _matches(cronstr, candidate):
+            expected.append(candidate)
+            if len(expected) == 5:
+                break
+    assert cron.next_n(when, len(expected)) == expected
+
+
+def test_task_schedule_merges_triggers():
+    schedule = TaskSchedule(["0 4 * * ?", "30 */6 * * ?", "0 4 * * ?"])
+    assert schedule.next_after(dt(2020, 1, 1)) == dt(2020, 1, 1, 0, 30)
+    assert schedule.next_n(dt(2020, 1, 1), 5) == [
+        dt(2020, 1, 1, 0, 30),
+        dt(2020, 1, 1, 4, 0),
+        dt(2020, 1, 1, 6, 30),
+        dt(2020, 1, 1, 12, 30),
+        dt(2020, 1, 1, 18, 30),
+    ]
+
+
+def test_task_schedule_shared_times_once():
+    schedule = TaskSchedule(["0 * * * ?", "0 */2 * * ?"])
+    assert schedule.next_n(dt(2020, 1, 1), 3) == [
+        dt(2020, 1, 1, 1),
+        dt(2020, 1, 1, 2),
+        dt(2020, 1, 1, 3),
+    ]
+
+
+def test_task_schedule_for_task():
+    task = Task("t", "img", triggers=[Trigger("0 4 * * ?"), Trigger("0 16 * * ?")])
+    assert TaskSchedule.for_task(task).next_after(dt(2020, 1, 1, 5)) == dt(
+        2020, 1, 1, 16
+    )
+    assert not TaskSchedule.for_task(Task("t", "img"))
+    assert TaskSchedule.for_task(Task("t", "img")).next_after(dt(2020, 1, 1)) is None
+
+
+def test_task_schedule_window_offset():
+    task = Task(
+        "t",
+        "img",
+        triggers=[Trigger("0 * * * ?", window=20), Trigger("0 12 * * ?")],
+    )
+    schedule = TaskSchedule.for_task(task, 15)
+    assert schedule.next_n(dt(2020, 1, 1, 11, 20), 3) == [
+        dt(2020, 1, 1, 12, 0),
+        dt(2020, 1, 1, 12, 15),
+        dt(2020, 1, 1, 13, 15),
+    ]
+    assert schedule.next_after(dt(2020, 1, 1, 12, 10)) == dt(2020, 1, 1, 12, 15)
+    # offsets are clamped to the window
+    assert TaskSchedule.for_task(task, 45).next_after(dt(2020, 1, 1, 0, 0)) == dt(
+        2020, 1, 1, 0, 19
+    )
+    # without a planned offset a stable one is derived from the name
+    default = default_offset("t", 20)
+    assert 0 <= default < 20
+    assert TaskSchedule.for_task(task).next_after(dt(2020, 1, 1, 0, 0)) == dt(
+        2020, 1, 1, 0, default
+    )
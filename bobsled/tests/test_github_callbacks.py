@@ -14,20 +14,22 @@ async def test_github_on_error(mocker):
     storage.tasks["hello-world"] = Task(
         "hello-world", image="hello-world", error_threshold=3
     )
-    a = Run("hello-world", Status.Error)
-    b = Run("hello-world", Status.Error)
-    c = Run("hello-world", Status.Error)
-    d = Run("hello-world", Status.Error)
+
+    async def fail(day):
+        run = Run("hello-world", Status.Error, start=f"2020-01-{day:02d}T00:00:00")
+        await storage.add_run(run)
+        await storage.update_task_stats(run)
+        return run
 
     # 2 failures, no GH call
-    await storage.add_run(a)
-    await storage.add_run(b)
+    await fail(1)
+    b = await fail(2)
     await gh.on_error(b, storage)
     gh.make_issue.assert_not_called()
 
     # 4 failures, GH call
-    await storage.add_run(c)
-    await storage.add_run(d)
+    await fail(3)
+    d = await fail(4)
 
     # error threshold off, no error
     storage.tasks["hello-world"].error_threshold = 0
@@ -37,7 +39,30 @@ async def test_github_on_error(mocker):
     # back on, now this triggers an error
     storage.tasks["hello-world"].error_threshold = 3
     await gh.on_error(d, storage)
-    gh.make_issue.assert_called_once_with(d, 4, d)
+    gh.make_issue.assert_called_once_with(d, 4, "2020-01-01T00:00:00")
+
+
+@pytest.mark.asyncio
+async def test_github_on_error_high_threshold(mocker):
+    mocker.patch("github3.login")
+    gh = GithubIssueCallback(None, None, None)
+    mocker.patch.object(gh, "make_issue")
+
+    storage = InMemoryStorage()
+    storage.tasks["hello-world"] = Task(
+        "hello-world", image="hello-world", error_threshold=8
+    )
+    ok = Run("hello-world", Status.Success, start="2020-01-01T00:00:00")
+    await storage.add_run(ok)
+    await storage.update_task_stats(ok)
+    for day in range(2, 10):
+        run = Run("hello-world", Status.Error, start=f"2020-01-{day:02d}T00:00:00")
+        await storage.add_run(run)
+        await storage.update_task_stats(run)
+        await gh.on_error(run, storage)
+
+    # only once the streak reaches the threshold, which is above the old window of 5
+    gh.make_issue.assert_called_once_with(run, 8, "2020-01-02T00:00:00")
 
 
 @pytest.mark.asyncio
@@ -65,7 +90,7 @@ def test_make_issue(mocker):
         logs="\n".join(str(n) for n in range(100)),
         start="2020-01-01",
     )
-    gh.make_issue(run, 1, run)
+    gh.make_issue(run, 1, run.start)
 
     gh.repo_obj.create_issue.assert_called_once_with(
         title="hello-world failing since at least 2020-01-01",
@@ -0,0 +1,24 @@
+from ..logs import BLOCK_SIZE, compress_logs, iter_decompressed
+
+
+def test_roundtrip():
+    logs = "".join(f"scraped page {n}: ünïcödé ✓\n" for n in range(50000))
+    data = compress_logs(logs)
+    assert len(data) < len(logs) / 5
+    pieces = list(iter_decompressed(data))
+    # decompressed a block at a time
+    assert len(pieces) > 1
+    assert max(len(p) for p in pieces) <= BLOCK_SIZE
+    assert "".join(pieces) == logs
+
+
+def test_offset():
+    logs = "".join(f"line {n}\n" for n in range(100000))
+    data = compress_logs(logs)
+    for offset in (0, 1, BLOCK_SIZE - 1, BLOCK_SIZE, 300000, len(logs) - 1):
+        assert "".join(iter_decompressed(data, offset)) == logs[offset:]
+    assert list(iter_decompressed(data, len(logs))) == []
+
+
+def test_empty():
+    assert "".join(iter_decompressed(compress_logs(""))) == ""
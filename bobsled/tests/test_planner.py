@@ -0,0 +1,80 @@
+import datetime
+import pytest
+from ..base import Run, Status, Task, Trigger
+from ..cron import TaskSchedule
+from ..planner import LoadProfile, expected_durations, make_plan, run_minutes
+from ..storages import InMemoryStorage
+
+midnight = datetime.datetime(2020, 1, 1)
+
+
+def test_run_minutes():
+    run = Run(
+        "t", Status.Success, start="2020-01-01T00:00:00", end="2020-01-01T00:10:30"
+    )
+    assert run_minutes(run) == 11
+    run.end = "2020-01-01T00:00:05"
+    assert run_minutes(run) == 1
+
+
+@pytest.mark.asyncio
+async def test_expected_durations():
+    storage = InMemoryStorage()
+    for minutes, status in [
+        (5, Status.Success),
+        (30, Status.Error),
+        (7, Status.Success),
+        (9, Status.Success),
+    ]:
+        run = Run(
+            "t",
+            status,
+            start="2020-01-01T00:00:00",
+            end=f"2020-01-01T00:{minutes:02d}:00",
+        )
+        await storage.add_run(run)
+        await storage.update_task_stats(run)
+    # a task that has only failed has no duration estimate
+    run = Run("failing", Status.Error, start="2020-01-01", end="2020-01-01T00:01")
+    await storage.add_run(run)
+    await storage.update_task_stats(run)
+    assert await expected_durations(
+        storage, [Task("t", "img"), Task("new", "img"), Task("failing", "img")]
+    ) == {"t": 7}
+
+
+def test_load_profile_wraps():
+    profile = LoadProfile(midnight, 60)
+    profile.add(TaskSchedule(["50 * * * ?"]), 20)
+    assert profile.load[50:] == [1] * 10
+    assert profile.load[:10] == [1] * 10
+    assert profile.load[10] == 0
+    assert profile.cost(TaskSchedule(["55 * * * ?"]), 10) == (2, 10)
+
+
+def test_make_plan_spreads_windowed_tasks():
+    tasks = [
+        Task(f"scrape-{n}", "img", triggers=[Trigger("0 * * * ?", window=20)])
+        for n in range(4)
+    ]
+    durations = {t.name: 5 for t in tasks}
+    # everything is currently piled up on minute zero
+    plan = make_plan(tasks, durations, {t.name: 0 for t in tasks}, midnight)
+    assert plan.peak_before == 4
+    assert plan.peak_after == 1
+    assert sorted(plan.offsets.values()) == [0, 5, 10, 15]
+
+    # planning again from the result doesn't move anything
+    again = make_plan(tasks, durations, plan.offsets, midnight)
+    assert again.offsets == plan.offsets
+
+
+def test_make_plan_avoids_fixed_tasks():
+    tasks = [
+        Task("fixed", "img", triggers=[Trigger("0 * * * ?")]),
+        Task("flexible", "img", triggers=[Trigger("0 * * * ?", window=30)]),
+        Task("disabled", "img", enabled=False, triggers=[Trigger("0 * * * ?")]),
+    ]
+    plan = make_plan(tasks, {"fixed": 10, "flexible": 10}, {"flexible": 0}, midnight)
+    assert plan.offsets == {"flexible": 10}
+    assert (plan.peak_before, plan.peak_after) == (2, 1)
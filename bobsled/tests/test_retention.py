@@ -0,0 +1,73 @@
+import datetime
+import pytest
+from ..base import Run, Status
+from ..retention import Retention, RunArchive
+from ..storages import InMemoryStorage
+
+
+async def _storage():
+    s = InMemoryStorage()
+    for n in range(5):
+        run = Run("one", Status.Success, start=f"2020-01-0{n + 1}T00:00:00")
+        run.logs = f"run {n}\n"
+        await s.add_run(run)
+    await s.add_run(Run("two", Status.Error, start="2020-01-01T12:00:00"))
+    return s
+
+
+@pytest.mark.asyncio
+async def test_retention_disabled():
+    s = await _storage()
+    assert not Retention(s).enabled
+    assert await Retention(s).run() == 0
+    assert len(s.runs) == 6
+
+
+@pytest.mark.asyncio
+async def test_retention_archives_expired_runs(tmp_path):
+    s = await _storage()
+    retention = Retention(
+        s,
+        BOBSLED_RETAIN_RUNS_PER_TASK="2",
+        BOBSLED_RETAIN_DAYS="2",
+        BOBSLED_ARCHIVE_DIR=str(tmp_path),
+    )
+    retention.BATCH_SIZE = 1
+    now = datetime.datetime(2020, 1, 4, 6)
+    assert await retention.run(now) == 2
+    # the two latest runs of each task and everything since the 2nd are kept
+    assert sorted(r.start for r in s.runs) == [
+        "2020-01-01T12:00:00",
+        "2020-01-03T00:00:00",
+        "2020-01-04T00:00:00",
+        "2020-01-05T00:00:00",
+    ]
+    assert len(list(tmp_path.iterdir())) == 2
+    assert await retention.run(now) == 0
+
+    archive = RunArchive(str(tmp_path))
+    one = list(archive.iter_runs(task_name="one"))
+    assert [r.logs for r in one] == ["run 0\n", "run 1\n"]
+    assert all(r.status == Status.Success for r in one)
+    assert list(archive.iter_runs(task_name="two")) == []
+    assert list(archive.iter_runs(after="2020-01-01T06:00:00")) == one[1:]
+    assert list(archive.iter_runs(before="2020-01-01T06:00:00")) == one[:1]
+    assert archive.get_run(one[0].uuid) == one[0]
+
+
+@pytest.mark.asyncio
+async def test_retention_without_archive():
+    s = await _storage()
+    retention = Retention(s, BOBSLED_RETAIN_RUNS_PER_TASK="1")
+    assert await retention.run() == 4
+    assert sorted(r.task for r in s.runs) == ["one", "two"]
+
+
+@pytest.mark.asyncio
+async def test_retention_max_batches():
+    s = await _storage()
+    retention = Retention(s, BOBSLED_RETAIN_RUNS_PER_TASK="1")
+    retention.BATCH_SIZE = 1
+    assert await retention.run(max_batches=3) == 3
+    assert await retention.run(max_batches=3) == 1
+    assert sorted(r.task for r in s.runs) == ["one", "two"]
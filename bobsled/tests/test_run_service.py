@@ -1,10 +1,12 @@
 import os
+import datetime
 import time
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import asyncio
 import pytest
 import boto3
-from ..base import Task, Status
+import docker
+from ..base import Run, Task, Status
 from ..storages import InMemoryStorage
 from ..runners import LocalRunService, ECSRunService
 from ..tasks import TaskProvider
@@ -212,6 +214,59 @@ async def test_callback_on_error():
     callback.on_error.assert_called_once_with(run, rs.storage)
 
 
+@pytest.mark.asyncio
+async def test_missing_container():
+    with patch("docker.from_env"):
+        rs = local_run_service()
+    rs.client.containers.get.side_effect = docker.errors.NotFound("gone")
+    rs.tracks_timeouts = True
+    task = Task("hello-world", image="hello-world", timeout_minutes=5)
+    await rs.storage.set_tasks([task])
+    run = await rs.run_task(task)
+    assert len(rs.timeouts) == 1
+
+    # finished like any other run
+    run = await rs.update_status(run.uuid)
+    assert run.status == Status.Missing
+    assert run.end
+    assert len(rs.timeouts) == 0
+    stats = (await rs.storage.get_task_stats())["hello-world"]
+    assert stats.last_status == Status.Missing
+
+
+@pytest.mark.asyncio
+async def test_claimed_run_not_missing():
+    with patch("docker.from_env"):
+        rs = local_run_service()
+    run = Run("hello-world", Status.Queued, run_info={"queued_at": "2020-01-01"})
+    await rs.storage.add_run(run)
+    # claimed by a dispatch in another process, which hasn't started it yet
+    claimed_at = datetime.datetime.utcnow().isoformat()
+    await rs.storage.claim_run(
+        run.uuid, Status.Queued, Status.Pending, {"claimed_at": claimed_at}
+    )
+    run = await rs.update_status(run.uuid)
+    assert run.status == Status.Pending
+    rs.client.containers.get.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_stale_claim_missing():
+    with patch("docker.from_env"):
+        rs = local_run_service()
+    run = Run("hello-world", Status.Queued, run_info={"queued_at": "2020-01-01"})
+    await rs.storage.add_run(run)
+    # the process that claimed it died before starting it
+    await rs.storage.claim_run(
+        run.uuid, Status.Queued, Status.Pending, {"claimed_at": "2020-01-01"}
+    )
+    run = await rs.update_status(run.uuid)
+    assert run.status == Status.Missing
+    assert run.end
+    assert (await rs.storage.get_run(run.uuid)).status == Status.Missing
+    rs.client.containers.get.assert_not_called()
+
+
 def test_ecs_initialize():
     ENV_FILE = os.path.join(os.path.dirname(__file__), "tasks/tasks.yml")
     storage = InMemoryStorage()
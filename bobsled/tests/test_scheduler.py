@@ -0,0 +1,47 @@
+from ..scheduler import DeadlineQueue
+
+
+def test_pop_due_in_order():
+    q = DeadlineQueue()
+    q.push("c", 30)
+    q.push("a", 10)
+    q.push("b", 20)
+    assert len(q) == 3
+    assert q.peek() == 10
+    assert q.pop_due(5) == []
+    assert q.pop_due(20) == [("a", 10), ("b", 20)]
+    assert len(q) == 1
+    assert q.peek() == 30
+
+
+def test_push_replaces_deadline():
+    q = DeadlineQueue()
+    q.push("a", 10)
+    q.push("b", 20)
+    q.push("a", 30)
+    assert len(q) == 2
+    assert q.get("a") == 30
+    assert q.pop_due(25) == [("b", 20)]
+    assert q.pop_due(100) == [("a", 30)]
+    assert q.peek() is None
+
+
+def test_remove():
+    q = DeadlineQueue()
+    q.push("a", 10)
+    q.push("b", 20)
+    q.remove("a")
+    q.remove("missing")
+    assert "a" not in q
+    assert q.peek() == 20
+    assert q.pop_due(100) == [("b", 20)]
+
+
+def test_many_removes_compact_heap():
+    q = DeadlineQueue()
+    for n in range(1000):
+        q.push(n, n)
+    for n in range(999):
+        q.remove(n)
+    assert len(q._heap) < 1000
+    assert q.pop_due(1000) == [(999, 999)]
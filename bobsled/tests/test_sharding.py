@@ -0,0 +1,23 @@
+from ..sharding import HashRing
+
+
+def test_ring_owner_is_stable():
+    keys = [f"task{n}" for n in range(100)]
+    ring = HashRing(["a", "b", "c"])
+    assert [ring.owner(k) for k in keys] == [
+        HashRing(["c", "b", "a"]).owner(k) for k in keys
+    ]
+    assert {ring.owner(k) for k in keys} == {"a", "b", "c"}
+
+
+def test_ring_member_leaving_moves_only_its_keys():
+    keys = [f"task{n}" for n in range(100)]
+    before = HashRing(["a", "b", "c"])
+    after = HashRing(["a", "b"])
+    for key in keys:
+        if before.owner(key) != "c":
+            assert after.owner(key) == before.owner(key)
+
+
+def test_empty_ring():
+    assert HashRing([]).owner("task") is None
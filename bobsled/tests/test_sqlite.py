@@ -0,0 +1,68 @@
+import os
+import asyncio
+import tempfile
+import pytest
+from ..base import Run, Status, Task
+from ..storages import SQLiteStorage
+from ..storages.database import Tasks
+
+
+async def _storage(readers=2):
+    s = SQLiteStorage(
+        "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bobsled.db"),
+        BOBSLED_SQLITE_READERS=readers,
+    )
+    await s.connect()
+    await s.set_tasks([Task("one", "image")])
+    return s
+
+
+@pytest.mark.asyncio
+async def test_wal_enabled():
+    s = await _storage()
+    assert await s.database.fetch_val("PRAGMA journal_mode") == "wal"
+
+
+@pytest.mark.asyncio
+async def test_reads_not_blocked_by_writer():
+    s = await _storage()
+    in_transaction = asyncio.Event()
+    finish = asyncio.Event()
+
+    async def write():
+        async with s.database.transaction():
+            await s.database.execute(Tasks.update().values(image="new"))
+            in_transaction.set()
+            await finish.wait()
+
+    writer = asyncio.ensure_future(write())
+    await in_transaction.wait()
+    # the uncommitted change isn't seen, and reading doesn't wait for it
+    task = await asyncio.wait_for(s.get_task("one"), 1)
+    assert task.image == "image"
+    finish.set()
+    await writer
+    assert (await s.get_task("one")).image == "new"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_writes_serialized():
+    s = await _storage(readers=1)
+    runs = [Run("one", Status.Running, logs=f"{n}\n") for n in range(20)]
+    await asyncio.gather(*[s.add_run(run) for run in runs])
+    for run in runs:
+        run.status = Status.Success
+    await asyncio.gather(*[s.save_run(run) for run in runs], s.get_runs(), s.get_runs())
+    assert len(await s.get_runs(status=Status.Success)) == 20
+    assert await s.get_logs(runs[7].uuid) == "7\n"
+
+
+@pytest.mark.asyncio
+async def test_failed_transaction_releases_writer():
+    s = await _storage()
+    with pytest.raises(ValueError):
+        async with s.database.transaction():
+            await s.database.execute(Tasks.update().values(image="new"))
+            raise ValueError()
+    await asyncio.wait_for(s.set_tasks([Task("two", "image")]), 1)
+    assert [t.name for t in await s.get_tasks()] == ["two"]
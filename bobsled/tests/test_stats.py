@@ -0,0 +1,87 @@
+import random
+import pytest
+from ..base import Run, Status, Task
+from ..stats import P2Quantile, TaskStats
+from .test_admission import FakeRunService
+
+
+def test_p2_quantile_small_counts():
+    estimate = P2Quantile(0.5)
+    assert estimate.value is None
+    for x in (5, 1, 3):
+        estimate.add(x)
+    assert estimate.count == 3
+    assert estimate.value == 3
+
+
+@pytest.mark.parametrize("p", [0.5, 0.9, 0.99])
+def test_p2_quantile_accuracy(p):
+    rand = random.Random(1)
+    values = [rand.expovariate(1 / 60) for _ in range(5000)]
+    estimate = P2Quantile(p)
+    for x in values:
+        estimate.add(x)
+    exact = sorted(values)[int(p * len(values))]
+    assert estimate.count == 5000
+    assert abs(estimate.value - exact) / exact < 0.05
+
+    # survives a round trip through storage
+    restored = P2Quantile.from_dict(estimate.to_dict())
+    restored.add(1)
+    estimate.add(1)
+    assert restored.value == estimate.value
+
+
+def _run(status, day, minutes=1):
+    return Run(
+        "t",
+        status,
+        start=f"2020-01-{day:02d}T00:00:00",
+        end=f"2020-01-{day:02d}T00:{minutes:02d}:00",
+    )
+
+
+def test_task_stats_record():
+    stats = TaskStats("t")
+    for day, status in enumerate(
+        [Status.Success, Status.Error, Status.Error, Status.Success, Status.Error],
+        start=1,
+    ):
+        run = _run(status, day, minutes=day)
+        assert stats.record(run)
+    # recorded once
+    assert not stats.record(run)
+    assert not stats.record(Run("t", Status.Running))
+
+    assert stats.runs == 5
+    assert stats.success_rate == 0.4
+    assert stats.last_status == Status.Error
+    assert stats.consecutive_failures == 1
+    assert stats.failing_since == "2020-01-05T00:00:00"
+    # only successful runs' durations
+    assert stats.duration(0.5) in (60, 240)
+    with pytest.raises(ValueError):
+        stats.duration(0.75)
+
+    stats.record(_run(Status.Error, 6))
+    assert stats.consecutive_failures == 2
+    assert stats.failing_since == "2020-01-05T00:00:00"
+    stats.record(_run(Status.TimedOut, 7))
+    assert stats.consecutive_failures == 0
+    assert stats.to_dict()["last_status"] == "TimedOut"
+
+
+@pytest.mark.asyncio
+async def test_stats_updated_when_runs_finish():
+    rs = FakeRunService()
+    await rs.storage.set_tasks([Task("t", "img")])
+    run = await rs.run_task(Task("t", "img"))
+    assert await rs.storage.get_task_stats() == {}
+    await rs.finish(run)
+    stats = (await rs.storage.get_task_stats())["t"]
+    assert (stats.runs, stats.last_status) == (1, Status.Success)
+
+    run = await rs.run_task(Task("t", "img"))
+    await rs.stop_run(run.uuid)
+    stats = (await rs.storage.get_task_stats(["t"]))["t"]
+    assert (stats.runs, stats.last_status) == (2, Status.UserKilled)
@@ -1,8 +1,22 @@
 import os
+import datetime
+import tempfile
+import sqlalchemy
 import pytest
-from ..storages import InMemoryStorage, DatabaseStorage
-from ..base import Run, Status, Task, Trigger
-from ..storages.database import Tasks, Runs, Users
+from ..storages import InMemoryStorage, DatabaseStorage, SQLiteStorage
+from ..storages.migrations import MIGRATIONS, current_version
+from ..base import Run, ScheduleState, Status, Task, Trigger
+from ..storages.database import (
+    _run_to_db,
+    Leases,
+    RunLogs,
+    Runs,
+    ScheduleOffsets,
+    ScheduleStates,
+    Tasks,
+    TaskStatsTable,
+    Users,
+)
 
 
 async def mem_storage():
@@ -17,15 +31,41 @@ async def db_storage():
         )
     )
     await db.connect()
-    await db.database.execute(Runs.delete())
-    await db.database.execute(Tasks.delete())
-    await db.database.execute(Users.delete())
+    for table in (
+        RunLogs,
+        Runs,
+        Tasks,
+        Users,
+        ScheduleStates,
+        ScheduleOffsets,
+        Leases,
+        TaskStatsTable,
+    ):
+        await db.database.execute(table.delete())
     names = ["test-task", "stopped", "running", "running too", "one", "two", "three"]
     await db.set_tasks([Task(name, "image") for name in names])
     return db
 
 
-@pytest.mark.parametrize("storage", [mem_storage, db_storage])
+async def sqlite_storage():
+    db = DatabaseStorage("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bobsled.db"))
+    await db.connect()
+    names = ["test-task", "stopped", "running", "running too", "one", "two", "three"]
+    await db.set_tasks([Task(name, "image") for name in names])
+    return db
+
+
+async def tuned_sqlite_storage():
+    db = SQLiteStorage("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bobsled.db"))
+    await db.connect()
+    names = ["test-task", "stopped", "running", "running too", "one", "two", "three"]
+    await db.set_tasks([Task(name, "image") for name in names])
+    return db
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
 @pytest.mark.asyncio
 async def test_simple_add_then_get(storage):
     p = await storage()
@@ -37,7 +77,9 @@ async def test_simple_add_then_get(storage):
     assert r.status == r2.status
 
 
-@pytest.mark.parametrize("storage", [mem_storage, db_storage])
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
 @pytest.mark.asyncio
 async def test_update(storage):
     p = await storage()
@@ -51,7 +93,9 @@ async def test_update(storage):
     assert r2.exit_code == 0
 
 
-@pytest.mark.parametrize("storage", [mem_storage, db_storage])
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
 @pytest.mark.asyncio
 async def test_bad_get(storage):
     p = await storage()
@@ -59,7 +103,9 @@ async def test_bad_get(storage):
     assert r is None
 
 
-@pytest.mark.parametrize("storage", [mem_storage, db_storage])
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
 @pytest.mark.asyncio
 async def test_get_runs(storage):
     p = await storage()
@@ -77,7 +123,9 @@ async def test_get_runs(storage):
     assert [r.task for r in await p.get_runs()] == ["stopped", "running too", "running"]
 
 
-@pytest.mark.parametrize("storage", [mem_storage, db_storage])
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
 @pytest.mark.asyncio
 async def test_get_runs_latest_n(storage):
     p = await storage()
@@ -91,7 +139,9 @@ async def test_get_runs_latest_n(storage):
     assert latest_one[0].task == "three"
 
 
-@pytest.mark.parametrize("storage", [mem_storage, db_storage])
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
 @pytest.mark.asyncio
 async def test_task_storage(storage):
     s = await storage()
@@ -106,6 +156,7 @@ async def test_task_storage(storage):
             cpu=512,
             enabled=False,
             timeout_minutes=60,
+            priority=5,
             triggers=[Trigger(cron="@daily")],
             next_tasks=["two"],
         ),
@@ -120,7 +171,9 @@ async def test_task_storage(storage):
     assert task == tasks[0]
 
 
-@pytest.mark.parametrize("storage", [mem_storage, db_storage])
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
 @pytest.mark.asyncio
 async def test_task_storage_updates(storage):
     s = await storage()
@@ -137,7 +190,9 @@ async def test_task_storage_updates(storage):
     assert task == tasks[0]
 
 
-@pytest.mark.parametrize("storage", [mem_storage, db_storage])
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
 @pytest.mark.asyncio
 async def test_user_storage(storage):
     s = await storage()
@@ -162,3 +217,568 @@ async def test_user_storage(storage):
     assert user.username == "someone"
     assert "argon2" in user.password_hash
     assert user.permissions == ["admin"]
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_schedule_state_storage(storage):
+    s = await storage()
+    assert await s.get_schedule_states() == {}
+
+    jan1 = datetime.datetime(2020, 1, 1, 4)
+    jan2 = datetime.datetime(2020, 1, 2, 4)
+    await s.set_schedule_states(
+        [ScheduleState("one", next_run=jan1), ScheduleState("two", jan1, jan2)]
+    )
+    states = await s.get_schedule_states()
+    assert states == {
+        "one": ScheduleState("one", None, jan1),
+        "two": ScheduleState("two", jan1, jan2),
+    }
+
+    # update existing
+    await s.set_schedule_states([ScheduleState("one", jan1, jan2)])
+    states = await s.get_schedule_states()
+    assert states["one"] == ScheduleState("one", jan1, jan2)
+    assert len(states) == 2
+
+    # existing and new rows together
+    await s.set_schedule_states(
+        [ScheduleState("two", jan2, jan2), ScheduleState("three", jan1, jan2)]
+    )
+    states = await s.get_schedule_states()
+    assert states["two"] == ScheduleState("two", jan2, jan2)
+    assert states["three"] == ScheduleState("three", jan1, jan2)
+    assert len(states) == 3
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_schedule_offset_storage(storage):
+    s = await storage()
+    assert await s.get_schedule_offsets() == {}
+    await s.set_schedule_offsets({"one": 5, "two": 10})
+    await s.set_schedule_offsets({"one": 15})
+    assert await s.get_schedule_offsets() == {"one": 15, "two": 10}
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_leases(storage):
+    s = await storage()
+    assert await s.acquire_lease("beat:a", "a", 10)
+    assert await s.acquire_lease("beat:b", "b", 10)
+    assert await s.acquire_lease("leader", "a", 10)
+    # held by someone else
+    assert not await s.acquire_lease("leader", "b", 10)
+    # renewing our own lease
+    assert await s.acquire_lease("leader", "a", 10)
+    assert await s.get_leases("beat:") == {"beat:a": "a", "beat:b": "b"}
+
+    # only the holder can release
+    await s.release_lease("leader", "b")
+    assert not await s.acquire_lease("leader", "b", 10)
+    await s.release_lease("leader", "a")
+    assert await s.acquire_lease("leader", "b", 10)
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_expired_lease(storage):
+    s = await storage()
+    assert await s.acquire_lease("beat:a", "a", -1)
+    assert await s.get_leases("beat:") == {}
+    assert await s.acquire_lease("beat:a", "b", 10)
+    assert await s.get_leases("beat:") == {"beat:a": "b"}
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_get_active_runs(storage):
+    s = await storage()
+    await s.add_run(Run("running", Status.Running))
+    await s.add_run(Run("running too", Status.Running))
+    await s.add_run(Run("one", Status.Queued, run_info={"queued_at": "x"}))
+    await s.add_run(Run("stopped", Status.Success))
+
+    active = await s.get_active_runs()
+    assert active.counts == {Status.Queued: 1, Status.Pending: 0, Status.Running: 2}
+    assert {r.task for r in active.with_status(Status.Running)} == {
+        "running",
+        "running too",
+    }
+
+
+@pytest.mark.parametrize("storage", [db_storage, sqlite_storage, tuned_sqlite_storage])
+@pytest.mark.asyncio
+async def test_set_tasks_bulk_upsert(storage):
+    s = await storage()
+    # more tasks than fit in a single insert batch
+    tasks = [Task(f"task{n}", "img", tags=["t"]) for n in range(150)]
+    await s.set_tasks(tasks)
+    assert len(await s.get_tasks()) == 150
+
+    # unchanged tasks aren't rewritten, so an out of band edit survives
+    await s.database.execute(
+        Tasks.update().where(Tasks.c.name == "task1").values(image="edited")
+    )
+    tasks[2] = Task("task2", "newimg")
+    await s.set_tasks(tasks[:100])
+    assert len(await s.get_tasks()) == 100
+    assert (await s.get_task("task1")).image == "edited"
+    assert (await s.get_task("task2")).image == "newimg"
+
+
+@pytest.mark.asyncio
+async def test_migrate_existing_database():
+    # a database created by create_all before priority and content_hash existed
+    uri = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "old.db")
+    engine = sqlalchemy.create_engine(uri)
+    engine.execute(
+        "CREATE TABLE bobsled_task (name VARCHAR(100) PRIMARY KEY, image VARCHAR(100), "
+        "tags JSON, entrypoint JSON, environment VARCHAR(100), memory INTEGER, "
+        "cpu INTEGER, enabled BOOLEAN, timeout_minutes INTEGER, "
+        "error_threshold INTEGER, triggers JSON, next_tasks JSON)"
+    )
+    engine.execute(
+        "INSERT INTO bobsled_task (name, image, tags, triggers, next_tasks) "
+        "VALUES ('old', 'img', '[]', '[]', '[]')"
+    )
+
+    s = DatabaseStorage(uri)
+    await s.connect()
+    with engine.connect() as conn:
+        assert current_version(conn) == len(MIGRATIONS)
+        indexes = {
+            i["name"] for i in sqlalchemy.inspect(conn).get_indexes("bobsled_run")
+        }
+    assert "ix_bobsled_run_task_start" in indexes
+    # existing tasks get the default priority
+    assert (await s.get_task("old")).priority == 0
+    await s.set_tasks([Task("old", "img", priority=3)])
+    assert (await s.get_task("old")).priority == 3
+
+    # nothing left to do the second time
+    await DatabaseStorage(uri).connect()
+    with engine.connect() as conn:
+        assert current_version(conn) == len(MIGRATIONS)
+
+
+@pytest.mark.asyncio
+async def test_migrate_run_times():
+    # runs from before start and end were timestamps
+    uri = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "old.db")
+    engine = sqlalchemy.create_engine(uri)
+    engine.execute(
+        "CREATE TABLE bobsled_run (uuid VARCHAR(50) PRIMARY KEY, status VARCHAR(50), "
+        'task VARCHAR(100), start VARCHAR(50), "end" VARCHAR(50), logs VARCHAR, '
+        "exit_code INTEGER, run_info_json JSON)"
+    )
+    engine.execute(
+        "INSERT INTO bobsled_run VALUES ('a', 'Success', 'old', "
+        "'2020-01-01T00:00:00', '2020-01-01T00:01:30.500000', '', 0, '\"{}\"'), "
+        "('b', 'Running', 'old', '2020-01-02T00:00:00', '', '', NULL, '\"{}\"')"
+    )
+
+    s = DatabaseStorage(uri)
+    await s.connect()
+    finished = await s.get_run("a")
+    assert finished.end == "2020-01-01T00:01:30.500000"
+    assert finished.duration_seconds == 90.5
+    running = await s.get_run("b")
+    assert (running.end, running.duration_seconds) == ("", None)
+    assert await s.get_runs(after=("2020-01-01T12:00:00", "")) == [running]
+
+
+async def _explain(s, query):
+    dialect = sqlalchemy.create_engine(str(s.database.url)).dialect
+    sql = str(query.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+    async with s.database.connection() as conn:
+        if dialect.name == "postgresql":
+            await conn.execute("ANALYZE bobsled_run")
+            # with a seeded table this small a scan is cheaper, check an index fits
+            await conn.execute("SET enable_seqscan = off")
+            try:
+                rows = await conn.fetch_all("EXPLAIN " + sql)
+            finally:
+                await conn.execute("SET enable_seqscan = on")
+        else:
+            rows = await conn.fetch_all("EXPLAIN QUERY PLAN " + sql)
+    return "\n".join(str(list(row.values())) for row in rows)
+
+
+@pytest.mark.parametrize("storage", [db_storage, sqlite_storage, tuned_sqlite_storage])
+@pytest.mark.asyncio
+async def test_run_query_plans(storage):
+    s = await storage()
+    names = [f"task{n}" for n in range(20)]
+    await s.set_tasks([Task(name, "image") for name in names])
+    runs = [
+        Run(
+            names[n % 20],
+            Status.Success if n % 50 else Status.Running,
+            start=f"2020-01-01T00:{n // 60 % 60:02d}:{n % 60:02d}",
+        )
+        for n in range(2000)
+    ]
+    for start in range(0, len(runs), 100):
+        await s.database.execute(
+            Runs.insert().values([_run_to_db(r) for r in runs[start : start + 100]])
+        )
+
+    plan = await _explain(s, s._runs_query(task_name="task3", latest=10))
+    assert "ix_bobsled_run_task_start" in plan
+    plan = await _explain(s, s._runs_query(status=Status.Running))
+    assert "ix_bobsled_run_status_start" in plan
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_logs_appended(storage):
+    s = await storage()
+    run = Run("running", Status.Running, logs="line one\nline t")
+    await s.add_run(run)
+    # a partial line isn't stored until it is finished
+    assert await s.get_logs(run.uuid) == "line one\n"
+
+    run.logs = "line one\nline two\nline three\n"
+    await s.save_run(run)
+    assert await s.get_logs(run.uuid) == run.logs
+    assert await s.get_logs(run.uuid, offset=9) == "line two\nline three\n"
+    assert await s.get_logs(run.uuid, offset=12) == "e two\nline three\n"
+
+    # a stale copy of the run saving the same output doesn't duplicate it
+    stale = Run("running", Status.Running, logs="line one\nline two\n", uuid=run.uuid)
+    await s.save_run(stale)
+    assert await s.append_logs(run.uuid, "line one\n") == len(run.logs)
+
+    run.logs += "done"
+    run.status = Status.Success
+    await s.save_run(run)
+    assert (await s.get_run(run.uuid)).logs == run.logs
+    assert await s.get_logs(run.uuid, offset=len(run.logs)) == ""
+
+
+@pytest.mark.parametrize("storage", [db_storage, sqlite_storage, tuned_sqlite_storage])
+@pytest.mark.asyncio
+async def test_logs_written_incrementally(storage):
+    s = await storage()
+    run = Run("running", Status.Running)
+    await s.add_run(run)
+    for n in range(5):
+        run.logs += f"line {n}\n"
+        await s.save_run(run)
+    rows = await s.database.fetch_all(
+        RunLogs.select().where(RunLogs.c.run == run.uuid).order_by(RunLogs.c.position)
+    )
+    # each save wrote just the new line
+    assert [r["text"] for r in rows] == [f"line {n}\n" for n in range(5)]
+    assert [r["position"] for r in rows] == [0, 7, 14, 21, 28]
+
+
+@pytest.mark.parametrize("storage", [db_storage, sqlite_storage, tuned_sqlite_storage])
+@pytest.mark.asyncio
+async def test_finished_logs_compressed(storage):
+    s = await storage()
+    run = Run("running", Status.Running, logs="fetching\n" * 1000)
+    await s.add_run(run)
+    run.status = Status.Success
+    await s.save_run(run)
+
+    row = await s.database.fetch_one(Runs.select().where(Runs.c.uuid == run.uuid))
+    assert len(row["logs_zlib"]) < 100
+    chunks = await s.database.fetch_all(
+        RunLogs.select().where(RunLogs.c.run == run.uuid)
+    )
+    assert chunks == []
+    assert (await s.get_run(run.uuid)).logs == run.logs
+    assert [text async for text in s.iter_logs(run.uuid, offset=8991)] == ["fetching\n"]
+
+    # saving it again doesn't add anything
+    await s.save_run(run)
+    assert await s.get_logs(run.uuid) == run.logs
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_get_runs_pages(storage):
+    s = await storage()
+    runs = [
+        Run("one", Status.Success, start=f"2020-01-01T00:00:{n // 2:02d}")
+        for n in range(10)
+    ]
+    for run in runs:
+        await s.add_run(run)
+    runs.sort(key=lambda r: (r.start, r.uuid))
+
+    page = await s.get_runs(latest=4)
+    assert page == runs[6:]
+    # runs with the same start are split by uuid
+    cursor = (page[0].start, page[0].uuid)
+    page = await s.get_runs(latest=4, before=cursor)
+    assert page == runs[2:6]
+    page = await s.get_runs(latest=4, before=(page[0].start, page[0].uuid))
+    assert page == runs[:2]
+
+    # and back again
+    assert await s.get_runs(latest=4, after=(runs[1].start, runs[1].uuid)) == runs[2:6]
+    assert await s.get_runs(after=cursor) == runs[7:]
+    assert await s.get_runs(task_name="two", before=cursor) == []
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_get_latest_runs(storage):
+    s = await storage()
+    for n in range(6):
+        await s.add_run(Run("one", Status.Success, start=f"2020-01-01T00:00:0{n}"))
+    for n in range(2):
+        await s.add_run(Run("two", Status.Error, start=f"2020-01-02T00:00:0{n}"))
+    # a queued run that starts later moves to its new place
+    queued = Run("two", Status.Queued, start="2020-01-01T00:00:00")
+    await s.add_run(queued)
+    queued.status = Status.Running
+    queued.start = "2020-01-03T00:00:00"
+    await s.save_run(queued)
+
+    latest = await s.get_latest_runs(3)
+    assert set(latest) == {"one", "two"}
+    assert [r.start[-2:] for r in latest["one"]] == ["03", "04", "05"]
+    assert [r.status for r in latest["two"]] == [
+        Status.Error,
+        Status.Error,
+        Status.Running,
+    ]
+    assert await s.get_latest_runs(1, task_names=["two", "three"]) == {"two": [queued]}
+
+
+@pytest.mark.asyncio
+async def test_memory_storage_indexes():
+    s = InMemoryStorage()
+    s.TASK_INDEX_SIZE = 3
+    runs = [
+        Run("one", Status.Success, start=f"2020-01-01T00:00:{n:02d}") for n in range(10)
+    ]
+    # added out of order
+    for run in reversed(runs):
+        await s.add_run(run)
+    # finished runs are kept as a copy
+    assert await s.get_run(runs[4].uuid) == runs[4]
+    assert await s.get_runs(task_name="one", latest=2) == runs[8:]
+    # past what the task index holds
+    assert await s.get_runs(task_name="one", latest=5) == runs[5:]
+    assert len(await s.get_runs(task_name="one")) == 10
+
+    runs[9].status = Status.Running
+    await s.save_run(runs[9])
+    assert await s.get_runs(status=Status.Running) == [runs[9]]
+    assert len(await s.get_runs(status=Status.Success)) == 9
+
+    # a newer start moves a run to the end of its task's index
+    runs[0].start = "2020-01-02T00:00:00"
+    await s.save_run(runs[0])
+    assert (await s.get_latest_runs(2))["one"] == [runs[9], runs[0]]
+
+
+@pytest.mark.asyncio
+async def test_memory_storage_finished_logs():
+    s = InMemoryStorage()
+    run = Run("one", Status.Running, start="2020-01-01T00:00:00")
+    await s.add_run(run)
+    run.logs = "x" * 10000
+    await s.save_run(run)
+    assert await s.get_run(run.uuid, logs=False) is run
+
+    run.status = Status.Success
+    await s.save_run(run)
+    # the caller's run is left alone, storage only keeps the compressed logs
+    assert run.logs == "x" * 10000
+    stored = await s.get_run(run.uuid, logs=False)
+    assert stored.logs == ""
+    assert stored.status == Status.Success
+    assert (await s.get_runs(status=Status.Success))[0].logs == ""
+    assert (await s.get_run(run.uuid)).logs == "x" * 10000
+    assert len(s.compressed_logs[run.uuid]) < 100
+
+
+@pytest.mark.asyncio
+async def test_memory_storage_assign_runs():
+    s = InMemoryStorage()
+    s.runs = [Run("one", Status.Running), Run("two", Status.Success)]
+    assert (await s.get_active_runs()).counts[Status.Running] == 1
+    assert set(await s.get_latest_runs(5)) == {"one", "two"}
+    assert len(s.runs) == 2
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_expired_runs(storage):
+    s = await storage()
+    one = [
+        Run("one", Status.Success, start=f"2020-01-0{n + 1}T00:00:00") for n in range(5)
+    ]
+    two = [
+        Run("two", Status.Error, start=f"2020-01-0{n + 1}T12:00:00") for n in range(2)
+    ]
+    # active runs are never expired
+    running = Run("one", Status.Running, start="2019-12-31T00:00:00")
+    for run in one + two + [running]:
+        await s.add_run(run)
+
+    expired = await s.get_expired_runs(keep_latest=2)
+    assert [r.uuid for r in expired] == [r.uuid for r in one[:3]]
+    expired = await s.get_expired_runs(older_than="2020-01-02T06:00:00")
+    assert [r.uuid for r in expired] == [one[0].uuid, two[0].uuid, one[1].uuid]
+    # kept if either rule keeps it
+    expired = await s.get_expired_runs(keep_latest=2, older_than="2020-01-03T06:00:00")
+    assert [r.uuid for r in expired] == [one[0].uuid, one[1].uuid, one[2].uuid]
+    assert len(await s.get_expired_runs(keep_latest=1, limit=2)) == 2
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_duration_stats(storage):
+    s = await storage()
+    for n in range(3):
+        run = Run("one", Status.Running, start=f"2020-01-0{n + 1}T00:00:00")
+        await s.add_run(run)
+        run.status = Status.Success if n else Status.Error
+        run.end = f"2020-01-0{n + 1}T00:0{n + 1}:00"
+        await s.save_run(run)
+        assert run.duration_seconds == (n + 1) * 60
+    await s.add_run(Run("two", Status.Running, start="2020-01-01T00:00:00"))
+
+    assert await s.get_duration_stats() == {
+        "one": {"runs": 3, "mean_seconds": 120, "max_seconds": 180}
+    }
+    stats = await s.get_duration_stats(
+        status=Status.Success, since="2020-01-02T12:00:00"
+    )
+    assert stats == {"one": {"runs": 1, "mean_seconds": 180, "max_seconds": 180}}
+    assert await s.get_duration_stats(task_names=["two"]) == {}
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_delete_runs(storage):
+    s = await storage()
+    runs = [
+        Run("one", Status.Success, start=f"2020-01-01T00:00:0{n}") for n in range(4)
+    ]
+    runs[3].status = Status.Running
+    runs[3].logs = "partial\n"
+    for run in runs:
+        await s.add_run(run)
+
+    await s.delete_runs([runs[0].uuid, runs[3].uuid])
+    assert await s.get_run(runs[0].uuid) is None
+    assert await s.get_logs(runs[3].uuid) == ""
+    assert [r.uuid for r in await s.get_runs(task_name="one")] == [
+        runs[1].uuid,
+        runs[2].uuid,
+    ]
+    assert (await s.get_active_runs()).counts[Status.Running] == 0
+
+
+@pytest.mark.asyncio
+async def test_memory_delete_refills_task_index():
+    s = InMemoryStorage()
+    s.TASK_INDEX_SIZE = 3
+    runs = [
+        Run("one", Status.Success, start=f"2020-01-01T00:00:0{n}") for n in range(5)
+    ]
+    for run in runs:
+        await s.add_run(run)
+    await s.delete_runs([r.uuid for r in runs[2:]])
+    assert await s.get_runs(task_name="one", latest=3) == runs[:2]
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_task_version(storage):
+    s = await storage()
+    tasks = await s.get_tasks()
+    version = await s.get_task_version()
+    await s.set_tasks(tasks)
+    assert await s.get_task_version() == version
+    await s.set_tasks(tasks + [Task("new", "image")])
+    assert await s.get_task_version() == version + 1
+    await s.set_tasks(tasks)
+    assert await s.get_task_version() == version + 2
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_task_stats(storage):
+    s = await storage()
+    for n in range(10):
+        run = Run(
+            "one",
+            Status.Error if n % 3 == 2 else Status.Success,
+            start=f"2020-01-01T00:{n:02d}:00",
+            end=f"2020-01-01T00:{n:02d}:{n:02d}",
+        )
+        await s.add_run(run)
+        await s.update_task_stats(run)
+    failed = Run("two", Status.Error, start="2020-01-01T00:00:00")
+    await s.add_run(failed)
+    stats = await s.update_task_stats(failed)
+    assert stats.consecutive_failures == 1
+    # recording the same run again changes nothing
+    await s.update_task_stats(failed)
+
+    all_stats = await s.get_task_stats()
+    assert set(all_stats) == {"one", "two"}
+    one = all_stats["one"]
+    assert (one.runs, one.successes, one.consecutive_failures) == (10, 7, 0)
+    # an estimate, the median is 4
+    assert 3 <= one.duration(0.5) <= 4
+    assert one.durations[0].count == 7
+    two = (await s.get_task_stats(["two"]))["two"]
+    assert (two.runs, two.last_status) == (1, Status.Error)
+    assert two.failing_since == "2020-01-01T00:00:00"
+
+
+@pytest.mark.parametrize(
+    "storage", [mem_storage, db_storage, sqlite_storage, tuned_sqlite_storage]
+)
+@pytest.mark.asyncio
+async def test_claim_run(storage):
+    s = await storage()
+    run = Run("one", Status.Queued, start="2020-01-01T00:00:00")
+    await s.add_run(run)
+    assert await s.claim_run(
+        run.uuid, Status.Queued, Status.Pending, {"claimed_at": "2020-01-02"}
+    )
+    # already claimed
+    assert not await s.claim_run(run.uuid, Status.Queued, Status.Pending)
+    assert not await s.claim_run("missing", Status.Queued, Status.Pending)
+    run = await s.get_run(run.uuid)
+    assert run.status == Status.Pending
+    assert run.run_info == {"claimed_at": "2020-01-02"}
@@ -0,0 +1,43 @@
+import pytest
+from ..base import Task
+from ..storages import TaskCacheStorage
+from ..storages.database import Tasks
+from .test_storages import db_storage, sqlite_storage
+
+
+@pytest.mark.parametrize("storage", [db_storage, sqlite_storage])
+@pytest.mark.asyncio
+async def test_tasks_read_once_per_version(storage):
+    inner = await storage()
+    s = TaskCacheStorage(inner, BOBSLED_TASK_CACHE_SECONDS=0)
+    assert (await s.get_task("one")).image == "image"
+
+    # an edit that doesn't bump the version isn't seen, the rows aren't read again
+    await inner.database.execute(
+        Tasks.update().where(Tasks.c.name == "one").values(image="edited")
+    )
+    assert (await s.get_task("one")).image == "image"
+
+    # another process changing the tasks bumps the version
+    other = TaskCacheStorage(inner, BOBSLED_TASK_CACHE_SECONDS=0)
+    await other.set_tasks([Task("one", "new"), Task("two", "image")])
+    assert [t.name for t in await s.get_tasks()] == ["one", "two"]
+    assert (await s.get_task("one")).image == "new"
+    assert await s.get_task("three") is None
+
+
+@pytest.mark.parametrize("storage", [sqlite_storage])
+@pytest.mark.asyncio
+async def test_version_checked_periodically(storage):
+    inner = await storage()
+    s = TaskCacheStorage(inner, BOBSLED_TASK_CACHE_SECONDS=60)
+    assert len(await s.get_tasks()) == 7
+
+    await inner.set_tasks([Task("one", "image")])
+    assert len(await s.get_tasks()) == 7
+    s.next_check = 0
+    assert len(await s.get_tasks()) == 1
+
+    # its own changes are seen right away
+    await s.set_tasks([Task("one", "image"), Task("two", "image")])
+    assert len(await s.get_tasks()) == 2
@@ -48,3 +48,22 @@ async def test_load_github_dir():
     await tp.update_tasks()
     tasks = await storage.get_tasks()
     assert len(tasks) == 4
+
+
+@pytest.mark.asyncio
+async def test_update_tasks_diff():
+    storage = InMemoryStorage()
+    tp = TaskProvider(storage=storage, BOBSLED_TASKS_FILENAME=ENV_FILE)
+    diff = await tp.update_tasks()
+    assert {t.name for t in diff.added} == {"hello-world", "full-example", "forever"}
+    assert diff.changed == diff.removed == []
+
+    # unchanged reload is an empty diff
+    diff = await tp.update_tasks()
+    assert len(diff.tasks) == 3
+    assert diff.added == diff.changed == diff.removed == []
+
+    tp.filename = os.path.join(os.path.dirname(__file__), "tasks/tasks2.yml")
+    diff = await tp.update_tasks()
+    assert [t.name for t in diff.added] == ["hello-world2"]
+    assert set(diff.removed) == {"hello-world", "full-example", "forever"}
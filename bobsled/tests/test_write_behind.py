@@ -0,0 +1,98 @@
+import asyncio
+import pytest
+from ..base import Run, Status
+from ..storages import InMemoryStorage, WriteBehindStorage
+from .test_storages import sqlite_storage
+
+
+class CountingStorage(InMemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    async def save_runs(self, runs):
+        self.batches.append([r.uuid for r in runs])
+        await super().save_runs(runs)
+
+
+@pytest.mark.asyncio
+async def test_updates_coalesced():
+    inner = CountingStorage()
+    s = WriteBehindStorage(inner, BOBSLED_WRITE_BEHIND_SECONDS=60)
+    one, two = Run("one", Status.Pending), Run("two", Status.Pending)
+    await s.add_run(one)
+    await s.add_run(two)
+    for n in range(3):
+        one.status = two.status = Status.Running
+        one.logs += f"line {n}\n"
+        await s.save_run(one)
+        await s.save_run(two)
+    assert inner.batches == []
+    assert await inner.get_logs(one.uuid) == ""
+
+    # reads see pending updates
+    assert (await s.get_active_runs()).counts[Status.Running] == 2
+    assert inner.batches == [[one.uuid, two.uuid]]
+    assert await s.get_logs(one.uuid) == "line 0\nline 1\nline 2\n"
+
+
+@pytest.mark.asyncio
+async def test_terminal_saved_immediately():
+    inner = CountingStorage()
+    s = WriteBehindStorage(inner, BOBSLED_WRITE_BEHIND_SECONDS=60)
+    run = Run("one", Status.Running)
+    await s.add_run(run)
+    run.logs = "partial\n"
+    await s.save_run(run)
+    run.status = Status.Success
+    run.logs = "partial\ndone"
+    await s.save_run(run)
+    assert s.pending == {}
+    assert await inner.get_logs(run.uuid) == "partial\ndone"
+    assert inner.batches == []
+
+
+@pytest.mark.asyncio
+async def test_flushed_after_delay():
+    inner = await sqlite_storage()
+    s = WriteBehindStorage(inner, BOBSLED_WRITE_BEHIND_SECONDS=0.05)
+    run = Run("one", Status.Pending, start="2020-01-01T00:00:00")
+    await s.add_run(run)
+    run.status = Status.Running
+    await s.save_run(run)
+    assert (await inner.get_run(run.uuid)).status == Status.Pending
+    await asyncio.sleep(0.1)
+    assert s.pending == {}
+    assert (await inner.get_run(run.uuid)).status == Status.Running
+
+
+class SlowStorage(InMemoryStorage):
+    """records the status each write stores, read when the write starts"""
+
+    def __init__(self):
+        super().__init__()
+        self.stored = {}
+
+    async def save_run(self, run):
+        self.stored[run.uuid] = run.status
+
+    async def save_runs(self, runs):
+        for uuid, status in [(r.uuid, r.status) for r in runs]:
+            await asyncio.sleep(0.01)
+            self.stored[uuid] = status
+
+
+@pytest.mark.asyncio
+async def test_terminal_save_waits_for_flush():
+    inner = SlowStorage()
+    s = WriteBehindStorage(inner, BOBSLED_WRITE_BEHIND_SECONDS=60)
+    a, b = Run("a", Status.Running), Run("b", Status.Running)
+    await s.save_run(a)
+    await s.save_run(b)
+    flush = asyncio.ensure_future(s.flush())
+    # while the flush is writing a, with b still to come
+    await asyncio.sleep(0.005)
+    b.status = Status.Success
+    await s.save_run(b)
+    await flush
+    assert inner.stored == {a.uuid: Status.Running, b.uuid: Status.Success}
@@ -1,4 +1,5 @@
 import os
+import json
 import datetime
 import asyncio
 import attr
@@ -13,18 +14,23 @@ from starlette.authentication import (
 )
 from starlette.middleware import Middleware
 from starlette.middleware.authentication import AuthenticationMiddleware
-from starlette.responses import JSONResponse, RedirectResponse
+from starlette.responses import JSONResponse, RedirectResponse, StreamingResponse
 from starlette.routing import Route, WebSocketRoute, Mount
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 import uvicorn
 import jwt
 
-from .base import Status
+from .base import Status, parse_time
+from .cron import TaskSchedule
 from .exceptions import AlreadyRunning
 from .core import bobsled
 
 
+MAX_PAGE_SIZE = 500
+DURATION_STATS_DAYS = 30
+
+
 class JWTSessionAuthBackend(AuthenticationBackend):
     async def authenticate(self, request):
         jwt_token = request.cookies.get("jwt_token")
@@ -126,17 +132,14 @@ async def index(request):
     return templates.TemplateResponse("base.html", {"request": request})
 
 
-def _parse_time(time):
-    return datetime.datetime.strptime(time, "%Y-%m-%dT%H:%M:%S.%f")
-
-
 def _run2dict(run):
+    # stored runs have their duration already, this only computes it for others
+    run.set_duration()
+    seconds = run.duration_seconds
     run = attr.asdict(run)
     run["status"] = run["status"].name
-    if run["end"]:
-        tdelta = _parse_time(run["end"]) - _parse_time(run["start"])
-        hour, rem = divmod(tdelta.seconds, 3600)
-        hour += tdelta.days * 24
+    if seconds is not None:
+        hour, rem = divmod(int(seconds), 3600)
         minutes, seconds = divmod(rem, 60)
         run["duration"] = f"{hour}:{minutes:02d}:{seconds:02d}"
     else:
@@ -144,13 +147,89 @@ def _run2dict(run):
     return run
 
 
+async def _iter_run_logs(run, offset=0):
+    """
+    a run's logs from 'offset' on, taken from the run if its logs were just updated
+    and otherwise streamed from storage
+    """
+    if run.logs:
+        if run.complete_logs()[offset:]:
+            yield run.complete_logs()[offset:]
+    else:
+        async for text in bobsled.storage.iter_logs(run.uuid, offset):
+            yield text
+
+
+async def _stream_run(run):
+    """_run2dict as JSON, streaming the logs rather than loading them all at once"""
+    rundata = _run2dict(run)
+    rundata.pop("logs")
+    yield json.dumps(rundata)[:-1] + ', "logs": "'
+    async for text in _iter_run_logs(run):
+        # escapes each piece, leaving off the quotes
+        yield json.dumps(text)[1:-1]
+    yield '"}'
+
+
+async def _update_run(run_id):
+    # finished runs are returned as-is, without loading their logs
+    run = await bobsled.storage.get_run(run_id, logs=False)
+    return await bobsled.run.update_status(run, update_logs=True)
+
+
+def _cursor(run):
+    return f"{run.start},{run.uuid}"
+
+
+def _parse_cursor(cursor):
+    if not cursor:
+        return None
+    start, _, uuid = cursor.rpartition(",")
+    try:
+        valid = uuid and parse_time(start)
+    except ValueError:
+        valid = False
+    if not valid:
+        raise ValueError(f"invalid cursor: {cursor}")
+    return start, uuid
+
+
+async def _run_page(request, *, limit=100, **kwargs):
+    """
+    a page of runs, new to old, for ?before=cursor or ?after=cursor
+
+    the response has the cursors for the pages of older and newer runs, raises
+    ValueError for an invalid limit or cursor
+    """
+    try:
+        limit = int(request.query_params.get("limit", limit))
+    except ValueError:
+        raise ValueError("limit must be a whole number")
+    # 0 would mean no limit at all
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    runs = await bobsled.run.get_runs(
+        latest=limit,
+        before=_parse_cursor(request.query_params.get("before")),
+        after=_parse_cursor(request.query_params.get("after")),
+        **kwargs,
+    )
+    return {
+        "runs": [_run2dict(r) for r in runs],
+        "older": _cursor(runs[-1]) if runs else None,
+        "newer": _cursor(runs[0]) if runs else None,
+    }
+
+
 @requires(["authenticated"], redirect="login")
 async def api_index(request):
     tasks = [attr.asdict(t) for t in await bobsled.storage.get_tasks()]
-    results = await asyncio.gather(
-        *[bobsled.run.get_runs(task_name=t["name"], latest=4) for t in tasks]
-    )
-    for task, latest_runs in zip(tasks, results):
+    runs_by_task = await bobsled.storage.get_latest_runs(4)
+    stats = await bobsled.storage.get_task_stats()
+    for task in tasks:
+        task_stats = stats.get(task["name"])
+        task["stats"] = task_stats.to_dict() if task_stats else None
+        # new to old
+        latest_runs = runs_by_task.get(task["name"], [])[::-1]
         if latest_runs:
             task["latest_run"] = _run2dict(latest_runs[0])
             task["recent_statuses"] = [r.status.name for r in latest_runs]
@@ -169,20 +248,44 @@ async def api_index(request):
 
 @requires(["authenticated"], redirect="login")
 async def latest_runs(request):
-    return JSONResponse(
-        {"runs": [_run2dict(r) for r in await bobsled.run.get_runs(latest=100)]}
-    )
+    try:
+        return JSONResponse(await _run_page(request))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+
+@requires(["authenticated"], redirect="login")
+async def queue(request):
+    stats = await bobsled.run.queue_stats()
+    runs = await bobsled.run.get_runs(status=Status.Queued)
+    return JSONResponse({**stats, "runs": [_run2dict(r) for r in runs]})
 
 
 @requires(["authenticated"], redirect="login")
 async def task_overview(request):
     task_name = request.path_params["task_name"]
     task = await bobsled.storage.get_task(task_name)
-    runs = await bobsled.run.get_runs(
-        task_name=task_name, update_status=True, latest=40
+    try:
+        page = await _run_page(
+            request, task_name=task_name, limit=40, update_status=True
+        )
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    try:
+        next_runs = TaskSchedule.for_task(task).next_n(datetime.datetime.utcnow(), 5)
+    except ValueError:
+        next_runs = []
+    since = datetime.datetime.utcnow() - datetime.timedelta(days=DURATION_STATS_DAYS)
+    durations = await bobsled.storage.get_duration_stats(
+        task_names=[task_name], status=Status.Success, since=since.isoformat()
     )
     return JSONResponse(
-        {"task": attr.asdict(task), "runs": [_run2dict(r) for r in runs]}
+        {
+            "task": attr.asdict(task),
+            **page,
+            "next_runs": [n.isoformat() for n in next_runs],
+            "durations": durations.get(task_name),
+        }
     )
 
 
@@ -192,8 +295,13 @@ async def run_task(request):
     if "admin" not in request.auth.scopes:
         return JSONResponse({"error": "Insufficient permissions."})
     task = await bobsled.storage.get_task(task_name)
+    priority = request.query_params.get("priority")
     try:
-        run = await bobsled.run.run_task(task)
+        priority = int(priority) if priority else None
+    except ValueError:
+        return JSONResponse({"error": "priority must be an integer"}, status_code=400)
+    try:
+        run = await bobsled.run.run_task(task, priority=priority)
     except AlreadyRunning:
         return JSONResponse({"error": "Task was already running"})
     return JSONResponse(_run2dict(run))
@@ -201,10 +309,8 @@ async def run_task(request):
 
 @requires(["authenticated"], redirect="login")
 async def run_detail(request):
-    run_id = request.path_params["run_id"]
-    run = await bobsled.run.update_status(run_id, update_logs=True)
-    rundata = _run2dict(run)
-    return JSONResponse(rundata)
+    run = await _update_run(request.path_params["run_id"])
+    return StreamingResponse(_stream_run(run), media_type="application/json")
 
 
 @requires(["authenticated"], redirect="login")
@@ -214,10 +320,34 @@ async def stop_run(request):
     return JSONResponse({})
 
 
+async def notify_beat(message):
+    """send a message to beat's control socket, without waiting if beat is down"""
+    hostname = os.environ.get("BOBSLED_BEAT_HOSTNAME", "beat")
+    port = os.environ.get("BOBSLED_BEAT_CONTROL_PORT", "1989")
+    socket = zmq.asyncio.Context.instance().socket(zmq.PUSH)
+    socket.connect(f"tcp://{hostname}:{port}")
+    try:
+        await socket.send_string(message, zmq.NOBLOCK)
+    except zmq.Again:
+        # beat picks changes up on its next scheduled config update anyway
+        pass
+    finally:
+        # give the message a moment to be delivered after the socket is closed
+        socket.close(linger=1000)
+
+
 @requires(["authenticated", "admin"], redirect="login")
 async def update_config(request):
-    tasks = [attr.asdict(t) for t in await bobsled.refresh_config()]
-    return JSONResponse({"tasks": tasks})
+    diff = await bobsled.refresh_config()
+    await notify_beat("config_changed")
+    return JSONResponse(
+        {
+            "tasks": [attr.asdict(t) for t in diff.tasks],
+            "added": [t.name for t in diff.added],
+            "changed": [t.name for t in diff.changed],
+            "removed": diff.removed,
+        }
+    )
 
 
 @requires(["authenticated"], redirect="login")
@@ -240,10 +370,16 @@ async def beat_websocket(websocket):
 async def websocket_endpoint(websocket):
     await websocket.accept()
     run_id = websocket.path_params["run_id"]
+    # logs are sent as they arrive, with the offset they start at
+    offset = 0
     while True:
-        run = await bobsled.run.update_status(run_id, update_logs=True)
+        run = await _update_run(run_id)
         rundict = _run2dict(run)
+        rundict.pop("logs")
         await websocket.send_json(rundict)
+        async for text in _iter_run_logs(run, offset):
+            await websocket.send_json({"logs_offset": offset, "logs_append": text})
+            offset += len(text)
         if run.status not in (Status.Running, Status.Pending):
             break
         await asyncio.sleep(1)
@@ -265,6 +401,7 @@ app = Starlette(
         # API
         Route("/api/index", api_index),
         Route("/api/latest_runs", latest_runs),
+        Route("/api/queue", queue),
         Route("/api/task/{task_name}", task_overview),
         Route("/api/task/{task_name}/run", run_task, methods=["POST"]),
         Route("/api/run/{run_id}", run_detail),
@@ -284,6 +421,7 @@ app = Starlette(
     ],
     middleware=[Middleware(AuthenticationMiddleware, backend=JWTSessionAuthBackend())],
     on_startup=[bobsled.initialize],
+    on_shutdown=[bobsled.shutdown],
 )
 
 
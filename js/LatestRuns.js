@@ -11,7 +11,11 @@ class LatestRuns extends React.Component {
   }
 
   componentDidMount() {
-    fetch("/api/latest_runs")
+    this.loadPage("");
+  }
+
+  loadPage(query) {
+    fetch("/api/latest_runs" + query)
       .then(response => response.json())
       .then(data => this.setState(data));
   }
@@ -21,6 +25,20 @@ class LatestRuns extends React.Component {
       <section className="section">
         <div className="container">
           <RunList title="Latest Runs" runs={this.state.runs} />
+          <button
+            className="button"
+            disabled={!this.state.newer}
+            onClick={() => this.loadPage("?after=" + this.state.newer)}
+          >
+            Newer
+          </button>
+          <button
+            className="button"
+            disabled={!this.state.older}
+            onClick={() => this.loadPage("?before=" + this.state.older)}
+          >
+            Older
+          </button>
         </div>
       </section>
     );
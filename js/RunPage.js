@@ -23,7 +23,15 @@ class RunPage extends React.Component {
   componentDidMount() {
     this.state.ws.onmessage = (evt) => {
       const message = JSON.parse(evt.data);
-      this.setState(message);
+      if ("logs_append" in message) {
+        this.setState((state) => ({
+          logs:
+            (state.logs || "").slice(0, message.logs_offset) +
+            message.logs_append,
+        }));
+      } else {
+        this.setState(message);
+      }
     };
 
     fetch("/api/run/" + this.props.match.params.run_id)
@@ -0,0 +1,88 @@
+import sys
+import time
+import random
+import zlib
+from bobsled.logs import compress_logs, iter_decompressed
+
+"""
+Compression ratio and CPU cost of zlib on run logs.
+
+usage: python scripts/benchmark_log_compression.py [log files...]
+
+without arguments it uses generated logs that look like scraper output
+"""
+
+LEVELS = [1, 6, 9]
+
+
+def scraper_log(lines, seed=0):
+    rng = random.Random(seed)
+    states = ["ak", "al", "ca", "ny", "tx", "wa"]
+    out = []
+    for n in range(lines):
+        ts = f"2020-03-{n // 80000 + 1:02d} {n // 3600 % 24:02d}:{n // 60 % 60:02d}:{n % 60:02d}"
+        kind = rng.random()
+        state = rng.choice(states)
+        if kind < 0.7:
+            page = rng.randint(1, 50000)
+            out.append(
+                f"{ts} INFO scrapelib: GET - https://legislature.{state}.gov/bills/"
+                f"?session=2020&page={page}"
+            )
+        elif kind < 0.9:
+            out.append(
+                f"{ts} INFO openstates: save bill {state.upper()} HB {rng.randint(1, 4000)}"
+                f" as bill_{rng.getrandbits(64):016x}.json"
+            )
+        elif kind < 0.99:
+            out.append(f"{ts} WARNING openstates: no sponsor found for vote {n}")
+        else:
+            out.append(
+                "Traceback (most recent call last):\n"
+                '  File "scrape.py", line 112, in scrape_bill\n'
+                "    doc = self.lxmlize(url)\n"
+                f"requests.exceptions.HTTPError: 500 Server Error for url: {state}/{n}"
+            )
+    return "\n".join(out) + "\n"
+
+
+def fixtures():
+    if len(sys.argv) > 1:
+        for filename in sys.argv[1:]:
+            with open(filename) as f:
+                yield filename, f.read()
+    else:
+        for lines in (1000, 20000, 200000):
+            yield f"generated {lines} lines", scraper_log(lines)
+
+
+def timed(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    print(
+        f"{'fixture':<24} {'size':>9} {'level':>5} {'ratio':>6} {'compress':>10} {'stream':>10}"
+    )
+    for name, logs in fixtures():
+        raw = logs.encode()
+        megabytes = len(raw) / 1e6
+        for level in LEVELS:
+            data, compress_time = timed(lambda: zlib.compress(raw, level))
+            _, stream_time = timed(lambda: sum(len(t) for t in iter_decompressed(data)))
+            print(
+                f"{name:<24} {megabytes:>7.2f}MB {level:>5} {len(raw) / len(data):>5.1f}x "
+                f"{megabytes / compress_time:>6.0f}MB/s {megabytes / stream_time:>6.0f}MB/s"
+            )
+    # sanity check the module's own settings
+    assert "".join(iter_decompressed(compress_logs(logs))) == logs
+
+
+if __name__ == "__main__":
+    main()
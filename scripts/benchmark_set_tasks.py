@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import asyncio
+import tempfile
+from bobsled.base import Task, Trigger
+from bobsled.storages import DatabaseStorage
+
+"""
+Times DatabaseStorage.set_tasks against catalogue size.
+
+usage: python scripts/benchmark_set_tasks.py [database_uri]
+
+defaults to a temporary SQLite database, pass a postgresql:// URI to test Postgres
+(the bobsled_task table will be overwritten)
+"""
+
+SIZES = [100, 500, 1500, 3000]
+
+
+def make_tasks(n, version=0):
+    return [
+        Task(
+            f"task-{i}",
+            f"image:{version}",
+            tags=["benchmark"],
+            entrypoint=["run", str(i)],
+            triggers=[Trigger(f"{i % 60} * * * *")],
+        )
+        for i in range(n)
+    ]
+
+
+async def timed(coro):
+    start = time.perf_counter()
+    await coro
+    return time.perf_counter() - start
+
+
+async def benchmark(uri):
+    storage = DatabaseStorage(uri)
+    await storage.connect()
+    print(f"{'tasks':>6} {'initial':>9} {'unchanged':>10} {'10% changed':>12}")
+    for size in SIZES:
+        await storage.set_tasks([])
+        tasks = make_tasks(size)
+        initial = await timed(storage.set_tasks(tasks))
+        unchanged = await timed(storage.set_tasks(tasks))
+        changed = make_tasks(size // 10, version=1) + tasks[size // 10 :]
+        partial = await timed(storage.set_tasks(changed))
+        print(f"{size:>6} {initial:>8.3f}s {unchanged:>9.3f}s {partial:>11.3f}s")
+    await storage.database.disconnect()
+
+
+def main():
+    if len(sys.argv) > 1:
+        uri = sys.argv[1]
+    else:
+        uri = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    asyncio.run(benchmark(uri))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import tempfile
+from bobsled.base import Run, Status, Task
+from bobsled.storages import DatabaseStorage, SQLiteStorage
+
+"""
+Compares DatabaseStorage on SQLite with SQLiteStorage while beat and the web UI use
+the database at the same time.
+
+A "beat" task starts runs, updates their logs and finishes them, while several "web"
+tasks read the dashboard, run pages and single runs.  Each storage runs for the same
+time against a fresh database seeded with past runs.
+
+usage: python scripts/benchmark_sqlite.py [seconds] [web readers]
+"""
+
+TASKS = 50
+SEEDED_RUNS = 2000
+LOG_LINE = "INFO scraped https://example.com/page/123 status=200 items=25\n"
+
+
+async def seed(storage):
+    await storage.connect()
+    await storage.set_tasks([Task(f"task-{n}", "image") for n in range(TASKS)])
+    runs = []
+    for n in range(SEEDED_RUNS):
+        run = Run(
+            f"task-{n % TASKS}",
+            Status.Success,
+            start=f"2020-01-01T00:00:00.{n:06d}",
+            end=f"2020-01-01T00:01:00.{n:06d}",
+            logs=LOG_LINE * 20,
+        )
+        await storage.add_run(run)
+        runs.append(run.uuid)
+    return runs
+
+
+async def beat(storage, stop, counts):
+    n = 0
+    while not stop.is_set():
+        run = Run(f"task-{n % TASKS}", Status.Running, start="2020-01-02T00:00:00")
+        await storage.add_run(run)
+        for _ in range(5):
+            run.logs += LOG_LINE * 10
+            await storage.save_run(run)
+        run.status = Status.Success
+        run.end = "2020-01-02T00:01:00"
+        await storage.save_run(run)
+        counts["writes"] += 7
+        n += 1
+
+
+async def web(storage, stop, counts, run_ids):
+    while not stop.is_set():
+        await storage.get_latest_runs(4)
+        await storage.get_runs(latest=100)
+        await storage.get_run(random.choice(run_ids))
+        await storage.get_runs(task_name=f"task-{random.randrange(TASKS)}", latest=40)
+        counts["reads"] += 4
+
+
+async def benchmark(Storage, seconds, readers):
+    storage = Storage("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+    # in its own task, so the tasks below each get their own connection
+    run_ids = await asyncio.ensure_future(seed(storage))
+    counts = {"reads": 0, "writes": 0}
+    stop = asyncio.Event()
+    tasks = [asyncio.ensure_future(beat(storage, stop, counts))] + [
+        asyncio.ensure_future(web(storage, stop, counts, run_ids))
+        for _ in range(readers)
+    ]
+    start = time.perf_counter()
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    await storage.database.disconnect()
+    return counts["reads"] / elapsed, counts["writes"] / elapsed
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    print(f"{'storage':>16} {'reads/s':>9} {'writes/s':>9}")
+    for Storage in (DatabaseStorage, SQLiteStorage):
+        reads, writes = asyncio.run(benchmark(Storage, seconds, readers))
+        print(f"{Storage.__name__:>16} {reads:>9.1f} {writes:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
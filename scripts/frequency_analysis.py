@@ -1,25 +1,13 @@
 import asyncio
-import attr
 import pprint
-import dateutil.parser
-from datetime import timedelta
 from bobsled.core import bobsled
 from bobsled.base import Status
 
 
-def recommend_frequency_for_task(runs):
-    total_duration = timedelta(seconds=0)
-    longest_duration = timedelta(seconds=0)
-    for run in runs:
-        start = dateutil.parser.parse(run.start)
-        end = dateutil.parser.parse(run.end)
-        duration = end - start
-        total_duration += duration
-        if duration > longest_duration:
-            longest_duration = duration
-    if longest_duration.seconds <= 60 * 10:
+def recommend_frequency_for_task(longest_seconds):
+    if longest_seconds <= 60 * 10:
         return '0 */2 * * ?'
-    elif longest_duration.seconds <= 60 * 60:
+    elif longest_seconds <= 60 * 60:
         return '0 */6 * * ?'
     else:
         return 'daily'
@@ -27,22 +15,23 @@ def recommend_frequency_for_task(runs):
 
 async def analyze_frequency():
     await bobsled.initialize()
-    tasks = [attr.asdict(t) for t in await bobsled.storage.get_tasks()]
-    results = await asyncio.gather(
-        *[bobsled.run.get_runs(task_name=t["name"], latest=4) for t in tasks]
-    )
+    tasks = await bobsled.storage.get_tasks()
+    # one row per task, rather than reading each task's runs
+    stats = await bobsled.storage.get_task_stats()
     recommendations = []
-    for task, latest_runs in zip(tasks, results):
+    for task in tasks:
+        task_stats = stats.get(task.name)
         # make recommendations for scrape tasks that have runs
-        if latest_runs and '-scrape' in task['name']:
-            if all(run.status is Status.Success for run in latest_runs):
-                recommendation = recommend_frequency_for_task(latest_runs)
+        if task_stats and '-scrape' in task.name:
+            longest = task_stats.duration(0.99)
+            if task_stats.last_status is Status.Success and longest is not None:
+                recommendation = recommend_frequency_for_task(longest)
             else:
-                # a recent run failed, made a note of that
-                recommendation = 'n/a - at least one recent task failed'
+                # the latest run failed, made a note of that
+                recommendation = 'n/a - the latest run failed'
             recommendations.append({
-                'task': task['name'],
-                'current_schedule': task['triggers'][0]['cron'],
+                'task': task.name,
+                'current_schedule': task.triggers[0].cron,
                 'recommended': recommendation
             })
 
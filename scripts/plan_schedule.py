@@ -0,0 +1,34 @@
+import sys
+import asyncio
+from bobsled.core import bobsled
+from bobsled.planner import expected_durations, make_plan
+
+
+async def plan_schedule(apply):
+    await bobsled.initialize()
+    tasks = await bobsled.storage.get_tasks()
+    durations = await expected_durations(bobsled.storage, tasks)
+    current = await bobsled.storage.get_schedule_offsets()
+    plan = make_plan(tasks, durations, current)
+
+    print(f"predicted peak concurrency: {plan.peak_before} => {plan.peak_after}")
+    for task_name, offset in sorted(plan.offsets.items()):
+        if current.get(task_name) != offset:
+            print(
+                f"  {task_name}: ~{durations.get(task_name, '?')} min, "
+                f"offset {current.get(task_name, 'default')} => {offset}"
+            )
+
+    if apply:
+        await bobsled.storage.set_schedule_offsets(plan.offsets)
+        print("saved offsets, beat will pick them up on its next config update")
+    else:
+        print("run with --apply to save these offsets")
+
+
+def main():
+    asyncio.run(plan_schedule("--apply" in sys.argv))
+
+
+if __name__ == "__main__":
+    main()